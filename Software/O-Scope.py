@@ -28,6 +28,7 @@ from kivy.uix.button import Button
 from kivy.uix.togglebutton import ToggleButton
 from kivy.uix.spinner import SpinnerOption
 from kivy.uix.label import Label
+from kivy.uix.textinput import TextInput
 from kivy.uix.image import Image
 from kivy.uix.widget import Widget
 from kivy.uix.behaviors import ButtonBehavior, ToggleButtonBehavior
@@ -46,7 +47,27 @@ from plyer import filechooser
 import numpy as np
 import sigfig
 import math
+import bisect
+import time
 import oscope
+import devicewatcher
+import frameprocessor
+import acquisition
+import persistence
+import spectrum
+import measurements
+import triggers
+import mathchannels
+import autoset
+import bodesweep
+import bodeanalysis
+import bodeplan
+import offsetupload
+import offsetsynth
+import devicewrites
+import digitalpoller
+import logictimeline
+import wavepreview
 import os, pathlib, sys
 import kivy.resources as kivy_resources
 import serial.tools.list_ports as list_ports
@@ -657,10 +678,55 @@ class ScopePlot(Plot):
         self.trigger_edge = 'Rising'
         self.triggered = False
         self.trigger_repeat = False
+        self.trigger_types = ('Edge', 'Pulse<', 'Pulse>', 'Runt', 'Window')
+        self.trigger_type = 'Edge'
+        self.trigger_hystereses = (0., 0.01, 0.05, 0.2, 1.)
+        self.trigger_hysteresis = 0.
+        self.trigger_holdoffs = (0., 0.5, 1., 2.)
+        self.trigger_holdoff = 0.
+        self.trigger = None
+        self.trigger_settings = None
 
         self.sweep_in_progress = 0
         self.samples_left = app.dev.SCOPE_BUFFER_SIZE // 2
 
+        self.processor = frameprocessor.FrameProcessor(app.dev.SCOPE_BUFFER_SIZE // 2)
+
+        self.partial_transfers = True
+        self.frame_start = 0
+
+        self.host_acquire_mode = 'SAMP'
+        self.averager = acquisition.FrameAverager(app.dev.SCOPE_BUFFER_SIZE // 2, 16)
+        self.envelope = acquisition.FrameEnvelope(app.dev.SCOPE_BUFFER_SIZE // 2)
+        self.equivalent_time = acquisition.EquivalentTimeSampler(app.dev.SCOPE_BUFFER_SIZE // 2, 20)
+        self.host_acquire_settings = None
+        self.last_ch1 = np.zeros(0)
+        self.last_ch2 = np.zeros(0)
+
+        self.roll_mode = False
+        self.roll_pos = None
+        self.roll_interval = None
+        self.roll_ch1 = np.zeros(0)
+        self.roll_ch2 = np.zeros(0)
+        self.roll_t = np.zeros(0)
+        self.roll_head = 0
+        self.roll_count = 0
+        self.roll_sweep_start = 0.
+
+        self.persistence = None
+        self.persistence_view = None
+        self.persistence_decays = (0.5, 0.8, 0.95, 1.)
+
+        self.show_measurements = False
+        self.measurement_interval = None
+        self.measurement_names = {'frequency': 'Freq', 'vpp': 'Vpp', 'duty': 'Duty', 'rise_time': 'Rise', 'phase': 'Phase'}
+        self.measurement_engine = measurements.MeasurementEngine([(ch, name) for ch in ('CH1', 'CH2') for name in ('frequency', 'vpp', 'duty', 'rise_time')] + [('CH1-CH2', 'phase')])
+
+        self.math_expression = None
+        self.math_autoscale = False
+
+        self.autoset = None
+
         self.volts_per_lsb = (5e-3, 1e-3)
         self.voltage_ranges = (u':\xB110V', u':\xB12V') 
 
@@ -697,6 +763,7 @@ class ScopePlot(Plot):
         # Add CH1/CH2 colors to the plot's color dict for curve rendering
         self.colors['ch1'] = theme['ch1_color']
         self.colors['ch2'] = theme['ch2_color']
+        self.colors['math'] = theme['waveform_color']
 
         self.yaxes['left'].color = theme['axes_color']
         self.yaxes['left'].yaxis_mode = 'linear'
@@ -711,6 +778,8 @@ class ScopePlot(Plot):
         self.yaxes['CH2'].v_cursor1 = 0.
         self.yaxes['CH2'].v_cursor2 = 0.
 
+        self.yaxes['MATH'] = self.y_axis(name = 'MATH', color = theme['waveform_color'], units = '', yaxis_mode = 'linear', ylimits_mode = 'manual', ylim = [-10., 10.])
+
         self.left_yaxis = 'CH1'
 
         self.ch1_display = u'CH1:\xB110V'
@@ -718,6 +787,7 @@ class ScopePlot(Plot):
 
         self.curves['CH1'] = self.curve(name = 'CH1', yaxis = 'CH1', curve_color = 'ch1', curve_style = '-')
         self.curves['CH2'] = self.curve(name = 'CH2', yaxis = 'CH2', curve_color = 'ch2', curve_style = '-')
+        self.curves['MATH'] = self.curve(name = 'MATH', yaxis = 'MATH', curve_color = 'math', curve_style = '')
 
         self.configure(background = theme['plot_background'], axes_background = theme['axes_background'], 
                        axes_color = theme['axes_color'], grid_color = theme['grid_color'], 
@@ -731,6 +801,7 @@ class ScopePlot(Plot):
             self.update_job = None
 
         self.trigger_mode = 'Single'
+        self.autoset = None
 
         self.show_sampling_rate = True
         self.sampling_rate_display = 'Not connected'
@@ -744,6 +815,7 @@ class ScopePlot(Plot):
         self.draw_v_cursors()
         self.draw_h_cursors()
         self.draw_chs_display()
+        self.draw_measurements()
         if self.show_sampling_rate and (self.sampling_rate_display != ''):
             self.add_text(text = self.sampling_rate_display, anchor_pos = [self.axes_right, self.axes_bottom - 3.5 * self.label_fontsize], anchor = 'se', color = self.axes_color, font_size = self.label_fontsize)
 
@@ -841,11 +913,35 @@ class ScopePlot(Plot):
             self.canvas.add(Line(rectangle = [self.axes_left + 5. * self.label_fontsize, self.axes_top + 3., 5. * self.label_fontsize - 2., 2. * self.label_fontsize - 1.]))
             self.add_text(text = self.ch2_display, anchor_pos = [self.axes_left + 7.5 * self.label_fontsize, self.axes_top + 0.5 * self.label_fontsize], anchor = 's', color = self.axes_background_color, font_size = self.label_fontsize)
 
+    def draw_measurements(self):
+        if not self.show_measurements:
+            return
+
+        colors = {'CH1': self.yaxes['CH1'].color, 'CH2': self.yaxes['CH2'].color, 'CH1-CH2': self.axes_color}
+        y = self.axes_top - 0.5 * self.label_fontsize
+        for (channel, name), [current, lo, hi, mean, std, count] in self.measurement_engine.results().items():
+            if count == 0:
+                readout = '{} {}: ---'.format(channel, self.measurement_names[name])
+            else:
+                readout = '{} {}: {}{}, \u03C3 {}{}'.format(channel, self.measurement_names[name], app.num2str(mean, 4), measurements.UNITS[name], app.num2str(std, 2), measurements.UNITS[name])
+            self.add_text(text = readout, anchor_pos = [self.axes_right - 0.5 * self.label_fontsize, y], anchor = 'ne', color = colors[channel], font_size = self.label_fontsize)
+            y -= 1.5 * self.label_fontsize
+
     def update_scope_plot(self, t):
         if not app.dev.connected:
             return
 
+        # leave the link to an offset waveform upload until it is done
+        if app.offset_upload is not None:
+            self.update_job = Clock.schedule_once(self.update_scope_plot, 0.1)
+            return
+
         try:
+            if self.autoset is not None:
+                self.update_autoset()
+                self.update_job = Clock.schedule_once(self.update_scope_plot, 0.05)
+                return
+
             sampling_interval = app.dev.sampling_interval
 
             ch1_range = app.dev.ch1_range
@@ -858,7 +954,21 @@ class ScopePlot(Plot):
                 sampling_rate = 1. / sampling_interval
                 self.sampling_rate_display = app.num2str(sampling_rate, 4) + 'S/s'
                 acquire_modes = ('SAMP', 'AVG02', 'AVG04', 'AVG08', 'AVG16')
+                if self.host_acquire_mode == 'AVG':
+                    self.sampling_rate_display = 'MEAN{:d}, '.format(self.averager.depth) + self.sampling_rate_display
+                elif self.host_acquire_mode == 'ENV':
+                    self.sampling_rate_display = 'ENV, ' + self.sampling_rate_display
+                elif self.host_acquire_mode == 'ET':
+                    self.sampling_rate_display = 'ETx{:d}, '.format(self.equivalent_time.factor) + app.num2str(sampling_rate * self.equivalent_time.factor, 4) + 'S/s'
                 self.sampling_rate_display = acquire_modes[app.dev.num_avg] + ', ' + self.sampling_rate_display
+                if self.persistence is not None:
+                    self.sampling_rate_display = ('PERS INF, ' if self.persistence.infinite else 'PERS, ') + self.sampling_rate_display
+                if self.trigger_holdoff > 0.:
+                    self.sampling_rate_display = 'HOLD, ' + self.sampling_rate_display
+                if self.trigger_hysteresis > 0.:
+                    self.sampling_rate_display = 'HYST ' + app.num2str(self.trigger_hysteresis, 2) + 'V, ' + self.sampling_rate_display
+                if self.trigger_type != 'Edge':
+                    self.sampling_rate_display = self.trigger_type.upper() + ', ' + self.sampling_rate_display
 
             if sampling_interval == 0.25e-6:
                 ch1_zero = app.dev.ch1_zero_4MSps[ch1_range]
@@ -873,90 +983,522 @@ class ScopePlot(Plot):
 
             num_samples = app.dev.SCOPE_BUFFER_SIZE // 2
 
-            if self.trigger_mode == 'Continuous':
-                scope_buffer = app.dev.trigger()
-            elif self.trigger_mode == 'Armed':
-                scope_buffer = app.dev.trigger()
+            if self.roll_mode and (self.trigger_mode == 'Continuous') and (sampling_interval > 200e-6):
+                delay = self.update_roll_plot(sampling_interval, num_samples, [self.volts_per_lsb[ch1_range], ch1_gain, ch1_zero], [self.volts_per_lsb[ch2_range], ch2_gain, ch2_zero])
+                self.update_job = Clock.schedule_once(self.update_scope_plot, delay)
+                return
+            self.roll_pos = None
+
+            window = self.get_view_window(sampling_interval, num_samples)
+
+            sweep_triggered = self.trigger_mode in ('Continuous', 'Armed')
+            if sweep_triggered:
+                app.dev.trigger_sweep()
+            if self.trigger_mode == 'Armed':
                 self.trigger_mode = 'Single'
+
+            ch1_cal = [self.volts_per_lsb[ch1_range], ch1_gain, ch1_zero]
+            ch2_cal = [self.volts_per_lsb[ch2_range], ch2_gain, ch2_zero]
+            if self.trigger_source == 'CH1':
+                [start, count] = self.read_frame(window, num_samples, 0, ch1_cal)
             else:
-                scope_buffer = app.dev.get_bufferbin()
+                [start, count] = self.read_frame(window, num_samples, 1, ch2_cal)
+
+            if not sweep_triggered:
                 if not app.dev.sweep_in_progress():
                     app.root.scope.play_pause_button.source = kivy_resources.resource_find('play.png')
                     app.root.scope.play_pause_button.reload()
                     self.trigger_mode = 'Single'
 
-            ch1_vals = np.array(scope_buffer[0:num_samples])
-            ch2_vals = np.array(scope_buffer[num_samples:])
-
             [self.sweep_in_progress, self.samples_left] = app.dev.get_sweep_progress()
-            if (self.sweep_in_progress == 1) and (sampling_interval <= 200e-6):
+            held = (self.sweep_in_progress == 1) and (sampling_interval <= 200e-6)
+            if held and (self.host_acquire_mode != 'SAMP'):
+                ch1 = self.last_ch1
+                ch2 = self.last_ch2
+                start = self.frame_start
+            elif held:
                 ch1 = self.curves['CH1'].points_y[0]
                 ch2 = self.curves['CH2'].points_y[0]
+                start = self.frame_start
             else:
-                ch1 = self.volts_per_lsb[ch1_range] * ch1_gain * (ch1_vals - ch1_zero)
-                ch2 = self.volts_per_lsb[ch2_range] * ch2_gain * (ch2_vals - ch2_zero)
+                ch1 = self.processor.scale(0, count, *ch1_cal)
+                ch2 = self.processor.scale(1, count, *ch2_cal)
+            self.frame_start = start
 
             if self.trigger_source == 'CH1':
                 ch = ch1
             else:
                 ch = ch2
-            if self.trigger_edge == 'Rising':
-                triggers = np.where(np.logical_and(ch[0:-1] <= self.trigger_level, ch[1:] > self.trigger_level))[0]
-            elif self.trigger_edge == 'Falling':
-                triggers = np.where(np.logical_and(ch[0:-1] >= self.trigger_level, ch[1:] < self.trigger_level))[0]
-            else:
-                triggers = np.array([], dtype = np.int64)
+            middle = (num_samples >> 1) - start
+            trigger = self.find_trigger(ch, middle, sampling_interval)
 
-            middle = len(ch) >> 1
-            if len(triggers) == 0:
+            if trigger is None:
                 self.triggered = False
                 zero = middle
                 offset = 0.
             else:
                 self.triggered = True
-                zero = triggers[np.argmin(abs(triggers - middle))]
-                offset = (self.trigger_level - ch[zero]) / (ch[zero + 1] - ch[zero])
+                [zero, offset] = trigger
 
             if self.trigger_source == 'CH1':
-                t1 = sampling_interval * (np.arange(num_samples) - zero - offset)
-                t2 = sampling_interval * (np.arange(num_samples) - zero - offset) + 0.125e-6
+                [t1, t2] = self.processor.times(len(ch1), sampling_interval, zero + offset, 0., 0.125e-6)
+            else:
+                [t1, t2] = self.processor.times(len(ch1), sampling_interval, zero + offset, -0.125e-6, 0.)
+
+            if self.host_acquire_mode == 'SAMP':
+                self.curves['CH1'].points_x = [t1]
+                self.curves['CH1'].points_y = [ch1]
+                self.curves['CH2'].points_x = [t2]
+                self.curves['CH2'].points_y = [ch2]
             else:
-                t2 = sampling_interval * (np.arange(num_samples) - zero - offset)
-                t1 = sampling_interval * (np.arange(num_samples) - zero - offset) - 0.125e-6
+                self.last_ch1 = ch1
+                self.last_ch2 = ch2
+                [ch1, ch2] = self.update_host_acquisition(ch1, ch2, zero, offset, held, sampling_interval, num_samples, [ch1_range, ch2_range, app.dev.num_avg])
 
-            self.curves['CH1'].points_x = [t1]
-            self.curves['CH1'].points_y = [ch1]
-            self.curves['CH2'].points_x = [t2]
-            self.curves['CH2'].points_y = [ch2]
+            self.update_math_channel()
+            if not held:
+                self.update_persistence()
 
             self.refresh_plot()
+            self.update_readouts(ch1, ch2)
+
+            self.update_job = Clock.schedule_once(self.update_scope_plot, 0.05)
+        except:
+            app.disconnect_from_oscope()
+
+    def update_host_acquisition(self, ch1, ch2, zero, offset, held, sampling_interval, num_samples, device_settings):
+        # Accumulate triggered frames into the running average or envelope 
+        # and show the result on a time grid centered on the trigger point.  
+        # Returns the traces the meter and XY plot should use.
+        settings = [sampling_interval, self.trigger_source, self.trigger_edge, self.trigger_level, self.trigger_type, self.trigger_holdoff, self.trigger_hysteresis] + device_settings
+        if settings != self.host_acquire_settings:
+            self.host_acquire_settings = settings
+            self.averager.reset()
+            self.envelope.reset()
+            self.equivalent_time.reset()
+
+        acquirer = {'AVG': self.averager, 'ENV': self.envelope, 'ET': self.equivalent_time}[self.host_acquire_mode]
+        if self.triggered and not held:
+            acquirer.add(ch1, ch2, zero, offset)
+        if acquirer.num_frames == 0:
+            return [ch1, ch2]
+
+        if self.host_acquire_mode == 'ET':
+            [times, values] = self.equivalent_time.samples()
+            times *= sampling_interval
+            visible = np.logical_and(times >= self.xlim[0] - sampling_interval, times <= self.xlim[1] + sampling_interval)
+            times = times[visible]
+            values = values[:, visible]
+            [skew1, skew2] = [0., 0.125e-6] if self.trigger_source == 'CH1' else [-0.125e-6, 0.]
+            self.curves['CH1'].points_x = [times + skew1]
+            self.curves['CH1'].points_y = [values[0]]
+            self.curves['CH2'].points_x = [times + skew2]
+            self.curves['CH2'].points_y = [values[1]]
+            return [ch1, ch2]
+
+        if self.trigger_source == 'CH1':
+            [t1, t2] = self.processor.times(num_samples, sampling_interval, num_samples >> 1, 0., 0.125e-6)
+        else:
+            [t1, t2] = self.processor.times(num_samples, sampling_interval, num_samples >> 1, -0.125e-6, 0.)
+
+        if self.host_acquire_mode == 'AVG':
+            [lo, hi, mean] = self.averager.average()
+            self.curves['CH1'].points_x = [t1[lo:hi]]
+            self.curves['CH1'].points_y = [mean[0]]
+            self.curves['CH2'].points_x = [t2[lo:hi]]
+            self.curves['CH2'].points_y = [mean[1]]
+            return [mean[0], mean[1]]
+        else:
+            [lo, hi, mins, maxs] = self.envelope.envelope()
+            self.curves['CH1'].points_x = [t1[lo:hi], t1[lo:hi]]
+            self.curves['CH1'].points_y = [mins[0], maxs[0]]
+            self.curves['CH2'].points_x = [t2[lo:hi], t2[lo:hi]]
+            self.curves['CH2'].points_y = [mins[1], maxs[1]]
+            return [ch1, ch2]
+
+    def set_host_acquire_mode(self, mode, depth = None):
+        if depth is not None:
+            self.averager.set_depth(depth)
+        self.host_acquire_mode = mode
+        self.host_acquire_settings = None
+        self.refresh_plot()
+
+    def increase_average_depth(self):
+        if self.host_acquire_mode != 'AVG':
+            self.set_host_acquire_mode('AVG', 2)
+        elif self.averager.depth < 1024:
+            self.set_host_acquire_mode('AVG', 2 * self.averager.depth)
 
-            if app.root.scope.meter_visible:
-                ch1_mean = float(np.sum(ch1)) / num_samples
-                ch2_mean = float(np.sum(ch2)) / num_samples
+    def decrease_average_depth(self):
+        if self.host_acquire_mode != 'AVG':
+            return
+        elif self.averager.depth > 2:
+            self.set_host_acquire_mode('AVG', self.averager.depth // 2)
+        else:
+            self.set_host_acquire_mode('SAMP')
 
-                ch1_rms = math.sqrt(float(np.sum((ch1 - ch1_mean) ** 2)) / num_samples)
-                ch2_rms = math.sqrt(float(np.sum((ch2 - ch2_mean) ** 2)) / num_samples)
+    def toggle_envelope(self):
+        self.set_host_acquire_mode('SAMP' if self.host_acquire_mode == 'ENV' else 'ENV')
 
-                theme = settings_manager.get_current_theme()
-                base_meter_text = '[b][color={}]{{}}V[/color]\n[color={}]{{}}V[/color][/b]'.format(theme['ch1_color'], theme['ch2_color'])
-                ch1_str = app.num2str(ch1_rms if app.root.scope.meter_ch1rms else ch1_mean, 4, positive_sign=True, trailing_zeros=True)
-                ch2_str = app.num2str(ch2_rms if app.root.scope.meter_ch2rms else ch2_mean, 4, positive_sign=True, trailing_zeros=True)
-                app.root.scope.meter_label.text = base_meter_text.format(ch1_str, ch2_str)
-                
+    def toggle_equivalent_time(self):
+        self.set_host_acquire_mode('SAMP' if self.host_acquire_mode == 'ET' else 'ET')
 
-            if app.root.scope.xyplot_visible:
-                if app.root.scope.scope_xyplot.ch1_vs_ch2:
-                    app.root.scope.scope_xyplot.curves['XY'].points_x = [ch2]
-                    app.root.scope.scope_xyplot.curves['XY'].points_y = [ch1]
-                else:
-                    app.root.scope.scope_xyplot.curves['XY'].points_x = [ch1]
-                    app.root.scope.scope_xyplot.curves['XY'].points_y = [ch2]
+    def cycle_equivalent_time_factor(self):
+        factors = (10, 20, 50)
+        factor = factors[(factors.index(self.equivalent_time.factor) + 1) % len(factors)] if self.equivalent_time.factor in factors else 20
+        self.equivalent_time.set_factor(factor)
+        self.refresh_plot()
+
+    def find_trigger(self, ch, middle, sampling_interval):
+        # Plain edge triggers, without hysteresis or holdoff, go through 
+        # the frame processor's search, which allocates nothing per frame; 
+        # the others through the trigger for the current settings.
+        if (self.trigger_type == 'Edge') and (self.trigger_hysteresis == 0.) and (self.trigger_holdoff == 0.):
+            return self.processor.find_trigger(ch, self.trigger_level, self.trigger_edge, middle)
+        return self.get_trigger().find(ch, middle, sampling_interval)
+
+    def get_trigger(self):
+        # Trigger for the current settings, built again only when one of 
+        # them changes.  The hysteresis is in volts and off by default.  
+        # Pulse width triggers use the time between the horizontal cursors 
+        # as the width limit, with the trigger edge selecting positive or 
+        # negative pulses; runt and window triggers use the trigger 
+        # channel's vertical cursors as thresholds.  The holdoff is a 
+        # multiple of the width of the view.
+        yaxis = self.yaxes[self.trigger_source]
+        settings = (self.trigger_type, self.trigger_source, self.trigger_edge, self.trigger_level, self.trigger_hysteresis, self.trigger_holdoff, self.h_cursor1, self.h_cursor2, yaxis.v_cursor1, yaxis.v_cursor2, self.xlim[0], self.xlim[1])
+        if settings == self.trigger_settings:
+            return self.trigger
+        hysteresis = self.trigger_hysteresis
+        polarity = 'Positive' if self.trigger_edge == 'Rising' else 'Negative'
+        [low, high] = sorted([yaxis.v_cursor1, yaxis.v_cursor2])
+        if self.trigger_type == 'Pulse<':
+            trigger = triggers.PulseWidthTrigger(self.trigger_level, polarity, '<', max_width = abs(self.h_cursor2 - self.h_cursor1), hysteresis = hysteresis)
+        elif self.trigger_type == 'Pulse>':
+            trigger = triggers.PulseWidthTrigger(self.trigger_level, polarity, '>', min_width = abs(self.h_cursor2 - self.h_cursor1), hysteresis = hysteresis)
+        elif self.trigger_type == 'Runt':
+            trigger = triggers.RuntTrigger(low, high, polarity, hysteresis)
+        elif self.trigger_type == 'Window':
+            trigger = triggers.WindowTrigger(low, high, 'Exit' if self.trigger_edge == 'Rising' else 'Enter', hysteresis)
+        else:
+            trigger = triggers.EdgeTrigger(self.trigger_level, self.trigger_edge, hysteresis)
+        if self.trigger_holdoff > 0.:
+            trigger = triggers.QualifiedTrigger(trigger, holdoff = self.trigger_holdoff * (self.xlim[1] - self.xlim[0]))
+        self.trigger = trigger
+        self.trigger_settings = settings
+        return trigger
+
+    def cycle_trigger_type(self):
+        types = self.trigger_types
+        self.trigger_type = types[(types.index(self.trigger_type) + 1) % len(types)]
+
+    def cycle_trigger_holdoff(self):
+        holdoffs = self.trigger_holdoffs
+        self.trigger_holdoff = holdoffs[(holdoffs.index(self.trigger_holdoff) + 1) % len(holdoffs)]
+
+    def cycle_trigger_hysteresis(self):
+        hystereses = self.trigger_hystereses
+        self.trigger_hysteresis = hystereses[(hystereses.index(self.trigger_hysteresis) + 1) % len(hystereses)]
+
+    def set_math_expression(self, text):
+        # Compile a math channel expression, or turn the math channel off 
+        # for an empty one.  Raises ValueError for an invalid expression, 
+        # leaving the current one in place.
+        if text.strip() == '':
+            self.math_expression = None
+            self.curves['MATH'].curve_style = ''
+            self.curves['MATH'].points_x = [np.array([])]
+            self.curves['MATH'].points_y = [np.array([])]
+            self.right_yaxis = ''
+        else:
+            self.math_expression = mathchannels.MathExpression(text)
+            self.curves['MATH'].curve_style = '-'
+            self.yaxes['MATH'].ylabel_value = self.math_expression.text
+            self.right_yaxis = 'MATH'
+            self.math_autoscale = True
+        self.refresh_plot()
+
+    def update_math_channel(self):
+        # Evaluate the math expression over each run of the displayed CH1 
+        # and CH2 traces, using the CH1 sample times for t.  Empty runs get 
+        # an empty math run, so that the runs line up with the CH1 ones, 
+        # as the waveform export expects.  The math axis is fitted to the 
+        # first result after the expression changes.
+        if self.math_expression is None:
+            return
+
+        points_x = []
+        points_y = []
+        for t, ch1, ch2 in zip(self.curves['CH1'].points_x, self.curves['CH1'].points_y, self.curves['CH2'].points_y):
+            n = min(len(t), len(ch1), len(ch2))
+            if n > 0:
+                points_x.append(t[:n])
+                points_y.append(self.math_expression.evaluate(ch1[:n], ch2[:n], t[:n]))
+            else:
+                points_x.append(np.array([]))
+                points_y.append(np.array([]))
+        self.curves['MATH'].points_x = points_x if points_x else [np.array([])]
+        self.curves['MATH'].points_y = points_y if points_y else [np.array([])]
+
+        if self.math_autoscale and any(len(y) > 0 for y in points_y):
+            self.math_autoscale = False
+            self.autoscale_math_axis()
+
+    def autoscale_math_axis(self):
+        finite = [y[np.isfinite(y)] for y in self.curves['MATH'].points_y]
+        finite = [y for y in finite if len(y) > 0]
+        if not finite:
+            return
+        lo = min(y.min() for y in finite)
+        hi = max(y.max() for y in finite)
+        if hi - lo <= 1e-12 * max(abs(lo), abs(hi), 1.):
+            [lo, hi] = [lo - 1., hi + 1.]
+        margin = 0.1 * (hi - lo)
+        self.yaxes['MATH'].ylim = [lo - margin, hi + margin]
+        self.refresh_plot()
+
+    def edit_math_expression(self):
+        content = BoxLayout(orientation = 'vertical', spacing = 10, padding = 10)
+        text_input = TextInput(text = '' if self.math_expression is None else self.math_expression.text, multiline = False, font_size = int(18 * app.fontscale))
+        message = Label(text = 'CH1, CH2, t, + - * / **, abs, sqrt, exp, log, log10, sin, cos, tan, sign, min, max, atan2, integ, deriv', font_size = int(14 * app.fontscale))
+        buttons = BoxLayout(spacing = 10)
+        cancel_button = Button(text = 'Cancel', font_size = int(16 * app.fontscale))
+        ok_button = Button(text = 'OK', font_size = int(16 * app.fontscale))
+        buttons.add_widget(cancel_button)
+        buttons.add_widget(ok_button)
+        content.add_widget(text_input)
+        content.add_widget(message)
+        content.add_widget(buttons)
+        popup = Popup(title = 'Math Channel (empty to turn off)', content = content, size_hint = (0.8, 0.4), auto_dismiss = False)
+
+        def on_ok(instance):
+            try:
+                self.set_math_expression(text_input.text)
+            except ValueError as e:
+                message.text = str(e)
+                return
+            popup.dismiss()
+
+        cancel_button.bind(on_release = lambda instance: popup.dismiss())
+        ok_button.bind(on_release = on_ok)
+        text_input.bind(on_text_validate = on_ok)
+        # the text input takes over the keyboard while the popup is open
+        popup.bind(on_dismiss = lambda instance: app.root.bind_keyboard())
+        popup.open()
+        text_input.focus = True
+
+    def update_persistence(self):
+        if self.persistence is None:
+            return
+
+        view = [int(self.axes_width), int(self.axes_height), list(self.xlim), list(self.yaxes['CH1'].ylim), list(self.yaxes['CH2'].ylim)]
+        if view != self.persistence_view:
+            self.persistence.resize(view[0], view[1])
+            self.persistence_view = view
+
+        traces = []
+        for index, name in enumerate(('CH1', 'CH2')):
+            curve = self.curves[name]
+            for px, py in zip(curve.points_x, curve.points_y):
+                traces.append((index, px, py, self.xlim, self.yaxes[name].ylim))
+        self.persistence.add_frame(traces)
+        self.image = self.persistence.render([get_color_from_hex(self.colors['ch1']), get_color_from_hex(self.colors['ch2'])])
+
+    def toggle_persistence(self):
+        if self.persistence is None:
+            self.persistence = persistence.PersistenceMap(2, self.persistence_decays[1])
+            self.persistence_view = None
+            self.curves['CH1'].curve_style = ''
+            self.curves['CH2'].curve_style = ''
+        else:
+            self.persistence = None
+            self.image = None
+            self.curves['CH1'].curve_style = '-'
+            self.curves['CH2'].curve_style = '-'
+        self.refresh_plot()
+
+    def cycle_persistence_decay(self):
+        if self.persistence is None:
+            return
+        decays = self.persistence_decays
+        decay = decays[(decays.index(self.persistence.decay) + 1) % len(decays)] if self.persistence.decay in decays else decays[1]
+        self.persistence.set_decay(decay)
+        self.persistence.reset()
+
+    def update_readouts(self, ch1, ch2):
+        if len(ch1) == 0:
+            return
+
+        if self.show_measurements:
+            sampling_interval = app.dev.sampling_interval
+            if sampling_interval != self.measurement_interval:
+                self.measurement_engine.reset()
+                self.measurement_interval = sampling_interval
+            self.measurement_engine.update(ch1, ch2, sampling_interval, 0.125e-6)
+
+        if app.root.scope.meter_visible:
+            [ch1_mean, ch1_rms] = self.processor.mean_rms(ch1)
+            [ch2_mean, ch2_rms] = self.processor.mean_rms(ch2)
+
+            theme = settings_manager.get_current_theme()
+            base_meter_text = '[b][color={}]{{}}V[/color]\n[color={}]{{}}V[/color][/b]'.format(theme['ch1_color'], theme['ch2_color'])
+            ch1_str = app.num2str(ch1_rms if app.root.scope.meter_ch1rms else ch1_mean, 4, positive_sign=True, trailing_zeros=True)
+            ch2_str = app.num2str(ch2_rms if app.root.scope.meter_ch2rms else ch2_mean, 4, positive_sign=True, trailing_zeros=True)
+            app.root.scope.meter_label.text = base_meter_text.format(ch1_str, ch2_str)
+            
+
+        if app.root.scope.xyplot_visible:
+            if app.root.scope.scope_xyplot.ch1_vs_ch2:
+                app.root.scope.scope_xyplot.curves['XY'].points_x = [ch2]
+                app.root.scope.scope_xyplot.curves['XY'].points_y = [ch1]
+            else:
+                app.root.scope.scope_xyplot.curves['XY'].points_x = [ch1]
+                app.root.scope.scope_xyplot.curves['XY'].points_y = [ch2]
+            if app.root.scope.spectrum_visible:
+                app.root.scope.spectrum_plot.update_spectrum(ch1, ch2, app.dev.sampling_interval)
+            else:
+                app.root.scope.scope_xyplot.update_persistence()
                 app.root.scope.scope_xyplot.refresh_plot()
 
-            self.update_job = Clock.schedule_once(self.update_scope_plot, 0.05)
-        except:
-            app.disconnect_from_oscope()
+    def update_roll_plot(self, sampling_interval, num_samples, ch1_cal, ch2_cal):
+        # Strip-chart display for slow timebases: each tick only the samples 
+        # acquired since the last tick are read and appended to a ring buffer 
+        # holding the most recent num_samples points, with the newest at t = 0.  
+        # Samples are timed from the start of their sweep.  The board stops 
+        # at the end of a sweep until the next one is triggered, so the 
+        # samples that would have come in between are missing; the trace 
+        # is broken at that gap rather than joined across it, and the next 
+        # tick is timed for the end of the sweep to keep the gap short.  
+        # Returns the delay until the next tick.
+        if (self.roll_pos is None) or (self.roll_interval != sampling_interval):
+            if self.roll_interval != sampling_interval:
+                self.roll_interval = sampling_interval
+                self.roll_ch1 = np.zeros(num_samples)
+                self.roll_ch2 = np.zeros(num_samples)
+                self.roll_t = np.zeros(num_samples)
+                self.roll_head = 0
+                self.roll_count = 0
+            self.start_roll_sweep()
+
+        # BUFFERBIN? latches how many samples are left in the sweep, which 
+        # SWEEP? then reports
+        app.dev.get_bufferbin(0, 1)
+        [self.sweep_in_progress, self.samples_left] = app.dev.get_sweep_progress()
+        acquired = num_samples - self.samples_left if self.sweep_in_progress == 1 else num_samples
+
+        if acquired > self.roll_pos:
+            [ch1_vals, ch2_vals] = app.dev.get_bufferbin_window(self.roll_pos, acquired - self.roll_pos)
+            self.roll_append(ch1_cal[0] * ch1_cal[1] * (np.array(ch1_vals) - ch1_cal[2]), 
+                             ch2_cal[0] * ch2_cal[1] * (np.array(ch2_vals) - ch2_cal[2]), 
+                             self.roll_sweep_start + sampling_interval * np.arange(self.roll_pos, acquired))
+            self.roll_pos = acquired
+
+        if self.sweep_in_progress != 1:
+            self.start_roll_sweep()
+            delay = 0.05
+        else:
+            delay = min(max(self.samples_left * sampling_interval, 0.005), 0.05)
+
+        order = (self.roll_head - self.roll_count + np.arange(self.roll_count)) % len(self.roll_ch1)
+        ch1 = self.roll_ch1[order]
+        ch2 = self.roll_ch2[order]
+        t1 = self.roll_t[order]
+        if len(t1) > 0:
+            t1 = t1 - t1[-1]
+        runs = np.flatnonzero(np.abs(np.diff(t1) - sampling_interval) > 0.5 * sampling_interval) + 1
+        self.triggered = False
+
+        self.curves['CH1'].points_x = np.split(t1, runs)
+        self.curves['CH1'].points_y = np.split(ch1, runs)
+        self.curves['CH2'].points_x = np.split(t1 + 0.125e-6, runs)
+        self.curves['CH2'].points_y = np.split(ch2, runs)
+        self.update_math_channel()
+
+        self.refresh_plot()
+        self.update_readouts(ch1, ch2)
+        return delay
+
+    def start_roll_sweep(self):
+        # The first sample of the sweep is taken when the board gets the 
+        # trigger, about halfway through the transaction, and never before 
+        # the last sample of the previous sweep.
+        start = time.monotonic()
+        app.dev.trigger_sweep()
+        self.roll_sweep_start = 0.5 * (start + time.monotonic())
+        if self.roll_count > 0:
+            latest = self.roll_t[(self.roll_head - 1) % len(self.roll_t)]
+            self.roll_sweep_start = max(self.roll_sweep_start, latest + 2. * self.roll_interval)
+        self.roll_pos = 0
+
+    def roll_append(self, ch1, ch2, t):
+        size = len(self.roll_ch1)
+        if len(ch1) > size:
+            ch1 = ch1[-size:]
+            ch2 = ch2[-size:]
+            t = t[-size:]
+        index = (self.roll_head + np.arange(len(ch1))) % size
+        self.roll_ch1[index] = ch1
+        self.roll_ch2[index] = ch2
+        self.roll_t[index] = t
+        self.roll_head = (self.roll_head + len(ch1)) % size
+        self.roll_count = min(self.roll_count + len(ch1), size)
+
+    def toggle_roll_mode(self):
+        self.roll_mode = not self.roll_mode
+        self.roll_pos = None
+        self.roll_interval = None
+        if self.roll_mode and app.dev.connected:
+            self.xlim = [-(app.dev.SCOPE_BUFFER_SIZE // 2 - 1) * app.dev.sampling_interval, 0.]
+            self.refresh_plot()
+
+    def get_view_window(self, sampling_interval, num_samples):
+        # Span of samples around the trigger point that xlim actually shows,
+        # or None when the whole record is needed (meter, XY plot and 
+        # measurements use all of it, the measurements so that they do not 
+        # change with horizontal zoom, an untriggered trace is positioned on 
+        # the buffer middle, 
+        # single captures are kept whole so that exports get every sample, 
+        # and qualified triggers need the pulses and holdoff around the 
+        # middle, not just a stretch as wide as the view).
+        if (not self.partial_transfers) or (not self.triggered) or (self.trigger_mode != 'Continuous'):
+            return None
+        if (self.trigger_type != 'Edge') or (self.trigger_holdoff > 0.):
+            return None
+        if app.root.scope.meter_visible or app.root.scope.xyplot_visible or self.show_measurements:
+            return None
+        lo = int(math.floor(self.xlim[0] / sampling_interval)) - 2
+        hi = int(math.ceil(self.xlim[1] / sampling_interval)) + 2
+        if (hi - lo) > num_samples // 3:
+            return None
+        return [lo, hi]
+
+    def read_frame(self, window, num_samples, trigger_index, trigger_cal):
+        # First read only a stretch of the trigger channel centered on the 
+        # buffer middle that is as wide as the view.  If a trigger lands in 
+        # it, it is the one nearest the middle, so only the samples spanning 
+        # that stretch and the view around the trigger are read from both 
+        # channels.  Otherwise fall back to reading the whole record.  The 
+        # raw samples end up in self.processor; returns the index of the 
+        # first sample read and the number of samples read per channel.
+        if window is not None:
+            [lo, hi] = window
+            middle = num_samples >> 1
+            width = max(hi, -lo, 16)
+            search_start = max(middle - width, 0)
+            search_stop = min(middle + width + 1, num_samples)
+            base = 0 if trigger_index == 0 else num_samples
+            count = self.processor.load_channel(trigger_index, app.dev.get_bufferbin_raw(base + search_start, search_stop - search_start), app.dev.num_avg)
+            ch = self.processor.scale(trigger_index, count, *trigger_cal, out = self.processor.work[:count])
+            trigger = self.find_trigger(ch, middle - search_start, app.dev.sampling_interval)
+            if trigger is not None:
+                trigger_pos = search_start + trigger[0]
+                start = max(min(search_start, trigger_pos + lo), 0)
+                stop = min(max(search_stop, trigger_pos + hi + 1), num_samples)
+                count = self.processor.load_channel(0, app.dev.get_bufferbin_raw(start, stop - start), app.dev.num_avg)
+                self.processor.load_channel(1, app.dev.get_bufferbin_raw(num_samples + start, stop - start), app.dev.num_avg)
+                return [start, count]
+
+        return [0, self.processor.load(app.dev.get_bufferbin_raw(), app.dev.num_avg)]
 
     def home_view(self):
         if not app.dev.connected:
@@ -984,6 +1526,55 @@ class ScopePlot(Plot):
         except:
             app.disconnect_from_oscope()
 
+    def start_autoset(self):
+        if not app.dev.connected:
+            return
+
+        try:
+            self.autoset = autoset.Autoset(app.dev)
+            self.autoset.start()
+            self.sampling_rate_display = 'AUTOSET...'
+            self.refresh_plot()
+        except:
+            app.disconnect_from_oscope()
+
+    def update_autoset(self):
+        # Advance the autoset search by one sweep and, once it is done, apply 
+        # the interval, ranges and trigger it found.  A single capture is 
+        # armed so that a stopped scope shows the signal with the new 
+        # settings too.
+        result = self.autoset.step()
+        if result is None:
+            return
+        self.autoset = None
+
+        app.dev.set_ch1range(result['ch1_range'])
+        app.dev.set_ch2range(result['ch2_range'])
+        self.set_sampling_interval(result['sampling_interval'])
+        self.xlim = [-result['view'], result['view']]
+        for name, ch_range in (('CH1', result['ch1_range']), ('CH2', result['ch2_range'])):
+            self.yaxes[name].ylim = [-2000. * self.volts_per_lsb[ch_range], 2000. * self.volts_per_lsb[ch_range]]
+
+        scope = app.root.scope
+        index = 0 if result['trigger_source'] == 'CH1' else 1
+        if index == 0:
+            scope.set_trigger_src_ch1()
+        else:
+            scope.set_trigger_src_ch2()
+        scope.trigger_src_button.index = index
+        scope.trigger_src_button.text = scope.trigger_src_button.texts[index]
+        scope.set_trigger_edge_rising()
+        scope.trigger_edge_button.index = 0
+        scope.trigger_edge_button.source = scope.trigger_edge_button.sources[0]
+        scope.trigger_edge_button.reload()
+        self.trigger_level = result['trigger_level']
+
+        if self.trigger_mode == 'Single':
+            self.trigger_mode = 'Armed'
+            scope.play_pause_button.source = kivy_resources.resource_find('stop.png')
+            scope.play_pause_button.reload()
+        self.refresh_plot()
+
     def decrease_sampling_interval(self):
         if app.dev.connected:
             interval = app.dev.sampling_interval
@@ -1281,6 +1872,50 @@ class ScopePlot(Plot):
             app.root.scope.trigger_edge_button.index = 1
             app.root.scope.trigger_edge_button.source = app.root.scope.trigger_edge_button.sources[1]
             app.root.scope.trigger_edge_button.reload()
+        elif key == 'o':
+            self.toggle_roll_mode()
+        elif key == 'v':
+            if 'shift' in modifiers:
+                self.decrease_average_depth()
+            else:
+                self.increase_average_depth()
+        elif key == 'e':
+            if 'shift' in modifiers:
+                self.host_acquire_settings = None
+            else:
+                self.toggle_envelope()
+        elif key == 't':
+            if 'shift' in modifiers:
+                self.cycle_equivalent_time_factor()
+            else:
+                self.toggle_equivalent_time()
+        elif key == 'p':
+            if 'shift' in modifiers:
+                self.cycle_persistence_decay()
+            else:
+                self.toggle_persistence()
+        elif key == 's':
+            if self.autoset is None:
+                self.start_autoset()
+        elif key == 'n':
+            if 'shift' in modifiers:
+                self.autoscale_math_axis()
+            else:
+                self.edit_math_expression()
+        elif key == 'u':
+            if 'shift' in modifiers:
+                self.cycle_trigger_holdoff()
+            else:
+                self.cycle_trigger_type()
+        elif key == 'b':
+            self.cycle_trigger_hysteresis()
+        elif key == 'm':
+            if 'shift' in modifiers:
+                self.measurement_engine.reset()
+            else:
+                self.show_measurements = not self.show_measurements
+                self.measurement_engine.reset()
+            self.refresh_plot()
         elif key == 'x':
             app.root.scope.toggle_h_cursors()
             app.root.scope.h_cursors_button.state = 'down' if app.root.scope.h_cursors_button.state == 'normal' else 'normal'
@@ -1402,6 +2037,10 @@ class ScopeXYPlot(Plot):
         self.yaxes['left'].v_cursor2 = 0.
 
         self.left_yaxis = 'left'
+
+        self.persistence = None
+        self.persistence_view = None
+        self.persistence_decays = (0.5, 0.8, 0.95, 1.)
         
         # Add XY color (blend of CH1/CH2) to colors dict
         self.colors['xy'] = theme['phase_color']  # Use phase color (magenta-ish) for XY
@@ -1504,6 +2143,39 @@ class ScopeXYPlot(Plot):
         self.show_v_cursors = not self.show_v_cursors
         self.refresh_plot()
 
+    def update_persistence(self):
+        if self.persistence is None:
+            return
+
+        yaxis = self.yaxes[self.left_yaxis]
+        view = [int(self.axes_width), int(self.axes_height), list(self.xlim), list(yaxis.ylim), self.ch1_vs_ch2]
+        if view != self.persistence_view:
+            self.persistence.resize(view[0], view[1])
+            self.persistence_view = view
+
+        curve = self.curves['XY']
+        self.persistence.add_frame([(0, px, py, self.xlim, yaxis.ylim) for px, py in zip(curve.points_x, curve.points_y)])
+        self.image = self.persistence.render([get_color_from_hex(self.colors['xy'])])
+
+    def toggle_persistence(self):
+        if self.persistence is None:
+            self.persistence = persistence.PersistenceMap(1, self.persistence_decays[1])
+            self.persistence_view = None
+            self.curves['XY'].curve_style = ''
+        else:
+            self.persistence = None
+            self.image = None
+            self.curves['XY'].curve_style = '-'
+        self.refresh_plot()
+
+    def cycle_persistence_decay(self):
+        if self.persistence is None:
+            return
+        decays = self.persistence_decays
+        decay = decays[(decays.index(self.persistence.decay) + 1) % len(decays)] if self.persistence.decay in decays else decays[1]
+        self.persistence.set_decay(decay)
+        self.persistence.reset()
+
     def swap_axes(self):
         self.ch1_vs_ch2 = not self.ch1_vs_ch2
         theme = settings_manager.get_current_theme()
@@ -1531,7 +2203,7 @@ class ScopeXYPlot(Plot):
         self.looking_for_gesture = True
 
     def on_touch_down(self, touch):
-        if not app.root.scope.xyplot_visible:
+        if (not app.root.scope.xyplot_visible) or app.root.scope.spectrum_visible:
             return
 
         if app.root.scope.wavegen_visible or app.root.scope.digital_controls_visible or app.root.scope.offset_waveform_visible:
@@ -1574,7 +2246,7 @@ class ScopeXYPlot(Plot):
                 self.dragging_v_zero_point = True
 
     def on_touch_move(self, touch):
-        if not app.root.scope.xyplot_visible:
+        if (not app.root.scope.xyplot_visible) or app.root.scope.spectrum_visible:
             return
 
         if app.root.scope.wavegen_visible or app.root.scope.digital_controls_visible or app.root.scope.offset_waveform_visible:
@@ -1618,7 +2290,7 @@ class ScopeXYPlot(Plot):
         self.touch_positions[i] = touch.pos
 
     def on_touch_up(self, touch):
-        if not app.root.scope.xyplot_visible:
+        if (not app.root.scope.xyplot_visible) or app.root.scope.spectrum_visible:
             return
 
         if app.root.scope.wavegen_visible or app.root.scope.digital_controls_visible or app.root.scope.offset_waveform_visible:
@@ -1722,6 +2394,209 @@ class ScopeXYPlot(Plot):
         elif key == 'i':
             app.root.scope.xy_h_cursors_button.state, app.root.scope.xy_v_cursors_button.state = app.root.scope.xy_v_cursors_button.state, app.root.scope.xy_h_cursors_button.state
             self.swap_axes()
+        elif key == 'f':
+            app.root.scope.spectrum_button.state = 'down'
+            app.root.scope.toggle_spectrum()
+        elif key == 'p':
+            if 'shift' in modifiers:
+                self.cycle_persistence_decay()
+            else:
+                self.toggle_persistence()
+
+class SpectrumPlot(Plot):
+
+    def __init__(self, **kwargs):
+        super(SpectrumPlot, self).__init__(**kwargs)
+
+        self.grid_state = 'on'
+
+        self.default_color_order = ('c', 'm', 'y', 'b', 'g', 'r')
+        self.default_marker = ''
+
+        self.worker = spectrum.SpectrumWorker()
+        self.worker.start()
+        self.analyzer = self.worker.analyzer
+        self.averaging_displays = {'None': '', 'Linear': 'LIN', 'Exponential': 'EXP'}
+        self.measurements = []
+        self.nyquist = None
+
+        # Get theme colors
+        theme = settings_manager.get_current_theme()
+
+        self.colors['ch1'] = theme['ch1_color']
+        self.colors['ch2'] = theme['ch2_color']
+
+        self.xaxis_color = ''
+        self.xaxis_mode = 'log'
+        self.xlimits_mode = 'manual'
+        self.xlim = [2., 6.]
+        self.xmin = 2.
+        self.xmax = 6.
+        self.xlabel_value = 'Frequency (Hz)'
+
+        self.yaxes['left'].color = theme['axes_color']
+        self.yaxes['left'].yaxis_mode = 'linear'
+        self.yaxes['left'].ylimits_mode = 'manual'
+        self.yaxes['left'].ylim = [-100., 20.]
+        self.yaxes['left'].ymin = -100.
+        self.yaxes['left'].ymax = 20.
+        self.yaxes['left'].ylabel_value = 'Level (dBV)'
+
+        self.left_yaxis = 'left'
+
+        self.curves['CH1'] = self.curve(name = 'CH1', yaxis = 'left', curve_color = 'ch1', curve_style = '-')
+        self.curves['CH2'] = self.curve(name = 'CH2', yaxis = 'left', curve_color = 'ch2', curve_style = '-')
+
+        self.configure(background = theme['plot_background'], axes_background = theme['axes_background'], 
+                       axes_color = theme['axes_color'], grid_color = theme['grid_color'], 
+                       fontsize = int(18 * app.fontscale), font = app.fontname, linear_minor_ticks = 'on')
+
+        self.refresh_plot()
+
+    def draw_plot(self):
+        super(SpectrumPlot, self).draw_plot()
+        self.draw_readouts()
+
+    def draw_readouts(self):
+        y = self.axes_top - 0.5 * self.label_fontsize
+        for name, measurement in zip(('CH1', 'CH2'), self.measurements):
+            if measurement is None:
+                continue
+            readout = '{}: {}Hz, {}dBV, THD {}%'.format(name, app.num2str(measurement['frequency'], 4), app.num2str(measurement['level'], 3), app.num2str(measurement['thd'], 3))
+            self.add_text(text = readout, anchor_pos = [self.axes_left + 0.5 * self.label_fontsize, y], anchor = 'nw', color = self.colors[name.lower()], font_size = self.label_fontsize)
+            y -= 1.5 * self.label_fontsize
+
+        settings_display = self.analyzer.window
+        if self.analyzer.averaging != 'None':
+            settings_display += ', {}{:d}'.format(self.averaging_displays[self.analyzer.averaging], self.analyzer.num_averages)
+        self.add_text(text = settings_display, anchor_pos = [self.axes_right, self.axes_bottom - 3.5 * self.label_fontsize], anchor = 'se', color = self.axes_color, font_size = self.label_fontsize)
+
+    def update_spectrum(self, ch1, ch2, sampling_interval):
+        if (len(ch1) < 16) or (len(ch1) != len(ch2)):
+            return
+
+        self.worker.submit([ch1, ch2], sampling_interval)
+
+        result = self.worker.latest()
+        if result is None:
+            return
+        [freqs, log_freqs, levels, self.measurements] = result
+
+        self.curves['CH1'].points_x = [log_freqs]
+        self.curves['CH1'].points_y = [levels[0][1:]]
+        self.curves['CH2'].points_x = [log_freqs]
+        self.curves['CH2'].points_y = [levels[1][1:]]
+
+        if freqs[-1] != self.nyquist:
+            self.nyquist = freqs[-1]
+            self.xlim = [log_freqs[0], log_freqs[-1]]
+        self.refresh_plot()
+
+    def home_view(self):
+        if self.nyquist is not None:
+            self.xlim = [self.curves['CH1'].points_x[0][0], math.log10(self.nyquist)]
+        self.yaxes['left'].ylim = [-100., 20.]
+        self.refresh_plot()
+
+    def cycle_window(self):
+        windows = spectrum.WINDOWS
+        self.analyzer.window = windows[(windows.index(self.analyzer.window) + 1) % len(windows)]
+        self.worker.reset()
+        self.refresh_plot()
+
+    def cycle_averaging(self):
+        modes = spectrum.AVERAGING_MODES
+        self.analyzer.averaging = modes[(modes.index(self.analyzer.averaging) + 1) % len(modes)]
+        self.worker.reset()
+        self.refresh_plot()
+
+    def on_touch_down(self, touch):
+        if not (app.root.scope.xyplot_visible and app.root.scope.spectrum_visible):
+            return
+
+        if app.root.scope.wavegen_visible or app.root.scope.digital_controls_visible or app.root.scope.offset_waveform_visible:
+            return
+
+        if touch.pos[0] > 0.9 * 0.6 * Window.size[0]:
+            return
+
+        super(SpectrumPlot, self).on_touch_down(touch)
+
+    def on_touch_move(self, touch):
+        if not (app.root.scope.xyplot_visible and app.root.scope.spectrum_visible):
+            return
+
+        super(SpectrumPlot, self).on_touch_move(touch)
+
+    def on_touch_up(self, touch):
+        if not (app.root.scope.xyplot_visible and app.root.scope.spectrum_visible):
+            return
+
+        if self.num_touches > 0:
+            super(SpectrumPlot, self).on_touch_up(touch)
+
+    def on_keyboard_down(self, keyboard, keycode, text, modifiers):
+        code, key = keycode
+
+        if key == 'up' or key == 'k':
+            if 'shift' in modifiers:
+                self.pan_up(fraction = 1. / self.axes_height)
+            elif 'ctrl' in modifiers:
+                self.pan_up(fraction = 0.5)
+            else:
+                self.pan_up()
+        elif key == 'down' or key == 'j':
+            if 'shift' in modifiers:
+                self.pan_down(fraction = 1. / self.axes_height)
+            elif 'ctrl' in modifiers:
+                self.pan_down(fraction = 0.5)
+            else:
+                self.pan_down()
+        elif key == 'left' or key == 'h':
+            if 'shift' in modifiers:
+                self.pan_left(fraction = 1. / self.axes_width)
+            elif 'ctrl' in modifiers:
+                self.pan_left(fraction = 0.5)
+            else:
+                self.pan_left()
+        elif key == 'right' or key == 'l':
+            if 'shift' in modifiers:
+                self.pan_right(fraction = 1. / self.axes_width)
+            elif 'ctrl' in modifiers:
+                self.pan_right(fraction = 0.5)
+            else:
+                self.pan_right()
+        elif key == '=':
+            if 'shift' in modifiers:
+                self.zoom_in(factor = math.sqrt(math.sqrt(2.)))
+            elif 'ctrl' in modifiers:
+                self.zoom_in(factor = 2.)
+            else:
+                self.zoom_in()
+        elif key == '-':
+            if 'shift' in modifiers:
+                self.zoom_out(factor = math.sqrt(math.sqrt(2.)))
+            elif 'ctrl' in modifiers:
+                self.zoom_out(factor = 2.)
+            else:
+                self.zoom_out()
+        elif key == 'g':
+            if self.grid() == 'off':
+                self.grid('on')
+            else:
+                self.grid('off')
+        elif key == 'spacebar':
+            self.home_view()
+        elif key == 'w':
+            self.cycle_window()
+        elif key == 'a':
+            if 'shift' in modifiers:
+                self.worker.reset()
+            else:
+                self.cycle_averaging()
+        elif key == 'f':
+            app.root.scope.spectrum_button.state = 'normal'
+            app.root.scope.toggle_spectrum()
 
 class WavegenPlot(Plot):
 
@@ -1753,6 +2628,7 @@ class WavegenPlot(Plot):
         self.MAX_OFFSET = 5.
 
         self.num_points = 401
+        self.preview = wavepreview.PreviewRenderer(num_points = self.num_points, lo = self.MIN_OFFSET, hi = self.MAX_OFFSET)
 
         self.xaxis_mode = 'linear'
         self.xlimits_mode = 'manual'
@@ -1828,48 +2704,18 @@ class WavegenPlot(Plot):
             self.canvas.add(Line(ellipse = [x - 3. * r, y - 3. * r, 6. * r, 6. * r], width = self.curve_lineweight))
 
     def generate_preview(self):
-        t = np.linspace(self.xlim[0], self.xlim[1], self.num_points)
-
-        if self.shape == 'DC':
-            v = self.offset * np.ones(self.num_points)
-        elif self.shape == 'SIN':
-            v = self.offset + self.amplitude * np.sin(2. * math.pi * self.frequency * t)
-        elif self.shape == 'SQUARE':
-            v = self.offset + self.amplitude * np.sign(np.sin(2. * math.pi * self.frequency * t))
-        elif self.shape == 'TRIANGLE':
-            v = self.offset + self.amplitude * 2. * np.arcsin(np.sin(2. * math.pi * self.frequency * t)) / math.pi
-        else:
-            raise ValueError("waveform shape must be 'DC', 'SIN', 'SQUARE', or 'TRIANGLE'")
-
-        where_over = np.where(v > self.MAX_OFFSET)[0]
-        v[where_over] = self.MAX_OFFSET
-        where_under = np.where(v < self.MIN_OFFSET)[0]
-        v[where_under] = self.MIN_OFFSET
-
-        self.curves['WG'] = self.curve(name = 'WG', curve_color = 'waveform', curve_style = '-', points_x = [t], points_y = [v])
-        if self.shape == 'DC':
-            self.yaxes['left'].ylabel_value = 'WG: DC, offset = {}V'.format(app.num2str(self.offset, 4))
-        else:
-            self.yaxes['left'].ylabel_value = 'WG: {}, freq = {}Hz, amp = {}V, offset = {}V'.format(self.shape, app.num2str(self.frequency, 4), app.num2str(self.amplitude, 4), app.num2str(self.offset, 4))
+        self.curves['WG'] = self.curve(name = 'WG', curve_color = 'waveform', curve_style = '-')
+        self.update_preview()
 
     def update_preview(self):
-        t = np.linspace(self.xlim[0], self.xlim[1], self.num_points)
-
-        if self.shape == 'DC':
-            v = self.offset * np.ones(self.num_points)
-        elif self.shape == 'SIN':
-            v = self.offset + self.amplitude * np.sin(2. * math.pi * self.frequency * t)
-        elif self.shape == 'SQUARE':
-            v = self.offset + self.amplitude * np.sign(np.sin(2. * math.pi * self.frequency * t))
-        elif self.shape == 'TRIANGLE':
-            v = self.offset + self.amplitude * 2. * np.arcsin(np.sin(2. * math.pi * self.frequency * t)) / math.pi
-        else:
+        if self.shape not in wavepreview.SHAPES:
             raise ValueError("waveform shape must be 'DC', 'SIN', 'SQUARE', or 'TRIANGLE'")
 
-        where_over = np.where(v > self.MAX_OFFSET)[0]
-        v[where_over] = self.MAX_OFFSET
-        where_under = np.where(v < self.MIN_OFFSET)[0]
-        v[where_under] = self.MIN_OFFSET
+        # The renderer keeps the unit shape at the preview's sample times and
+        # only resamples it when the shape, frequency, or time span changes,
+        # so dragging the amplitude or offset is a scale, shift, and clip
+        # into the same buffer.
+        [t, v] = self.preview.render(self.shape, self.xlim[0], self.xlim[1], self.frequency, self.amplitude, self.offset)
 
         self.curves['WG'].points_x = [t]
         self.curves['WG'].points_y = [v]
@@ -2097,6 +2943,12 @@ class WavegenPlot(Plot):
         if self.looking_for_gesture:
             self.looking_for_gesture = False
 
+        if self.dragging_offset_control_pt or self.dragging_amp_control_pt or self.dragging_amp_control_pt_h_xor_v:
+            # send the value that the drag ended on without waiting
+            app.flush_writes()
+            self.update_preview()
+            self.refresh_plot()
+
         if self.dragging_offset_control_pt:
             self.dragging_offset_control_pt = False
 
@@ -2227,6 +3079,26 @@ class OffsetWaveformPlot(Plot):
         self.refresh_plot()
 
     def on_oscope_disconnect(self):
+        self.clear_waveform()
+
+    def show_waveform(self, samples, offset_interval, title = 'Offset Waveform'):
+        # Plot samples, in volts, taken offset_interval apart.
+        num_samples = len(samples)
+        self.offset_interval = offset_interval
+        if num_samples == 0:
+            self.clear_waveform()
+            return
+
+        self.num_samples = num_samples
+        self.curves['OffsetWaveform'].points_x = [offset_interval * np.arange(num_samples)]
+        self.curves['OffsetWaveform'].points_y = [np.array(samples)]
+
+        self.yaxes['left'].ylabel_value = f'{title}: {num_samples:d} points, interval = {app.num2str(offset_interval, 4)}s'
+        self.xlim = [0., offset_interval * num_samples]
+
+        self.refresh_plot()
+
+    def clear_waveform(self):
         self.num_samples = 0
 
         self.xlim = [0., 1.]
@@ -2335,6 +3207,120 @@ class OffsetWaveformPlot(Plot):
         elif key == 'spacebar':
             self.home_view()
 
+class LogicTimelinePlot(Plot):
+    """Stacked traces of the digital inputs recorded in a logictimeline.LogicTimeline, D0 on top."""
+
+    def __init__(self, timeline, **kwargs):
+        super(LogicTimelinePlot, self).__init__(**kwargs)
+
+        self.timeline = timeline
+        # follow the latest polls over the last FOLLOW_SPAN seconds until the 
+        # view is panned or zoomed
+        self.following = True
+        self.follow_xlim = None
+        self.FOLLOW_SPAN = 60.
+
+        self.grid_state = 'on'
+
+        self.default_color_order = ('c', 'm', 'y', 'b', 'g', 'r')
+        self.default_marker = ''
+
+        self.xaxis_color = ''
+        self.xaxis_units = 's'
+        self.xaxis_mode = 'linear'
+        self.xlimits_mode = 'manual'
+        self.xlim = [0., self.FOLLOW_SPAN]
+        self.xmin = 0.
+        self.xmax = self.FOLLOW_SPAN
+        self.xlabel_value = ''
+
+        theme = settings_manager.get_current_theme()
+
+        self.yaxes['left'].color = theme['axes_color']
+        self.yaxes['left'].units = ''
+        self.yaxes['left'].yaxis_mode = 'linear'
+        self.yaxes['left'].ylimits_mode = 'manual'
+        self.yaxes['left'].ylim = [-0.25, 5.75]
+        self.yaxes['left'].ymin = -0.25
+        self.yaxes['left'].ymax = 5.75
+
+        self.left_yaxis = 'left'
+
+        for pin in range(logictimeline.NUM_PINS):
+            self.curves[f'D{pin:d}'] = self.curve(name = f'D{pin:d}', yaxis = 'left', curve_color = self.default_color_order[pin], curve_style = '-')
+
+        self.configure(background = theme['plot_background'], axes_background = theme['axes_background'], 
+                       axes_color = theme['axes_color'], grid_color = theme['grid_color'], 
+                       fontsize = int(18 * app.fontscale), font = app.fontname, linear_minor_ticks = 'on')
+
+        self.refresh_plot()
+
+    def trace_base(self, pin):
+        return 1.5 * (logictimeline.NUM_PINS - 1 - pin)
+
+    def load_traces(self):
+        # Only the part of the timeline in view is turned into points, so 
+        # the traces are reloaded whenever the view changes.
+        timeline = self.timeline
+        duration = timeline.end - timeline.start if len(timeline) != 0 else 0.
+
+        if self.xlimits_mode == 'auto':
+            # double tap: the whole timeline
+            self.xlimits_mode = 'manual'
+            self.xlim = [0., max(duration, 1e-3)]
+            self.yaxes['left'].ylimits_mode = 'manual'
+            self.yaxes['left'].ylim = [-0.25, 5.75]
+            self.following = False
+        elif self.following and (self.follow_xlim is not None) and (self.xlim != self.follow_xlim):
+            self.following = False
+
+        if self.following:
+            self.xlim = [max(duration - self.FOLLOW_SPAN, 0.), max(duration, self.FOLLOW_SPAN)]
+            self.follow_xlim = list(self.xlim)
+
+        for pin in range(logictimeline.NUM_PINS):
+            [points_x, points_y] = timeline.trace(pin, self.xlim[0], self.xlim[1], base = self.trace_base(pin))
+            self.curves[f'D{pin:d}'].points_x = points_x if points_x else [np.array([])]
+            self.curves[f'D{pin:d}'].points_y = points_y if points_y else [np.array([])]
+
+        if len(timeline) == 0:
+            self.yaxes['left'].ylabel_value = 'Digital inputs: nothing recorded; set a pin to IN'
+        else:
+            self.yaxes['left'].ylabel_value = f'Digital inputs: {len(timeline):d} changes over {app.num2str(duration, 4)}s'
+
+    def refresh_plot(self):
+        self.load_traces()
+        super(LogicTimelinePlot, self).refresh_plot()
+
+    def follow(self):
+        self.following = True
+        self.follow_xlim = None
+        self.yaxes['left'].ylim = [-0.25, 5.75]
+        self.refresh_plot()
+
+    def draw_plot(self):
+        super(LogicTimelinePlot, self).draw_plot()
+        for pin in range(logictimeline.NUM_PINS):
+            y = self.to_canvas_y(self.trace_base(pin) + 0.5, 'left')
+            if (y > self.axes_bottom) and (y < self.axes_top):
+                self.add_text(text = f'D{pin:d}', anchor_pos = [self.axes_left + 0.5 * self.label_fontsize, y], anchor = 'w', color = self.colors[self.default_color_order[pin]], font_size = self.label_fontsize)
+
+    def on_touch_down(self, touch):
+        # the plot lives in a popup with buttons below it
+        if not self.collide_point(*touch.pos):
+            return
+
+        touch.ud['logic_timeline_plot'] = True
+        super(LogicTimelinePlot, self).on_touch_down(touch)
+
+    def on_touch_move(self, touch):
+        if touch.ud.get('logic_timeline_plot'):
+            super(LogicTimelinePlot, self).on_touch_move(touch)
+
+    def on_touch_up(self, touch):
+        if touch.ud.get('logic_timeline_plot'):
+            super(LogicTimelinePlot, self).on_touch_up(touch)
+
 class BodePlot(Plot):
 
     def __init__(self, **kwargs):
@@ -2473,17 +3459,23 @@ class DigitalControlPanel(BoxLayout):
     def __init__(self, **kwargs):
         super(DigitalControlPanel, self).__init__(**kwargs)
         self.update_job = None
+        self.input_poller = digitalpoller.DigitalPoller(app.dev)
+        # every change of the inputs since the app started
+        self.logic_timeline = logictimeline.LogicTimeline()
+        self.input_poller.listeners.append(self.logic_timeline.record)
 
     def on_oscope_disconnect(self):
         if self.update_job is not None:
             self.update_job.cancel()
             self.update_job = None
+        self.input_poller.set_pins([])
 
     def sync_controls(self):
         if not app.dev.connected:
             return
 
         try:
+            app.flush_writes()
             led_button_vals = ('normal', 'down')
             self.led_one_button.state = led_button_vals[app.dev.get_led1()]
             self.led_two_button.state = led_button_vals[app.dev.get_led2()]
@@ -2525,42 +3517,71 @@ class DigitalControlPanel(BoxLayout):
         if not app.dev.connected:
             return
 
-        try:
-            at_least_one_input = False
-
-            if self.d_zero_mode_spinner.text == 'IN':
-                at_least_one_input = True
-                if app.dev.dig_read(0) == 1:
-                    self.d_zero_button.state = 'down'
-                else:
-                    self.d_zero_button.state = 'normal'
-
-            if self.d_one_mode_spinner.text == 'IN':
-                at_least_one_input = True
-                if app.dev.dig_read(1) == 1:
-                    self.d_one_button.state = 'down'
-                else:
-                    self.d_one_button.state = 'normal'
+        buttons = (self.d_zero_button, self.d_one_button, self.d_two_button, self.d_three_button)
+        spinners = (self.d_zero_mode_spinner, self.d_one_mode_spinner, self.d_two_mode_spinner, self.d_three_mode_spinner)
+        pins = [pin for pin in range(4) if spinners[pin].text == 'IN']
+        if not pins:
+            self.input_poller.set_pins([])
+            self.update_job = None
+            return
 
-            if self.d_two_mode_spinner.text == 'IN':
-                at_least_one_input = True
-                if app.dev.dig_read(2) == 1:
-                    self.d_two_button.state = 'down'
-                else:
-                    self.d_two_button.state = 'normal'
+        # leave the link to an offset waveform upload until it is done
+        if app.offset_upload is not None:
+            self.update_job = Clock.schedule_once(self.update_button_displays, 0.1)
+            return
 
-            if self.d_three_mode_spinner.text == 'IN':
-                at_least_one_input = True
-                if app.dev.dig_read(3) == 1:
-                    self.d_three_button.state = 'down'
+        try:
+            # one transaction for all of the inputs
+            self.input_poller.set_pins(pins)
+            self.input_poller.poll()
+            for pin in pins:
+                if self.input_poller.states[pin] == 1:
+                    buttons[pin].state = 'down'
                 else:
-                    self.d_three_button.state = 'normal'
+                    buttons[pin].state = 'normal'
 
-            if at_least_one_input:
-                self.update_job = Clock.schedule_once(self.update_button_displays, 0.05)
+            self.update_job = Clock.schedule_once(self.update_button_displays, 0.05)
         except:
             app.disconnect_from_oscope()
 
+    def show_logic_timeline(self):
+        content = BoxLayout(orientation = 'vertical', spacing = 10, padding = 10)
+        plot = LogicTimelinePlot(self.logic_timeline)
+        buttons = BoxLayout(spacing = 10, size_hint_y = None, height = int(40 * app.fontscale))
+        pan_left_button = Button(text = '<', font_size = int(16 * app.fontscale))
+        zoom_in_button = Button(text = 'Zoom In', font_size = int(16 * app.fontscale))
+        zoom_out_button = Button(text = 'Zoom Out', font_size = int(16 * app.fontscale))
+        pan_right_button = Button(text = '>', font_size = int(16 * app.fontscale))
+        live_button = Button(text = 'Live', font_size = int(16 * app.fontscale))
+        clear_button = Button(text = 'Clear', font_size = int(16 * app.fontscale))
+        save_button = Button(text = 'Save VCD', font_size = int(16 * app.fontscale))
+        close_button = Button(text = 'Close', font_size = int(16 * app.fontscale))
+        for button in (pan_left_button, zoom_in_button, zoom_out_button, pan_right_button, live_button, clear_button, save_button, close_button):
+            buttons.add_widget(button)
+        content.add_widget(plot)
+        content.add_widget(buttons)
+        popup = Popup(title = 'Logic Timeline', content = content, size_hint = (0.9, 0.8), auto_dismiss = False)
+
+        def clear(instance):
+            self.logic_timeline.clear()
+            # the next poll starts the new timeline from the current levels
+            self.input_poller.set_pins([])
+            plot.follow()
+
+        # new polls scroll into view while the plot is following them
+        refresh_job = Clock.schedule_interval(lambda t: plot.refresh_plot() if plot.following else None, 0.5)
+
+        pan_left_button.bind(on_release = lambda instance: plot.pan_left())
+        zoom_in_button.bind(on_release = lambda instance: plot.zoom_in_x())
+        zoom_out_button.bind(on_release = lambda instance: plot.zoom_out_x())
+        pan_right_button.bind(on_release = lambda instance: plot.pan_right())
+        live_button.bind(on_release = lambda instance: plot.follow())
+        clear_button.bind(on_release = clear)
+        save_button.bind(on_release = lambda instance: app.open_save_logic_dialog())
+        close_button.bind(on_release = lambda instance: popup.dismiss())
+        popup.bind(on_dismiss = lambda instance: refresh_job.cancel())
+        popup.open()
+
     def led1_callback(self):
         try:
             if self.led_one_button.state == 'down':
@@ -2589,10 +3610,7 @@ class DigitalControlPanel(BoxLayout):
             app.disconnect_from_oscope()
 
     def servo_period_callback(self):
-        try:
-            app.dev.dig_set_period(self.servo_period_slider.value)
-        except:
-            app.disconnect_from_oscope()
+        app.queue_write('DIG:PERIOD', app.dev.dig_set_period, self.servo_period_slider.value)
 
     def d0_button_callback(self):
         try:
@@ -2606,6 +3624,7 @@ class DigitalControlPanel(BoxLayout):
 
     def d0_mode_callback(self):
         try:
+            app.flush_writes()
             if self.d_zero_mode_spinner.text == 'OUT':
                 app.dev.dig_set_mode(0, 0)
                 self.d_zero_button.disabled = False
@@ -2679,19 +3698,13 @@ class DigitalControlPanel(BoxLayout):
             app.disconnect_from_oscope()
 
     def d0_freq_callback(self):
-        try:
-            app.dev.dig_set_freq(0, self.d_zero_freq_slider.value)
-        except:
-            app.disconnect_from_oscope()
+        app.queue_write('DIG0:FREQ', app.dev.dig_set_freq, 0, self.d_zero_freq_slider.value)
 
     def d0_duty_callback(self):
-        try:
-            if self.d_zero_mode_spinner.text == 'PWM':
-                app.dev.dig_set_duty(0, self.d_zero_duty_slider.value / 100.)
-            elif self.d_zero_mode_spinner.text == 'SERVO':
-                app.dev.dig_set_width(0, self.d_zero_duty_slider.value)
-        except:
-            app.disconnect_from_oscope()
+        if self.d_zero_mode_spinner.text == 'PWM':
+            app.queue_write('DIG0:DUTY', app.dev.dig_set_duty, 0, self.d_zero_duty_slider.value / 100.)
+        elif self.d_zero_mode_spinner.text == 'SERVO':
+            app.queue_write('DIG0:DUTY', app.dev.dig_set_width, 0, self.d_zero_duty_slider.value)
 
     def d1_button_callback(self):
         try:
@@ -2705,6 +3718,7 @@ class DigitalControlPanel(BoxLayout):
 
     def d1_mode_callback(self):
         try:
+            app.flush_writes()
             if self.d_one_mode_spinner.text == 'OUT':
                 app.dev.dig_set_mode(1, 0)
                 self.d_one_button.disabled = False
@@ -2778,19 +3792,13 @@ class DigitalControlPanel(BoxLayout):
             app.disconnect_from_oscope()
 
     def d1_freq_callback(self):
-        try:
-            app.dev.dig_set_freq(1, self.d_one_freq_slider.value)
-        except:
-            app.disconnect_from_oscope()
+        app.queue_write('DIG1:FREQ', app.dev.dig_set_freq, 1, self.d_one_freq_slider.value)
 
     def d1_duty_callback(self):
-        try:
-            if self.d_one_mode_spinner.text == 'PWM':
-                app.dev.dig_set_duty(1, self.d_one_duty_slider.value / 100.)
-            elif self.d_one_mode_spinner.text == 'SERVO':
-                app.dev.dig_set_width(1, self.d_one_duty_slider.value)
-        except:
-            app.disconnect_from_oscope()
+        if self.d_one_mode_spinner.text == 'PWM':
+            app.queue_write('DIG1:DUTY', app.dev.dig_set_duty, 1, self.d_one_duty_slider.value / 100.)
+        elif self.d_one_mode_spinner.text == 'SERVO':
+            app.queue_write('DIG1:DUTY', app.dev.dig_set_width, 1, self.d_one_duty_slider.value)
 
     def d2_button_callback(self):
         try:
@@ -2804,6 +3812,7 @@ class DigitalControlPanel(BoxLayout):
 
     def d2_mode_callback(self):
         try:
+            app.flush_writes()
             if self.d_two_mode_spinner.text == 'OUT':
                 app.dev.dig_set_mode(2, 0)
                 self.d_two_button.disabled = False
@@ -2877,19 +3886,13 @@ class DigitalControlPanel(BoxLayout):
             app.disconnect_from_oscope()
 
     def d2_freq_callback(self):
-        try:
-            app.dev.dig_set_freq(2, self.d_two_freq_slider.value)
-        except:
-            app.disconnect_from_oscope()
+        app.queue_write('DIG2:FREQ', app.dev.dig_set_freq, 2, self.d_two_freq_slider.value)
 
     def d2_duty_callback(self):
-        try:
-            if self.d_two_mode_spinner.text == 'PWM':
-                app.dev.dig_set_duty(2, self.d_two_duty_slider.value / 100.)
-            elif self.d_two_mode_spinner.text == 'SERVO':
-                app.dev.dig_set_width(2, self.d_two_duty_slider.value)
-        except:
-            app.disconnect_from_oscope()
+        if self.d_two_mode_spinner.text == 'PWM':
+            app.queue_write('DIG2:DUTY', app.dev.dig_set_duty, 2, self.d_two_duty_slider.value / 100.)
+        elif self.d_two_mode_spinner.text == 'SERVO':
+            app.queue_write('DIG2:DUTY', app.dev.dig_set_width, 2, self.d_two_duty_slider.value)
 
     def d3_button_callback(self):
         try:
@@ -2903,6 +3906,7 @@ class DigitalControlPanel(BoxLayout):
 
     def d3_mode_callback(self):
         try:
+            app.flush_writes()
             if self.d_three_mode_spinner.text == 'OUT':
                 app.dev.dig_set_mode(3, 0)
                 self.d_three_button.disabled = False
@@ -2976,19 +3980,13 @@ class DigitalControlPanel(BoxLayout):
             app.disconnect_from_oscope()
 
     def d3_freq_callback(self):
-        try:
-            app.dev.dig_set_freq(3, self.d_three_freq_slider.value)
-        except:
-            app.disconnect_from_oscope()
+        app.queue_write('DIG3:FREQ', app.dev.dig_set_freq, 3, self.d_three_freq_slider.value)
 
     def d3_duty_callback(self):
-        try:
-            if self.d_three_mode_spinner.text == 'PWM':
-                app.dev.dig_set_duty(3, self.d_three_duty_slider.value / 100.)
-            elif self.d_three_mode_spinner.text == 'SERVO':
-                app.dev.dig_set_width(3, self.d_three_duty_slider.value)
-        except:
-            app.disconnect_from_oscope()
+        if self.d_three_mode_spinner.text == 'PWM':
+            app.queue_write('DIG3:DUTY', app.dev.dig_set_duty, 3, self.d_three_duty_slider.value / 100.)
+        elif self.d_three_mode_spinner.text == 'SERVO':
+            app.queue_write('DIG3:DUTY', app.dev.dig_set_width, 3, self.d_three_duty_slider.value)
 
 class ScopeRoot(Screen):
 
@@ -2998,6 +3996,7 @@ class ScopeRoot(Screen):
         self.toolbar_visible = False
         self.wavegen_visible = False
         self.xyplot_visible = False
+        self.spectrum_visible = False
         self.offset_waveform_visible = False
         self.digital_controls_visible = False
         self.meter_visible = False
@@ -3007,6 +4006,7 @@ class ScopeRoot(Screen):
 
         self.read_offset_waveform = False
         self.offset_waveform_play_pause_button_update_job = None
+        self.offset_waveform_description = 'ramp(0, 2, 1); hold(2, 0.5); chirp(2, 1, 10, 0.5, 1)'
 
     def on_oscope_disconnect(self):
         if self.offset_waveform_play_pause_button_update_job is not None:
@@ -3050,6 +4050,8 @@ class ScopeRoot(Screen):
         if self.digital_control_panel.update_job is not None:
             self.digital_control_panel.update_job.cancel()
             self.digital_control_panel.update_job = None
+        # the timeline shows the inputs as unknown until they are read again
+        self.digital_control_panel.input_poller.set_pins([])
 
         if self.offset_waveform_play_pause_button_update_job is not None:
             self.offset_waveform_play_pause_button_update_job.cancel()
@@ -3139,6 +4141,8 @@ class ScopeRoot(Screen):
             self.offset_waveform_plot.on_keyboard_down(keyboard, keycode, text, modifiers)
         elif self.wavegen_visible:
             self.wavegen_plot.on_keyboard_down(keyboard, keycode, text, modifiers)
+        elif self.xyplot_visible and self.spectrum_visible:
+            self.spectrum_plot.on_keyboard_down(keyboard, keycode, text, modifiers)
         elif self.xyplot_visible:
             self.scope_xyplot.on_keyboard_down(keyboard, keycode, text, modifiers)
         else:
@@ -3159,28 +4163,18 @@ class ScopeRoot(Screen):
         return exponent + mantissa
 
     def sync_offset_waveform(self):
-        if not app.dev.connected:
+        if not app.dev.connected or app.offset_upload is not None:
             return
 
         try:
+            app.flush_writes()
             if not self.read_offset_waveform:
                 self.read_offset_waveform = True
 
                 offset_interval = app.dev.get_offset_interval()
                 self.offset_waveform_interval_slider.value = math.log10(offset_interval)
-                self.offset_waveform_plot.offset_interval = offset_interval
-
-                samples = app.dev.read_offset_waveform_as_voltages()
-                num_samples = len(samples)
-                self.offset_waveform_plot.num_samples = num_samples
-                if num_samples > 0:
-                    self.offset_waveform_plot.curves['OffsetWaveform'].points_x = [offset_interval * np.arange(num_samples)]
-                    self.offset_waveform_plot.curves['OffsetWaveform'].points_y = [np.array(samples)]
 
-                    self.offset_waveform_plot.yaxes['left'].ylabel_value = f'Offset Waveform: {num_samples:d} points, interval = {app.num2str(offset_interval, 4)}s'
-                    self.offset_waveform_plot.xlim = [0., offset_interval * num_samples]
-
-                    self.offset_waveform_plot.refresh_plot()
+                self.offset_waveform_plot.show_waveform(app.dev.read_offset_waveform_as_voltages(), offset_interval)
 
             if app.dev.get_offset_mode() == 1:
                 self.offset_waveform_repeat_button.state = 'down'
@@ -3202,6 +4196,57 @@ class ScopeRoot(Screen):
         except:
             app.disconnect_from_oscope()
 
+    def edit_offset_waveform(self):
+        content = BoxLayout(orientation = 'vertical', spacing = 10, padding = 10)
+        text_input = TextInput(text = self.offset_waveform_description, multiline = False, size_hint_y = None, height = int(36 * app.fontscale), font_size = int(18 * app.fontscale))
+        message = Label(text = 'Segments separated by ;  hold(level, T), ramp(v0, v1, T), staircase(v0, v1, steps, T), pwl([[t, v], ...]), noise(T, level, std), chirp(T, f0, f1, amplitude, level, log=False), expr("...t...", T)',
+                        size_hint_y = None, height = int(48 * app.fontscale), font_size = int(14 * app.fontscale))
+        message.bind(width = lambda instance, width: setattr(instance, 'text_size', [width, None]))
+        preview = OffsetWaveformPlot()
+        buttons = BoxLayout(spacing = 10, size_hint_y = None, height = int(40 * app.fontscale))
+        cancel_button = Button(text = 'Cancel', font_size = int(16 * app.fontscale))
+        preview_button = Button(text = 'Preview', font_size = int(16 * app.fontscale))
+        upload_button = Button(text = 'Upload', font_size = int(16 * app.fontscale))
+        for button in (cancel_button, preview_button, upload_button):
+            buttons.add_widget(button)
+        content.add_widget(text_input)
+        content.add_widget(message)
+        content.add_widget(preview)
+        content.add_widget(buttons)
+        popup = Popup(title = 'Synthesize Offset Waveform', content = content, size_hint = (0.8, 0.8), auto_dismiss = False)
+
+        def synthesize():
+            # The preview shows what the board will produce, from the same 
+            # cached codes that get uploaded.  Waveforms too long for the 
+            # board are turned down before any samples are made.
+            offset_interval = self.offset_waveform_plot.offset_interval
+            try:
+                codes = offsetsynth.codes(app.dev, text_input.text, offset_interval, max_samples = app.dev.MAX_OFFSET_SAMPLES)
+            except ValueError as e:
+                message.text = str(e)
+                return None
+            self.offset_waveform_description = text_input.text
+            preview.show_waveform(offsetsynth.voltages(app.dev, codes), offset_interval, 'Preview')
+            message.text = f'{app.num2str(len(codes) * offset_interval, 4)}s at an interval of {app.num2str(offset_interval, 4)}s'
+            return codes
+
+        def on_upload(instance):
+            codes = synthesize()
+            if codes is None:
+                return
+            popup.dismiss()
+            app.upload_offset_waveform(codes)
+
+        cancel_button.bind(on_release = lambda instance: popup.dismiss())
+        preview_button.bind(on_release = lambda instance: synthesize())
+        upload_button.bind(on_release = on_upload)
+        text_input.bind(on_text_validate = lambda instance: synthesize())
+        # the text input takes over the keyboard while the popup is open
+        popup.bind(on_dismiss = lambda instance: app.root.bind_keyboard())
+        popup.open()
+        synthesize()
+        text_input.focus = True
+
     def update_offset_waveform_play_pause_button(self, t):
         self.offset_waveform_play_pause_button.source = kivy_resources.resource_find('play.png')
         self.offset_waveform_play_pause_button.reload()
@@ -3210,7 +4255,15 @@ class ScopeRoot(Screen):
     def offset_waveform_play_pause_button_callback(self):
         if not app.dev.connected:
             return
+
+        # stops an upload in progress, leaving an empty waveform
+        if app.offset_upload is not None:
+            app.offset_upload.cancel()
+            return
+
         try:
+            # the interval that the slider was left at goes out first
+            app.flush_writes()
             if app.dev.offset_sweep_in_progress():
                 app.dev.offset_stop()
                 if self.offset_waveform_play_pause_button_update_job is not None:
@@ -3230,7 +4283,7 @@ class ScopeRoot(Screen):
             app.disconnect_from_oscope()
 
     def offset_waveform_repeat_button_callback(self):
-        if not app.dev.connected:
+        if not app.dev.connected or app.offset_upload is not None:
             return
 
         try:
@@ -3262,7 +4315,7 @@ class ScopeRoot(Screen):
             if self.offset_waveform_interval_snap_button.state == 'down':
                 value = self.nearest_one_three(value)
             offset_interval = math.pow(10., value)
-            app.dev.set_offset_interval(offset_interval)
+            app.queue_write('WAVEGEN:OFFSET:INTERVAL', app.dev.set_offset_interval, offset_interval)
 
             self.offset_waveform_plot.offset_interval = offset_interval
             num_samples = self.offset_waveform_plot.num_samples
@@ -3361,6 +4414,17 @@ class ScopeRoot(Screen):
         self.scope_xyplot.swap_axes()
         self.xy_h_cursors_button.state, self.xy_v_cursors_button.state = self.xy_v_cursors_button.state, self.xy_h_cursors_button.state
 
+    def toggle_spectrum(self):
+        self.spectrum_visible = not self.spectrum_visible
+        for widget in (self.scope_xyplot, self.swapxy_button, self.xy_h_cursors_button, self.xy_v_cursors_button):
+            widget.opacity = 0. if self.spectrum_visible else 1.
+            widget.disabled = self.spectrum_visible
+        self.spectrum_plot.opacity = 1. if self.spectrum_visible else 0.
+        self.spectrum_plot.disabled = not self.spectrum_visible
+        self.spectrum_plot.worker.reset()
+        self.scope_xyplot.reset_touches()
+        self.spectrum_plot.reset_touches()
+
     def toggle_xy_h_cursors(self):
         self.scope_xyplot.toggle_h_cursors()
 
@@ -3399,6 +4463,7 @@ class ScopeRoot(Screen):
             return
 
         try:
+            app.flush_writes()
             self.wavegen_plot.shape = app.dev.get_shape()
             self.wavegen_plot.frequency = app.dev.get_freq()
             self.wavegen_plot.amplitude = app.dev.get_amplitude()
@@ -3460,6 +4525,7 @@ class ScopeRoot(Screen):
             return
 
         try:
+            app.flush_writes()
             app.dev.set_shape(shape)
             if shape == 'SQUARE':
                 self.offset_adj_slider.value = app.dev.get_sq_offset_adj()
@@ -3472,43 +4538,35 @@ class ScopeRoot(Screen):
         if not app.dev.connected:
             return
 
-        try:
-            app.dev.set_freq(frequency)
-            self.wavegen_plot.frequency = app.dev.get_freq()
-        except:
-            app.disconnect_from_oscope()
+        app.queue_write('WAVEGEN:FREQ', app.dev.set_freq, frequency, done = self.frequency_written)
+
+    def frequency_written(self):
+        # the preview picks up the frequency that the board actually set the
+        # next time that it is drawn
+        self.wavegen_plot.frequency = app.dev.get_freq()
 
     def set_amplitude(self, amplitude):
         if not app.dev.connected:
             return
 
-        try:
-            app.dev.set_amplitude(amplitude)
-            self.wavegen_plot.amplitude = amplitude
-        except:
-            app.disconnect_from_oscope()
+        self.wavegen_plot.amplitude = amplitude
+        app.queue_write('WAVEGEN:AMP', app.dev.set_amplitude, amplitude)
 
     def set_offset(self, offset):
         if not app.dev.connected:
             return
 
-        try:
-            app.dev.set_offset(offset)
-#            self.wavegen_plot.offset = app.dev.get_offset()
-        except:
-            app.disconnect_from_oscope()
+        app.queue_write('WAVEGEN:OFFSET', app.dev.set_offset, offset)
+#        self.wavegen_plot.offset = app.dev.get_offset()
 
     def update_offset_adj(self):
         if not app.dev.connected:
             return
 
-        try:
-            if self.wavegen_plot.shape == 'SQUARE':
-                app.dev.set_sq_offset_adj(int(self.offset_adj_slider.value))
-            else:
-                app.dev.set_nsq_offset_adj(int(self.offset_adj_slider.value))
-        except:
-            app.disconnect_from_oscope()
+        if self.wavegen_plot.shape == 'SQUARE':
+            app.queue_write('WAVEGEN:SQOFFADJ', app.dev.set_sq_offset_adj, int(self.offset_adj_slider.value))
+        else:
+            app.queue_write('WAVEGEN:NSQOFFADJ', app.dev.set_nsq_offset_adj, int(self.offset_adj_slider.value))
 
     def pan_left(self):
         if self.offset_waveform_visible:
@@ -3622,6 +4680,29 @@ class BodeRoot(Screen):
         self.index = 0
         self.sweep_in_progress = False
 
+        # adaptive sweeps spend the point budget where the response changes
+        self.adaptive_sweep = False
+        self.sweep = None
+
+        # raw buffers of the last sweep, kept for offline re-analysis
+        self.keep_raw_buffers = False
+        self.archive = None
+
+        self.estimators = tuple(bodeanalysis.ESTIMATORS)
+        self.estimator = bodeanalysis.DEFAULT_ESTIMATOR
+        # acquisitions of the current point so far
+        self.acquisitions = []
+        self.min_snr = bodeanalysis.DEFAULT_MIN_SNR
+        self.max_acquisitions = 4
+
+        # sampling interval and averaging are planned per point; the
+        # averaging set on the scope screen is restored after the sweep
+        self.planner = None
+        self.predicted_time = None
+        self.last_snr = None
+        self.last_num_avg = 0
+        self.saved_max_avg = None
+
         self.bode_toolbar_visible = False
         self.bode_controls_visible = False
 
@@ -3655,10 +4736,39 @@ class BodeRoot(Screen):
         if app.save_dialog_visible:
             return False
 
-        self.bode_plot.on_keyboard_down(keyboard, keycode, text, modifiers)
+        if key == 'a':
+            self.toggle_adaptive_sweep()
+        elif key == 'r':
+            self.toggle_keep_raw_buffers()
+        elif key == 'e':
+            self.cycle_estimator()
+        else:
+            self.bode_plot.on_keyboard_down(keyboard, keycode, text, modifiers)
 
         return True
 
+    def toggle_adaptive_sweep(self):
+        # Takes effect at the start of the next sweep.
+        self.adaptive_sweep = not self.adaptive_sweep
+        self.update_xlabel()
+
+    def toggle_keep_raw_buffers(self):
+        # Takes effect at the start of the next sweep.
+        self.keep_raw_buffers = not self.keep_raw_buffers
+        self.update_xlabel()
+
+    def cycle_estimator(self):
+        # Takes effect at the next point.
+        self.estimator = self.estimators[(self.estimators.index(self.estimator) + 1) % len(self.estimators)]
+        self.update_xlabel()
+
+    def update_xlabel(self):
+        modes = ([self.estimator] if self.estimator != bodeanalysis.DEFAULT_ESTIMATOR else []) + (['Adaptive'] if self.adaptive_sweep else []) + (['Raw'] if self.keep_raw_buffers else [])
+        if self.sweep_in_progress and self.predicted_time is not None:
+            modes.append('~{:.0f} s'.format(self.predicted_time))
+        self.bode_plot.xlabel_value = ', '.join(['Frequency (Hz)'] + modes)
+        self.bode_plot.refresh_plot()
+
     def play_stop(self):
         if not self.sweep_in_progress:
             self.start_sweep()
@@ -3682,28 +4792,61 @@ class BodeRoot(Screen):
             self.stop_sweep()
             return
 
+        if not self.sweep_in_progress:
+            self.saved_max_avg = app.dev.max_avg
         self.sweep_in_progress = True
         self.play_stop_button.source = kivy_resources.resource_find('stop.png')
         self.play_stop_button.reload()
 
         num_points = int(self.num_points_slider.value)
-        if num_points == 1:
+        if self.adaptive_sweep:
+            # the points slider sets the point budget; the frequencies are
+            # chosen as the sweep goes
+            self.sweep = bodesweep.AdaptiveSweep(self.start_freq_slider.value, self.end_freq_slider.value, num_points)
+            self.target_freq = [self.start_freq_slider.value, self.end_freq_slider.value]
+        elif num_points == 1:
+            self.sweep = None
             self.target_freq = [self.start_freq_slider.value]
         else:
+            self.sweep = None
             self.target_freq = list(np.logspace(math.log10(self.start_freq_slider.value), math.log10(self.end_freq_slider.value), num_points))
         self.freq = []
         self.gain = []
         self.phase = []
         self.index = 0
+        self.acquisitions = []
+        if self.keep_raw_buffers:
+            self.archive = bodeanalysis.SweepArchive({'amplitude': self.amplitude_slider.value, 'offset': self.offset_slider.value, 'estimator': self.estimator})
+        else:
+            self.archive = None
+
+        self.planner = bodeplan.AcquisitionPlanner(app.dev, target_snr = self.min_snr)
+        self.last_snr = None
+        self.last_num_avg = 0
+        # an adaptive sweep may stop early, so this is at most its time
+        if self.adaptive_sweep and num_points > 1:
+            self.predicted_time = self.planner.sweep_time(np.logspace(math.log10(self.start_freq_slider.value), math.log10(self.end_freq_slider.value), num_points))
+        else:
+            self.predicted_time = self.planner.sweep_time(self.target_freq)
+        self.update_xlabel()
 
         try:
-            app.dev.wave(shape = 'SIN', freq = self.target_freq[0], amplitude = self.amplitude_slider.value, offset = self.offset_slider.value)
-            app.dev.set_period(12. / (app.dev.SCOPE_BUFFER_SIZE * self.target_freq[0]))
+            freq = self.next_frequency()
+            app.dev.wave(shape = 'SIN', freq = freq, amplitude = self.amplitude_slider.value, offset = self.offset_slider.value)
+            self.planner.apply(app.dev, self.planner.plan(freq))
         except:
             app.disconnect_from_oscope()
 
         self.state_handler = Clock.schedule_once(self.trigger, 0.05)
 
+    def next_frequency(self):
+        # The frequency to measure next, or None at the end of the sweep.
+        if self.sweep is not None:
+            return self.sweep.next_frequency()
+        elif self.index < len(self.target_freq):
+            return self.target_freq[self.index]
+        return None
+
     def stop_sweep(self):
         if self.state_handler is not None:
             self.state_handler.cancel()
@@ -3712,6 +4855,15 @@ class BodeRoot(Screen):
         self.sweep_in_progress = False
         self.play_stop_button.source = kivy_resources.resource_find('play.png')
         self.play_stop_button.reload()
+        self.update_xlabel()
+
+        if self.saved_max_avg is not None:
+            try:
+                if app.dev.connected and app.dev.max_avg != self.saved_max_avg:
+                    app.dev.set_max_avg(self.saved_max_avg)
+            except:
+                app.disconnect_from_oscope()
+            self.saved_max_avg = None
 
     def trigger(self, t):
         try:
@@ -3735,72 +4887,44 @@ class BodeRoot(Screen):
 
     def process_buffer(self, scope_buffer):
         try:
-            sampling_interval = app.dev.sampling_interval
-            ch1_range = app.dev.ch1_range
-            ch2_range = app.dev.ch2_range
-
-            if sampling_interval == 0.25e-6:
-                ch1_zero = app.dev.ch1_zero_4MSps[ch1_range]
-                ch1_gain = app.dev.ch1_gain_4MSps[ch1_range]
-                ch2_zero = app.dev.ch2_zero_4MSps[ch2_range]
-                ch2_gain = app.dev.ch2_gain_4MSps[ch2_range]
+            buffer = np.array(scope_buffer, dtype = np.uint16)
+            settings = bodeanalysis.point_settings(app.dev)
+            self.acquisitions.append(bodeanalysis.analyze_point(buffer, settings, estimator = self.estimator))
+            if self.archive is not None:
+                self.archive.append(buffer, settings, self.index)
+
+            # re-acquire a noisy point and average, rather than averaging
+            # every point of the sweep
+            [freq, gain, phase, snr] = bodeanalysis.combine(self.acquisitions)
+            if snr < self.min_snr and len(self.acquisitions) < self.max_acquisitions:
+                self.state_handler = Clock.schedule_once(self.trigger, 0.05)
+                return
+            # the SNR of a single acquisition predicts the averaging needed
+            # at the next point
+            self.last_snr = self.acquisitions[0][3]
+            self.last_num_avg = settings['num_avg']
+            self.acquisitions = []
+
+            if self.sweep is not None:
+                # adaptive points arrive out of order, so keep the lists
+                # sorted by frequency for plotting and saving
+                self.sweep.add(self.sweep.next_frequency(), gain, phase)
+                index = bisect.bisect(self.freq, freq)
             else:
-                ch1_zero = app.dev.ch1_zero[app.dev.num_avg][ch1_range]
-                ch1_gain = app.dev.ch1_gain[app.dev.num_avg][ch1_range]
-                ch2_zero = app.dev.ch2_zero[app.dev.num_avg][ch2_range]
-                ch2_gain = app.dev.ch2_gain[app.dev.num_avg][ch2_range]
-
-            num_samples = app.dev.SCOPE_BUFFER_SIZE // 2
-            ch1 = [app.dev.volts_per_lsb[ch1_range] * ch1_gain * (sample - ch1_zero) for sample in scope_buffer[0:num_samples]]
-            ch2 = [app.dev.volts_per_lsb[ch2_range] * ch2_gain * (sample - ch2_zero) for sample in scope_buffer[num_samples:]]
-
-            freq = app.dev.get_freq()
-
-            per_est = 1. / (sampling_interval * freq)
-            per_est_int = int(per_est)
-            per_est_frac = per_est - float(per_est_int)
-
-            Z = range(num_samples)
-            s = [math.sin(2. * math.pi * i / per_est) for i in Z]
-            c = [math.cos(2. * math.pi * i / per_est) for i in Z]
-
-            ch1_s = [ch1[i] * s[i] for i in Z]
-            ch1_c = [ch1[i] * c[i] for i in Z]
-            ch2_s = [ch2[i] * s[i] for i in Z]
-            ch2_c = [ch2[i] * c[i] for i in Z]
-
-            ch1_A_cos_phi = [2. * (sum(ch1_s[i:i + per_est_int]) - 0.5 * (ch1_s[i] + ch1_s[i + per_est_int]) + per_est_frac * (ch1_s[i + per_est_int] + 0.5 * per_est_frac * (ch1_s[i + per_est_int + 1] - ch1_s[i + per_est_int]))) / per_est for i in range(num_samples - per_est_int - 1)]
-            ch1_A_sin_phi = [2. * (sum(ch1_c[i:i + per_est_int]) - 0.5 * (ch1_c[i] + ch1_c[i + per_est_int]) + per_est_frac * (ch1_c[i + per_est_int] + 0.5 * per_est_frac * (ch1_c[i + per_est_int + 1] - ch1_c[i + per_est_int]))) / per_est for i in range(num_samples - per_est_int - 1)]
-            ch2_A_cos_phi = [2. * (sum(ch2_s[i:i + per_est_int]) - 0.5 * (ch2_s[i] + ch2_s[i + per_est_int]) + per_est_frac * (ch2_s[i + per_est_int] + 0.5 * per_est_frac * (ch2_s[i + per_est_int + 1] - ch2_s[i + per_est_int]))) / per_est for i in range(num_samples - per_est_int - 1)]
-            ch2_A_sin_phi = [2. * (sum(ch2_c[i:i + per_est_int]) - 0.5 * (ch2_c[i] + ch2_c[i + per_est_int]) + per_est_frac * (ch2_c[i + per_est_int] + 0.5 * per_est_frac * (ch2_c[i + per_est_int + 1] - ch2_c[i + per_est_int]))) / per_est for i in range(num_samples - per_est_int - 1)]
-
-            ch1_AcosPhi = sum(ch1_A_cos_phi) / float(len(ch1_A_cos_phi))
-            ch1_AsinPhi = sum(ch1_A_sin_phi) / float(len(ch1_A_sin_phi))
-            ch2_AcosPhi = sum(ch2_A_cos_phi) / float(len(ch2_A_cos_phi))
-            ch2_AsinPhi = sum(ch2_A_sin_phi) / float(len(ch2_A_sin_phi))
-
-            ch2_offset = 2. * math.pi * 0.125e-6 * freq
-            ch2_AcosPhi, ch2_AsinPhi = ch2_AcosPhi * math.cos(ch2_offset) + ch2_AsinPhi * math.sin(ch2_offset), ch2_AsinPhi * math.cos(ch2_offset) - ch2_AcosPhi * math.sin(ch2_offset)
-
-            ch1_A = math.sqrt(ch1_AcosPhi ** 2 + ch1_AsinPhi ** 2)
-            ch2_A = math.sqrt(ch2_AcosPhi ** 2 + ch2_AsinPhi ** 2)
-
-            gain = 20. * math.log10(ch2_A / ch1_A)
-            sign = 1. if ch1_AcosPhi * ch2_AsinPhi - ch1_AsinPhi * ch2_AcosPhi >= 0. else -1.
-            phase = sign * 180. * math.acos((ch1_AcosPhi * ch2_AcosPhi + ch1_AsinPhi * ch2_AsinPhi) / (ch1_A * ch2_A)) / math.pi
-
-            self.freq.append(freq)
-            self.gain.append(gain)
-            self.phase.append(phase)
+                index = len(self.freq)
+            self.freq.insert(index, freq)
+            self.gain.insert(index, gain)
+            self.phase.insert(index, phase)
 
             self.bode_plot.semilogx(np.array(self.freq), np.array(self.gain), 'm.m-' if self.pointmarkers_button.state == 'down' else 'm-', name = 'gain', yaxis = 'left')
             self.bode_plot.semilogx(np.array(self.freq), np.array(self.phase), 'c.c-' if self.pointmarkers_button.state == 'down' else 'c-', name = 'phase', yaxis = 'right', hold = 'on')
             self.bode_plot.xlimits([min(self.target_freq), max(self.target_freq)])
 
             self.index += 1
-            if self.index < len(self.target_freq):
-                app.dev.set_freq(self.target_freq[self.index])
-                app.dev.set_period(12. / (app.dev.SCOPE_BUFFER_SIZE * self.target_freq[self.index]))
+            next_freq = self.next_frequency()
+            if next_freq is not None:
+                app.dev.set_freq(next_freq)
+                self.planner.apply(app.dev, self.planner.plan(next_freq, self.last_snr, self.last_num_avg))
                 self.state_handler = Clock.schedule_once(self.trigger, 0.05)
             elif self.trigger_repeat_button.state == 'down':
                 self.start_sweep()
@@ -3859,6 +4983,9 @@ class MainApp(App):
         
         self.dev = oscope.oscope()
         self.connect_job = None
+        self.connect_retries = 0
+        self.connect_backoff = 0.2
+        self.device_watcher = devicewatcher.DeviceWatcher(self.on_devices_changed)
         self.save_dialog_visible = False
         self.save_dialog_path = os.path.expanduser('~')
         self.save_dialog_file = None
@@ -3879,6 +5006,14 @@ class MainApp(App):
         self.settings_dialog_visible = False
         self.settings_update_job = None
 
+        # Offset waveform upload running in the background
+        self.offset_upload = None
+        self.offset_upload_job = None
+
+        # Writes from sliders and dragged control points, coalesced by register
+        self.device_writes = devicewrites.CoalescingWriter()
+        self.device_writes_job = None
+
     def build(self):
         self.root = RootWidget()
         self.title = f"Whoa-Scope v{__version__}"
@@ -3888,12 +5023,19 @@ class MainApp(App):
         if settings_manager.launch_maximized:
             Window.maximize()
         
+        self.device_watcher.start()
         if self.dev.connected:
             self.root.scope.scope_plot.update_job = Clock.schedule_once(self.root.scope.scope_plot.update_scope_plot, 0.1)
             self.root.scope.digital_control_panel.sync_controls()
         else:
             self.connect_job = Clock.schedule_once(self.connect_to_oscope, 0.2)
         return self.root
+
+    def on_stop(self):
+        self.device_watcher.stop()
+        if self.offset_upload is not None:
+            self.offset_upload.cancel()
+        self.root.scope.spectrum_plot.worker.stop()
     
     def get_serial_port_info(self):
         """Get detailed information about serial ports for the settings panel."""
@@ -4031,6 +5173,8 @@ class MainApp(App):
                 scope.scope_plot.colors['ch2'] = theme['ch2_color']
                 scope.scope_plot.yaxes['CH1'].color = theme['ch1_color']
                 scope.scope_plot.yaxes['CH2'].color = theme['ch2_color']
+                scope.scope_plot.colors['math'] = theme['waveform_color']
+                scope.scope_plot.yaxes['MATH'].color = theme['waveform_color']
                 scope.scope_plot.configure(
                     background=theme['plot_background'],
                     axes_background=theme['axes_background'],
@@ -4268,7 +5412,10 @@ class MainApp(App):
         self._settings_ports_label = ports_label
         if self.settings_update_job is not None:
             self.settings_update_job.cancel()
-        self.settings_update_job = Clock.schedule_interval(self._update_settings_connection, 1.0)
+            self.settings_update_job = None
+        self._update_settings_connection(0)
+        if not self.device_watcher.event_driven:
+            self.settings_update_job = Clock.schedule_interval(self._update_settings_connection, 1.0)
     
     def stop_settings_updates(self):
         """Stop periodic updates of the settings dialog."""
@@ -4290,22 +5437,62 @@ class MainApp(App):
         App.get_running_app().stop()
         Window.close()
 
+    def on_devices_changed(self):
+        # called from the device watcher's thread
+        Clock.schedule_once(self._on_devices_changed)
+
+    def _on_devices_changed(self, t):
+        self._update_settings_connection(t)
+        if self.dev.connected:
+            return
+
+        # udev may still be setting up the port's permissions when the event 
+        # arrives, so retry a few times with increasing delays
+        self.connect_retries = 6
+        self.connect_backoff = 0.05
+        if self.connect_job is not None:
+            self.connect_job.cancel()
+        self.connect_job = Clock.schedule_once(self.connect_to_oscope, 0.05)
+
     def connect_to_oscope(self, t):
+        self.connect_job = None
         if self.dev.connected:
             return
 
-        self.dev = oscope.oscope()
+        # Only try to open a port when a board is actually attached; the 
+        # device watcher calls back here when one shows up.
+        ports = devicewatcher.find_devices()
+        if ports:
+            self.dev = oscope.oscope()
         if self.dev.connected:
-            self.connect_job = None
+            self.connect_retries = 0
             self.root.scope.scope_plot.update_job = Clock.schedule_once(self.root.scope.scope_plot.update_scope_plot, 0.1)
             self.root.scope.digital_control_panel.sync_controls()
-        else:
-            self.connect_job = Clock.schedule_once(self.connect_to_oscope, 0.2)
+            self._update_settings_connection(t)
+        elif ports or (self.connect_retries > 0):
+            # a board is there (or is about to be) but could not be opened 
+            # yet, so back off exponentially while retrying
+            self.connect_retries = max(self.connect_retries - 1, 0)
+            self.connect_job = Clock.schedule_once(self.connect_to_oscope, self.connect_backoff)
+            self.connect_backoff = min(2. * self.connect_backoff, 5.)
 
     def disconnect_from_oscope(self):
         if not self.dev.connected:
             return
 
+        if self.offset_upload is not None:
+            self.offset_upload.cancel()
+            self.offset_upload.join()
+            self.offset_upload = None
+        if self.offset_upload_job is not None:
+            self.offset_upload_job.cancel()
+            self.offset_upload_job = None
+
+        self.device_writes.clear()
+        if self.device_writes_job is not None:
+            self.device_writes_job.cancel()
+            self.device_writes_job = None
+
         self.dev.dev = None
         self.dev.connected = False
 
@@ -4314,7 +5501,9 @@ class MainApp(App):
 
         if self.connect_job is not None:
             self.connect_job.cancel()
+        self.connect_backoff = 0.2
         self.connect_job = Clock.schedule_once(self.connect_to_oscope, 0.2)
+        self._update_settings_connection(0)
 
     def num2str(self, num_raw, ndigits = 0, positive_sign = False, trailing_zeros = False):
         """
@@ -4390,6 +5579,29 @@ class MainApp(App):
         if selection:
             self.export_freqresp(selection[0])
 
+    def open_save_logic_dialog(self):
+        filechooser.save_file(
+            on_selection=self._on_logic_save_selection,
+            title="Save Logic Timeline",
+            filters=[("VCD Files", "*.vcd")]
+        )
+
+    def _on_logic_save_selection(self, selection):
+        if selection:
+            self.export_logic_timeline(selection[0])
+
+    def export_logic_timeline(self, filepath):
+        if not filepath:
+            return
+
+        if not filepath.lower().endswith('.vcd'):
+            filepath += '.vcd'
+
+        try:
+            self.root.scope.digital_control_panel.logic_timeline.export_vcd(filepath)
+        except Exception as e:
+            print(f"Error exporting logic timeline: {e}")
+
     def export_waveforms(self, filepath):
         if not filepath:
             return
@@ -4400,24 +5612,30 @@ class MainApp(App):
 
         try:
             with open(filepath, 'w') as outfile:
+                # Access plot data directly
+                curve_ch1 = self.root.scope.scope_plot.curves['CH1']
+                curve_ch2 = self.root.scope.scope_plot.curves['CH2']
+                curve_math = self.root.scope.scope_plot.curves['MATH']
+                # the math trace is evaluated run by run over the CH1 sample 
+                # times, so it lines up with the other columns
+                has_math = self.root.scope.scope_plot.math_expression is not None
+
                 if filepath.lower().endswith('.txt'):
-                    outfile.write('t1\tch1\tt2\tch2\n')
                     sep = '\t'
                 else:
-                    outfile.write('t1,ch1,t2,ch2\n')
                     sep = ','
-
-                # Access plot data directly
-                curve_ch1 = self.root.scope.scope_plot.curves['CH1']
-                curve_ch2 = self.root.scope.scope_plot.curves['CH2']
+                outfile.write(sep.join(['t1', 'ch1', 't2', 'ch2'] + (['math'] if has_math else [])) + '\n')
 
                 for i in range(len(curve_ch1.points_x)):
                     for j in range(len(curve_ch1.points_x[i])):
                         line = f'{curve_ch1.points_x[i][j]}{sep}'
                         line += f'{curve_ch1.points_y[i][j]}{sep}'
                         line += f'{curve_ch2.points_x[i][j]}{sep}'
-                        line += f'{curve_ch2.points_y[i][j]}\n'
-                        outfile.write(line)
+                        line += f'{curve_ch2.points_y[i][j]}'
+                        if has_math:
+                            math_y = curve_math.points_y[i] if i < len(curve_math.points_y) else []
+                            line += f'{sep}{math_y[j]}' if j < len(math_y) else sep
+                        outfile.write(line + '\n')
         except Exception as e:
             print(f"Error saving waveforms: {e}")
 
@@ -4443,6 +5661,10 @@ class MainApp(App):
                     line += f'{bode_root.gain[i]}{sep}'
                     line += f'{bode_root.phase[i]}\n'
                     outfile.write(line)
+
+            # the raw buffers go next to the table, for bodeanalysis.py
+            if bode_root.archive is not None and len(bode_root.archive) > 0:
+                bode_root.archive.save(os.path.splitext(filepath)[0] + '.npz')
         except Exception as e:
             print(f"Error saving frequency response: {e}")
 
@@ -4450,6 +5672,67 @@ class MainApp(App):
         if not self.dev.connected:
             return
 
+        try:
+            voltages = offsetupload.load_voltages(os.path.join(path, filename))
+        except (OSError, ValueError) as e:
+            print(f"Error loading offset waveform: {e}")
+            return
+
+        self.upload_offset_waveform(self.dev.offset_waveform_codes(voltages))
+
+    def queue_write(self, key, function, *args, done = None):
+        """
+        Write a setting that a slider or drag changes continuously.
+        Only the latest value queued for key is written, at most once per
+        device_writes.interval; done, if given, is called after the write.
+        """
+        if not self.dev.connected:
+            return
+
+        delay = self.device_writes.write(key, function, *args, done = done)
+        if self.device_writes_job is None:
+            if (delay == 0.) and (self.offset_upload is None):
+                self.flush_writes()
+            else:
+                self.device_writes_job = Clock.schedule_once(self.flush_writes, max(delay, 0.01))
+
+    def flush_writes(self, t = None):
+        """
+        Make the queued writes now, for example when a control is released
+        or before another command to the same settings.  Called directly,
+        the writes go out even during an offset waveform upload, between its
+        packets, so that they land before the caller's next command; only
+        the timer-driven flush, called with t, waits for the upload.
+        """
+        if self.device_writes_job is not None:
+            self.device_writes_job.cancel()
+            self.device_writes_job = None
+
+        if not self.dev.connected:
+            self.device_writes.clear()
+            return
+
+        if len(self.device_writes) == 0:
+            return
+
+        # leave the link to an offset waveform upload until it is done
+        if (t is not None) and (self.offset_upload is not None):
+            self.device_writes_job = Clock.schedule_once(self.flush_writes, 0.1)
+            return
+
+        try:
+            self.device_writes.flush()
+        except:
+            self.disconnect_from_oscope()
+
+    def upload_offset_waveform(self, codes):
+        if not self.dev.connected or self.offset_upload is not None:
+            return
+
+        if len(codes) > self.dev.MAX_OFFSET_SAMPLES:
+            print(f"Offset waveform has {len(codes):d} points, but only {self.dev.MAX_OFFSET_SAMPLES:d} fit.")
+            return
+
         try:
             if self.dev.offset_sweep_in_progress():
                 self.dev.offset_stop()
@@ -4460,16 +5743,38 @@ class MainApp(App):
                 self.root.scope.offset_waveform_play_pause_button.reload()
         except:
             self.disconnect_from_oscope()
+            return
 
-        try:
-            if not self.dev.write_offset_waveform_as_voltages(os.path.join(path, filename)):
-                return
-        except:
-            self.disconnect_from_oscope()
+        # The upload runs in the background.  Driver calls are serialized 
+        # by the oscope's lock, so other controls can still use the board, 
+        # but the scope plot and the polling loops hold off until the upload 
+        # is done to leave it the link.
+        self.offset_upload = offsetupload.OffsetWaveformUpload(self.dev, codes)
+        self.offset_upload.start()
+        self.offset_upload_job = Clock.schedule_interval(self.update_offset_upload, 0.1)
+
+    def update_offset_upload(self, t):
+        upload = self.offset_upload
+        if upload is None:
+            return False
+
+        plot = self.root.scope.offset_waveform_plot
+        if not upload.done.is_set():
+            plot.yaxes['left'].ylabel_value = f'Uploading offset waveform: {100. * upload.progress:.0f}% (play/pause to cancel)'
+            plot.refresh_plot()
             return
 
+        self.offset_upload = None
+        self.offset_upload_job = None
+        if upload.result == 'error':
+            self.disconnect_from_oscope()
+            return False
+        if upload.result == 'mismatch':
+            print(f"Problem writing offset waveform: read back differs from the {len(upload.codes):d} samples written.")
+
         self.root.scope.read_offset_waveform = False
         self.root.scope.sync_offset_waveform()
+        return False
 
 if __name__ == '__main__':
     app = MainApp()
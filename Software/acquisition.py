@@ -0,0 +1,186 @@
+"""
+Host-side acquisition modes for Whoa-Scope.
+Combines successive triggered frames into an ensemble average, a min/max
+envelope or an equivalent-time reconstruction.  Frames are placed on a
+common time grid centered on the trigger point using the sub-sample trigger
+offset, so that averaging does not smear edges by up to one sample period.
+"""
+
+import numpy as np
+
+
+class AlignedFrames(object):
+    """Base class that resamples frames onto a grid centered on the trigger."""
+
+    def __init__(self, num_samples=1500):
+        self.num_samples = num_samples
+        self.middle = num_samples >> 1
+        self.aligned = np.zeros((2, num_samples))
+        self.counts = np.zeros(num_samples, dtype=np.int64)
+
+    def align(self, ch1, ch2, zero, offset):
+        """Linearly interpolate both channels so that the trigger lands on self.middle.
+
+        zero and offset locate the trigger between ch[zero] and ch[zero + 1]
+        as in ScopePlot.update_scope_plot.  Returns the [lo, hi) range of
+        grid points covered by the frame.
+        """
+        shift = int(zero) - self.middle
+        lo = max(-shift, 0)
+        hi = min(self.num_samples, len(ch1) - 1 - shift)
+        if hi <= lo:
+            return [0, 0]
+        offset = float(offset)
+        for ch, out in ((ch1, self.aligned[0, lo:hi]), (ch2, self.aligned[1, lo:hi])):
+            np.multiply(ch[lo + shift:hi + shift], 1. - offset, out=out)
+            out += offset * ch[lo + shift + 1:hi + shift + 1]
+        return [lo, hi]
+
+    def covered(self):
+        """Return the [lo, hi) span of grid points that at least one frame covered."""
+        nonzero = np.flatnonzero(self.counts)
+        if len(nonzero) == 0:
+            return [0, 0]
+        return [int(nonzero[0]), int(nonzero[-1]) + 1]
+
+
+class FrameAverager(AlignedFrames):
+    """Average of the last depth trigger-aligned frames.
+
+    A ring of the aligned frames is kept alongside running sums, so adding a
+    frame only adds it to and subtracts the oldest frame from the sums, no
+    matter how deep the average is.
+    """
+
+    def __init__(self, num_samples=1500, depth=16):
+        super(FrameAverager, self).__init__(num_samples)
+        self.depth = 0
+        self.set_depth(depth)
+
+    def set_depth(self, depth):
+        depth = int(depth)
+        if depth != self.depth:
+            self.depth = depth
+            self.ring = np.zeros((depth, 2, self.num_samples))
+            self.ranges = np.zeros((depth, 2), dtype=np.int64)
+            self.sums = np.zeros((2, self.num_samples))
+            self.mean = np.zeros((2, self.num_samples))
+        self.reset()
+
+    def reset(self):
+        self.sums[:] = 0.
+        self.counts[:] = 0
+        self.ranges[:] = 0
+        self.head = 0
+        self.num_frames = 0
+
+    def add(self, ch1, ch2, zero, offset):
+        [lo, hi] = self.align(ch1, ch2, zero, offset)
+
+        if self.num_frames == self.depth:
+            [old_lo, old_hi] = self.ranges[self.head]
+            self.sums[:, old_lo:old_hi] -= self.ring[self.head, :, old_lo:old_hi]
+            self.counts[old_lo:old_hi] -= 1
+        else:
+            self.num_frames += 1
+
+        self.ring[self.head, :, lo:hi] = self.aligned[:, lo:hi]
+        self.ranges[self.head] = [lo, hi]
+        self.sums[:, lo:hi] += self.aligned[:, lo:hi]
+        self.counts[lo:hi] += 1
+        self.head = (self.head + 1) % self.depth
+
+    def average(self):
+        """Return [lo, hi, mean], where mean[0] and mean[1] hold the averaged channels over [lo, hi)."""
+        [lo, hi] = self.covered()
+        np.divide(self.sums[:, lo:hi], np.maximum(self.counts[lo:hi], 1), out=self.mean[:, lo:hi])
+        return [lo, hi, self.mean[:, lo:hi]]
+
+
+class FrameEnvelope(AlignedFrames):
+    """Running minimum and maximum of trigger-aligned frames (peak hold)."""
+
+    def __init__(self, num_samples=1500):
+        super(FrameEnvelope, self).__init__(num_samples)
+        self.mins = np.zeros((2, num_samples))
+        self.maxs = np.zeros((2, num_samples))
+        self.reset()
+
+    def reset(self):
+        self.mins[:] = np.inf
+        self.maxs[:] = -np.inf
+        self.counts[:] = 0
+        self.num_frames = 0
+
+    def add(self, ch1, ch2, zero, offset):
+        [lo, hi] = self.align(ch1, ch2, zero, offset)
+        np.minimum(self.mins[:, lo:hi], self.aligned[:, lo:hi], out=self.mins[:, lo:hi])
+        np.maximum(self.maxs[:, lo:hi], self.aligned[:, lo:hi], out=self.maxs[:, lo:hi])
+        self.counts[lo:hi] += 1
+        self.num_frames += 1
+
+    def envelope(self):
+        """Return [lo, hi, mins, maxs] over the span of grid points covered so far."""
+        [lo, hi] = self.covered()
+        return [lo, hi, self.mins[:, lo:hi], self.maxs[:, lo:hi]]
+
+
+class EquivalentTimeSampler(object):
+    """Equivalent-time reconstruction of a repetitive signal.
+
+    The trigger point falls at a random fraction of a sample period in each
+    frame, so binning the samples of many frames by their time relative to
+    the trigger onto a grid factor times finer than the sampling interval
+    fills in the waveform between the real sample instants.  Old frames are
+    forgotten exponentially once depth frames have been accumulated so that
+    the display keeps following the signal.
+    """
+
+    def __init__(self, num_samples=1500, factor=20, depth=256):
+        self.num_samples = num_samples
+        self.middle = num_samples >> 1
+        self.ramp = np.arange(num_samples, dtype=np.float64)
+        self.depth = depth
+        self.factor = 0
+        self.set_factor(factor)
+
+    def set_factor(self, factor):
+        factor = int(factor)
+        if factor != self.factor:
+            self.factor = factor
+            self.size = self.num_samples * factor
+            self.sums = np.zeros((2, self.size))
+            self.counts = np.zeros(self.size)
+        self.reset()
+
+    def reset(self):
+        self.sums[:] = 0.
+        self.counts[:] = 0.
+        self.num_frames = 0
+
+    def add(self, ch1, ch2, zero, offset):
+        n = len(ch1)
+        bins = np.rint((self.ramp[:n] - (zero + offset) + self.middle) * self.factor).astype(np.int64)
+        valid = (bins >= 0) & (bins < self.size)
+        bins = bins[valid]
+
+        if self.num_frames >= self.depth:
+            forget = 1. - 1. / self.depth
+            self.sums *= forget
+            self.counts *= forget
+        else:
+            self.num_frames += 1
+
+        self.sums[0] += np.bincount(bins, weights=ch1[valid], minlength=self.size)
+        self.sums[1] += np.bincount(bins, weights=ch2[valid], minlength=self.size)
+        self.counts += np.bincount(bins, minlength=self.size)
+
+    def samples(self):
+        """Return [times, values] for the filled bins.
+
+        times are in sample periods relative to the trigger; values[0] and
+        values[1] hold the reconstructed channels.
+        """
+        filled = np.flatnonzero(self.counts > 1e-3)
+        times = filled / float(self.factor) - self.middle
+        return [times, self.sums[:, filled] / self.counts[filled]]
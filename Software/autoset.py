@@ -0,0 +1,229 @@
+"""
+Autoset for Whoa-Scope.
+Chooses the sampling interval, input ranges and trigger for an unknown
+signal from a handful of sweeps instead of stepping through the 1-2-5
+intervals and the ranges one sweep at a time.  Every sweep is analyzed for
+the level, amplitude and period of both channels, and the next sweep jumps
+straight to the interval that shows the target number of periods in the
+500 samples of the default view.  The search ends once a sweep at that
+interval confirms the period, which also catches signals that were
+aliased at the interval of the first sweep.
+
+The period is taken from the spacing of hysteresis-qualified crossings of
+the mid level, or from the largest spectral peak when the crossings are
+irregular, as they are for signals with strong harmonics.
+"""
+
+import math
+
+import numpy as np
+
+import frameprocessor
+import spectrum
+import triggers
+
+
+# the 1-2-5 sampling intervals that autoset chooses from; the fastest is
+# the 4MSps mode and slower ones would take too long to capture
+INTERVALS = (0.25e-6,) + tuple(m * 10. ** e for e in range(-7, -2) for m in (1., 2., 5.) if 0.5e-6 <= m * 10. ** e <= 1e-3)
+
+VIEW_SAMPLES = 500
+# geometric mean of 2 and 5 periods in view
+TARGET_PERIODS = math.sqrt(10.)
+
+# the first sweep, and the sweeps tried in turn while no signal is found:
+# one fast enough for signals that alias to DC at the first interval and
+# one slow enough for signals with less than two periods in the first
+PROBE_INTERVALS = (10e-6, 0.5e-6, 1e-3)
+
+
+def nearest_interval(interval):
+    """Return the entry of INTERVALS nearest to interval on a log scale."""
+    return min(INTERVALS, key=lambda candidate: abs(math.log(candidate / interval)))
+
+
+def target_interval(period):
+    """Return the interval from INTERVALS that shows closest to TARGET_PERIODS periods in view."""
+    return nearest_interval(period * TARGET_PERIODS / VIEW_SAMPLES)
+
+
+def analyze(ch, sampling_interval, min_amplitude):
+    """Return a dict with the low, high and mid levels, the peak-to-peak amplitude and the period of a trace.
+
+    period is None if the trace varies by less than min_amplitude or shows
+    fewer than two periods; cycles holds the number of rising crossings.
+    """
+    lo = float(ch.min())
+    hi = float(ch.max())
+    result = {'lo': lo, 'hi': hi, 'level': 0.5 * (lo + hi), 'amplitude': hi - lo, 'period': None, 'cycles': 0}
+    if hi - lo < min_amplitude:
+        return result
+    edges = triggers.schmitt_edges(ch, result['level'], 0.1 * (hi - lo), True)
+    result['cycles'] = len(edges)
+    if len(edges) < 3:
+        return result
+    spacing = np.diff(edges)
+    median = float(np.median(spacing))
+    if np.all(np.abs(spacing - median) < 0.2 * median):
+        result['period'] = median * sampling_interval
+        return result
+    analyzer = spectrum.SpectrumAnalyzer('Hann')
+    [freqs, log_freqs, levels] = analyzer.compute(ch - ch.mean(), sampling_interval)
+    peak = analyzer.find_peak(levels[0], freqs)
+    if (peak is not None) and (peak[0] * len(ch) * sampling_interval >= 2.):
+        result['period'] = 1. / peak[0]
+    return result
+
+
+class Autoset(object):
+    """Step-by-step autoset search on an oscope (or SimulatedScope).
+
+    start() configures and triggers the first sweep.  Each call of step()
+    returns None while a sweep is in progress; once the sweep is done, it
+    analyzes it and either triggers the next one and returns None, or
+    returns the result as a dict with the chosen sampling_interval,
+    ch1_range, ch2_range, trigger_source and trigger_level, the half width
+    of the view in seconds, the measured frequency (None for DC) and the
+    number of sweeps used.  The view is narrower than the default one when
+    even the fastest interval shows too many periods.  run() does the
+    whole search at once for scripts.
+    """
+
+    def __init__(self, dev, max_sweeps=8, min_amplitude=50e-3):
+        self.dev = dev
+        self.max_sweeps = max_sweeps
+        self.min_amplitude = min_amplitude
+        self.processor = frameprocessor.FrameProcessor(dev.SCOPE_BUFFER_SIZE // 2)
+
+    def start(self):
+        self.num_sweeps = 0
+        self.probes = list(PROBE_INTERVALS)
+        self.ranges = [0, 0]
+        self.apply(self.probes.pop(0), self.ranges)
+
+    def apply(self, interval, ranges):
+        dev = self.dev
+        if ranges[0] != dev.ch1_range:
+            dev.set_ch1range(ranges[0])
+        if ranges[1] != dev.ch2_range:
+            dev.set_ch2range(ranges[1])
+        # setting the interval also cancels a sweep in progress
+        dev.set_period(interval)
+        self.interval = interval
+        self.ranges = list(ranges)
+        dev.trigger_sweep()
+        self.num_sweeps += 1
+
+    def calibration(self, index):
+        dev = self.dev
+        ch_range = self.ranges[index]
+        if dev.sampling_interval == 0.25e-6:
+            zero = (dev.ch1_zero_4MSps, dev.ch2_zero_4MSps)[index][ch_range]
+            gain = (dev.ch1_gain_4MSps, dev.ch2_gain_4MSps)[index][ch_range]
+        else:
+            zero = (dev.ch1_zero, dev.ch2_zero)[index][dev.num_avg][ch_range]
+            gain = (dev.ch1_gain, dev.ch2_gain)[index][dev.num_avg][ch_range]
+        return [dev.volts_per_lsb[ch_range], gain, zero]
+
+    def capture(self):
+        count = self.processor.load(self.dev.get_bufferbin_raw(), self.dev.num_avg)
+        clipped = [bool(np.any(self.processor.raw[index, :count] == 0) or np.any(self.processor.raw[index, :count] >= 4095)) for index in range(2)]
+        return [[self.processor.scale(index, count, *self.calibration(index)) for index in range(2)], clipped]
+
+    def choose_ranges(self, analyses, clipped):
+        # The 2V range if the signal fits it with some margin, the 10V range
+        # otherwise or if it clipped on the 2V range.
+        ranges = []
+        for index in range(2):
+            peak = max(abs(analyses[index]['lo']), abs(analyses[index]['hi']))
+            fits = peak < 0.8 * 2048. * self.dev.volts_per_lsb[1]
+            ranges.append(1 if fits and not (clipped[index] and self.ranges[index] == 1) else 0)
+        return ranges
+
+    def result(self, analyses, source, period):
+        # without a period, go back to the first probe interval rather than 
+        # staying at the slow one
+        interval = self.dev.sampling_interval if period is not None else PROBE_INTERVALS[0]
+        view = 0.5 * VIEW_SAMPLES * interval
+        if period is not None:
+            view = min(view, 0.5 * TARGET_PERIODS * period)
+        return {'sampling_interval': interval, 'ch1_range': self.ranges[0], 'ch2_range': self.ranges[1],
+                'trigger_source': ('CH1', 'CH2')[source], 'trigger_level': analyses[source]['level'], 'view': view,
+                'frequency': None if period is None else 1. / period, 'sweeps': self.num_sweeps}
+
+    def step(self):
+        if self.dev.sweep_in_progress():
+            return None
+
+        sampling_interval = self.dev.sampling_interval
+        [chs, clipped] = self.capture()
+        analyses = [analyze(ch, sampling_interval, self.min_amplitude) for ch in chs]
+        ranges = self.choose_ranges(analyses, clipped)
+        out_of_sweeps = self.num_sweeps >= self.max_sweeps
+
+        periodic = [index for index in range(2) if analyses[index]['period'] is not None]
+        if not periodic:
+            # trigger on the channel with more going on
+            source = 0 if analyses[0]['amplitude'] >= analyses[1]['amplitude'] else 1
+            slow = [index for index in range(2) if analyses[index]['amplitude'] >= self.min_amplitude]
+            if slow and (self.interval < INTERVALS[-1]) and not out_of_sweeps:
+                self.apply(nearest_interval(min(100. * self.interval, INTERVALS[-1])), ranges)
+                return None
+            if (not slow) and self.probes and not out_of_sweeps:
+                self.apply(self.probes.pop(0), ranges)
+                return None
+            if (ranges != self.ranges) and not out_of_sweeps:
+                self.apply(self.interval, ranges)
+                return None
+            return self.result(analyses, source, None)
+
+        source = max(periodic, key=lambda index: analyses[index]['amplitude'] / (2048. * self.dev.volts_per_lsb[self.ranges[index]]))
+        period = analyses[source]['period']
+        target = target_interval(period)
+        if (target != self.interval) or (ranges != self.ranges) or any(clipped[index] and ranges[index] == 1 for index in range(2)):
+            if not out_of_sweeps:
+                self.apply(target, ranges)
+                return None
+        return self.result(analyses, source, period)
+
+    def run(self):
+        self.start()
+        while True:
+            result = self.step()
+            if result is not None:
+                return result
+
+
+if __name__ == '__main__':
+    import time
+
+    import simscope
+
+    signals = [('1 kHz sine, 1 V', simscope.sine(1., 1e3), None),
+               ('50 Hz sine, 8 V', simscope.sine(8., 50.), None),
+               ('5 Hz square, 3 V', simscope.square(3., 5.), None),
+               ('100 kHz square, 0.5 V + 1 V', simscope.square(0.5, 100e3, 1.), None),
+               ('200 kHz sine (aliases at 10 us)', simscope.sine(1., 200e3), None),
+               ('1 MHz sine (aliases to DC)', simscope.sine(1., 1e6), None),
+               ('3 kHz triangle, 15% duty square', simscope.triangle(1.8, 3e3), simscope.square(4., 3e3, 0., 0.15)),
+               ('sine with strong 3rd harmonic', lambda t: np.sin(2e4 * np.pi * t) + 0.9 * np.sin(6e4 * np.pi * t), None),
+               ('CH2 only, 20 kHz', None, simscope.sine(0.3, 20e3)),
+               ('DC 1.2 V', simscope.dc(1.2), None),
+               ('no signal', None, None)]
+
+    print('{:>34s} {:>10s} {:>6s} {:>6s} {:>9s} {:>7s} {:>6s} {:>10s}'.format('signal', 'interval', 'ranges', 'source', 'level', 'periods', 'sweeps', 'acq time'))
+    for name, ch1, ch2 in signals:
+        dev = simscope.SimulatedScope(ch1, ch2, seed=1)
+        autoset = Autoset(dev)
+        start = time.perf_counter()
+        result = autoset.run()
+        elapsed = time.perf_counter() - start
+        periods = None if result['frequency'] is None else 2. * result['view'] * result['frequency']
+        print('{:>34s} {:>10s} {:>6s} {:>6s} {:8.3f}V {:>7s} {:6d} {:9.3f}s'.format(name, '{:g}'.format(result['sampling_interval']),
+              '{},{}'.format(result['ch1_range'], result['ch2_range']), result['trigger_source'], result['trigger_level'],
+              '-' if periods is None else '{:.2f}'.format(periods), result['sweeps'], dev.dev.acquisition_time))
+        assert result['sweeps'] <= 5, name
+        assert elapsed < 1., name
+        if (periods is not None) and (result['sampling_interval'] != INTERVALS[-1]):
+            assert 2. <= periods <= 5., name
+    print('OK')
@@ -0,0 +1,531 @@
+"""
+Bode analysis for Whoa-Scope.
+Turns the raw buffer captured at one point of a Bode sweep into gain and
+phase, and keeps sweep archives: the raw buffers of every point of a sweep
+together with the settings they were captured with.  The live sweep and the
+offline re-analysis call the same functions on the same integers, so a
+sweep re-analyzed with the same estimator gives identical results, while a
+different CH2 skew correction or a different estimator can be tried later
+without re-running the physical sweep.
+
+Estimators fit the sine at the wavegen frequency in each channel: the
+original sliding one-period average, a three-parameter least-squares sine
+fit, a four-parameter fit that also tracks the frequency, and a single DFT
+bin over whole cycles.  Each reports the residual of its fit, from which
+the signal-to-noise ratio of the point is derived, so a sweep can
+re-acquire just the noisy points and average them.
+
+Archives are NumPy .npz files.  reanalyze() spreads the points of one or
+many archives over a process pool; run this module with archive paths as
+arguments to re-analyze them into CSV files next to them.
+"""
+
+import concurrent.futures
+import json
+import math
+import os
+
+import numpy as np
+
+
+# the CH2 sample is taken this long after the CH1 sample
+CH2_SKEW = 0.125e-6
+
+# per-point settings stored in an archive next to each buffer
+POINT_FIELDS = ('freq', 'sampling_interval', 'num_avg', 'ch1_range', 'ch2_range',
+                'ch1_volts_per_lsb', 'ch1_gain', 'ch1_zero', 'ch2_volts_per_lsb', 'ch2_gain', 'ch2_zero')
+
+# points per task handed to a worker process
+CHUNK_POINTS = 16
+
+# the gain and phase of each channel are within a few tenths of a dB and a
+# few degrees at this signal-to-noise ratio, once the noise is averaged
+# over the record
+DEFAULT_MIN_SNR = 30.
+
+
+def point_settings(dev):
+    """Return the settings of the sweep just captured by dev as a dict with the keys in POINT_FIELDS."""
+    ch1_range = dev.ch1_range
+    ch2_range = dev.ch2_range
+    if dev.sampling_interval == 0.25e-6:
+        ch1_zero = dev.ch1_zero_4MSps[ch1_range]
+        ch1_gain = dev.ch1_gain_4MSps[ch1_range]
+        ch2_zero = dev.ch2_zero_4MSps[ch2_range]
+        ch2_gain = dev.ch2_gain_4MSps[ch2_range]
+    else:
+        ch1_zero = dev.ch1_zero[dev.num_avg][ch1_range]
+        ch1_gain = dev.ch1_gain[dev.num_avg][ch1_range]
+        ch2_zero = dev.ch2_zero[dev.num_avg][ch2_range]
+        ch2_gain = dev.ch2_gain[dev.num_avg][ch2_range]
+    return {'freq': dev.get_freq(), 'sampling_interval': dev.sampling_interval, 'num_avg': dev.num_avg,
+            'ch1_range': ch1_range, 'ch2_range': ch2_range,
+            'ch1_volts_per_lsb': dev.volts_per_lsb[ch1_range], 'ch1_gain': ch1_gain, 'ch1_zero': ch1_zero,
+            'ch2_volts_per_lsb': dev.volts_per_lsb[ch2_range], 'ch2_gain': ch2_gain, 'ch2_zero': ch2_zero}
+
+
+def calibrate(buffer, settings):
+    """Return [ch1, ch2] in volts from a buffer of both channels, already shifted right by num_avg."""
+    buffer = np.asarray(buffer)
+    num_samples = len(buffer) // 2
+    ch1 = settings['ch1_volts_per_lsb'] * settings['ch1_gain'] * (buffer[:num_samples] - settings['ch1_zero'])
+    ch2 = settings['ch2_volts_per_lsb'] * settings['ch2_gain'] * (buffer[num_samples:] - settings['ch2_zero'])
+    return [ch1, ch2]
+
+
+def sliding_average(x, period):
+    """Return the mean over all start samples of the trapezoidal integral of x over one period, times 2 / period.
+
+    The period is in samples and need not be an integer; the fractional
+    part of the last sample interval is integrated with linear
+    interpolation.  For x = ch * sin(w t) this is A cos(phi) of ch.
+    """
+    whole = int(period)
+    frac = period - float(whole)
+    count = len(x) - whole - 1
+    if count <= 0:
+        raise ValueError('the record is shorter than one period')
+    sums = np.cumsum(np.concatenate(([0.], x)))
+    window = sums[whole:whole + count] - sums[:count]
+    last = x[whole:whole + count]
+    integrals = window - 0.5 * (x[:count] + last) + frac * (last + 0.5 * frac * (x[whole + 1:whole + 1 + count] - last))
+    return float(np.mean(2. * integrals / period))
+
+
+def references(num_samples, period):
+    """Return [sin, cos] of the phase of a sine with the given period in samples."""
+    w = 2. * math.pi / period * np.arange(num_samples)
+    return [np.sin(w), np.cos(w)]
+
+
+def residual_rms(ch, s, c, a, b):
+    """Return the RMS of ch after removing a * s + b * c and the mean."""
+    residual = ch - a * s - b * c
+    residual -= residual.mean()
+    return math.sqrt(float(np.dot(residual, residual)) / len(residual))
+
+
+class Estimator(object):
+    """Base class for estimators of the sine at freq in both channels.
+
+    fit(ch1, ch2, sampling_interval, freq) returns an array with a row of
+    [A cos(phi), A sin(phi), residual RMS] per channel, where the channel
+    is A sin(w t + phi) plus a constant and the residual, and t is zero at
+    the first sample.
+    """
+
+    name = ''
+
+    def fit(self, ch1, ch2, sampling_interval, freq):
+        raise NotImplementedError
+
+
+class SlidingEstimator(Estimator):
+    """Averages the products with a sine and cosine over every one-period window of the record."""
+
+    name = 'Sliding'
+
+    def fit(self, ch1, ch2, sampling_interval, freq):
+        period = 1. / (sampling_interval * freq)
+        [s, c] = references(len(ch1), period)
+        coefficients = np.zeros((2, 3))
+        for index, ch in enumerate((ch1, ch2)):
+            a = sliding_average(ch * s, period)
+            b = sliding_average(ch * c, period)
+            coefficients[index] = [a, b, residual_rms(ch, s, c, a, b)]
+        return coefficients
+
+
+class SineFitEstimator(Estimator):
+    """Least-squares fit of a sine and cosine at freq plus a constant, for both channels in one solve."""
+
+    name = 'Sine Fit'
+
+    def solve(self, ch1, ch2, s, c):
+        design = np.column_stack((s, c, np.ones(len(s))))
+        [solution, residues, rank, singular] = np.linalg.lstsq(design, np.column_stack((ch1, ch2)), rcond=None)
+        coefficients = np.zeros((2, 3))
+        coefficients[:, :2] = solution[:2].T
+        if len(residues) == 2:
+            coefficients[:, 2] = np.sqrt(residues / len(s))
+        else:
+            coefficients[:, 2] = [residual_rms(ch, s, c, a, b) for ch, [a, b] in zip((ch1, ch2), solution[:2].T)]
+        return coefficients
+
+    def fit(self, ch1, ch2, sampling_interval, freq):
+        [s, c] = references(len(ch1), 1. / (sampling_interval * freq))
+        return self.solve(ch1, ch2, s, c)
+
+
+class FourParameterSineFitEstimator(SineFitEstimator):
+    """Sine fit that first refines the frequency on the larger channel by Gauss-Newton steps.
+
+    This absorbs a mismatch between the wavegen clock and the sampling
+    clock, which leaves a residual beat in the three-parameter fit.
+    """
+
+    name = 'Sine Fit 4P'
+
+    def __init__(self, iterations=3):
+        self.iterations = iterations
+
+    def fit(self, ch1, ch2, sampling_interval, freq):
+        n = np.arange(len(ch1), dtype=np.float64)
+        w = 2. * math.pi * sampling_interval * freq
+        ch = ch1 if np.ptp(ch1) >= np.ptp(ch2) else ch2
+        for iteration in range(self.iterations):
+            s = np.sin(w * n)
+            c = np.cos(w * n)
+            [[a, b, residual], unused] = self.solve(ch, ch, s, c)
+            # the derivative of a sin(w n) + b cos(w n) with respect to w
+            design = np.column_stack((s, c, np.ones(len(n)), n * (a * c - b * s)))
+            step = np.linalg.lstsq(design, ch, rcond=None)[0][3]
+            # a step beyond a quarter cycle over the record means the fit
+            # has locked onto noise; keep the last frequency
+            if abs(step) * len(n) > 0.5 * math.pi:
+                break
+            w += step
+        return self.solve(ch1, ch2, np.sin(w * n), np.cos(w * n))
+
+
+class DFTBinEstimator(Estimator):
+    """Single DFT bin at freq, over the whole cycles at the start of the record.
+
+    The same sum as the Goertzel recurrence, done as one dot product with
+    the references.
+    """
+
+    name = 'DFT Bin'
+
+    def fit(self, ch1, ch2, sampling_interval, freq):
+        period = 1. / (sampling_interval * freq)
+        count = len(ch1)
+        cycles = math.floor(count / period)
+        if cycles >= 1:
+            count = min(int(round(cycles * period)), count)
+        [s, c] = references(count, period)
+        coefficients = np.zeros((2, 3))
+        for index, ch in enumerate((ch1[:count], ch2[:count])):
+            x = ch - ch.mean()
+            a = 2. * float(np.dot(x, s)) / count
+            b = 2. * float(np.dot(x, c)) / count
+            coefficients[index] = [a, b, residual_rms(ch, s, c, a, b)]
+        return coefficients
+
+
+ESTIMATORS = {estimator.name: estimator for estimator in (SlidingEstimator(), SineFitEstimator(), FourParameterSineFitEstimator(), DFTBinEstimator())}
+# the sliding average is thrown off by the wavegen offset when the record
+# does not hold whole periods; see the benchmark below
+DEFAULT_ESTIMATOR = 'Sine Fit'
+
+
+def transfer(coefficients, freq, ch2_skew=CH2_SKEW):
+    """Return [gain in dB, phase in degrees, SNR in dB] of ch2 relative to ch1 from the coefficients of an estimator.
+
+    The phase of CH2 is corrected for ch2_skew.  The SNR is that of the
+    noisier channel, signal RMS over residual RMS.
+    """
+    [[ch1_AcosPhi, ch1_AsinPhi, ch1_residual], [ch2_AcosPhi, ch2_AsinPhi, ch2_residual]] = coefficients.tolist()
+
+    ch2_offset = 2. * math.pi * ch2_skew * freq
+    ch2_AcosPhi, ch2_AsinPhi = ch2_AcosPhi * math.cos(ch2_offset) + ch2_AsinPhi * math.sin(ch2_offset), ch2_AsinPhi * math.cos(ch2_offset) - ch2_AcosPhi * math.sin(ch2_offset)
+
+    ch1_A = math.sqrt(ch1_AcosPhi ** 2 + ch1_AsinPhi ** 2)
+    ch2_A = math.sqrt(ch2_AcosPhi ** 2 + ch2_AsinPhi ** 2)
+
+    gain = 20. * math.log10(ch2_A / ch1_A)
+    sign = 1. if ch1_AcosPhi * ch2_AsinPhi - ch1_AsinPhi * ch2_AcosPhi >= 0. else -1.
+    # rounding can put the cosine just outside [-1, 1]
+    cos_phase = min(max((ch1_AcosPhi * ch2_AcosPhi + ch1_AsinPhi * ch2_AsinPhi) / (ch1_A * ch2_A), -1.), 1.)
+    phase = sign * 180. * math.acos(cos_phase) / math.pi
+    snr = min(20. * math.log10(A / (math.sqrt(2.) * residual)) if residual > 0. else math.inf for A, residual in ((ch1_A, ch1_residual), (ch2_A, ch2_residual)))
+    return [gain, phase, snr]
+
+
+def gain_phase(ch1, ch2, sampling_interval, freq, ch2_skew=CH2_SKEW, estimator=DEFAULT_ESTIMATOR):
+    """Return [gain in dB, phase in degrees, SNR in dB] of ch2 relative to ch1 at freq, using the named estimator."""
+    return transfer(ESTIMATORS[estimator].fit(ch1, ch2, sampling_interval, freq), freq, ch2_skew)
+
+
+def analyze_point(buffer, settings, ch2_skew=CH2_SKEW, estimator=DEFAULT_ESTIMATOR):
+    """Return [freq, gain, phase, snr] for one raw sweep buffer and its settings."""
+    [ch1, ch2] = calibrate(buffer, settings)
+    return [settings['freq']] + gain_phase(ch1, ch2, settings['sampling_interval'], settings['freq'], ch2_skew, estimator)
+
+
+def analyze_points(buffers, settings, ch2_skew=CH2_SKEW, estimator=DEFAULT_ESTIMATOR):
+    """Return an array of [freq, gain, phase, snr] rows for the buffers, given settings as a dict of arrays."""
+    results = np.zeros((len(buffers), 4))
+    for index in range(len(buffers)):
+        point = {name: settings[name][index].item() for name in POINT_FIELDS}
+        results[index] = analyze_point(buffers[index], point, ch2_skew, estimator)
+    return results
+
+
+def combine(rows):
+    """Return the [freq, gain, phase, snr] row averaging repeated acquisitions of one point.
+
+    The complex transfer functions are averaged, since the acquisitions
+    start at unrelated phases of the signal, and the noise powers add up
+    to the SNR of the average.  A single row is returned unchanged.
+    """
+    if len(rows) == 1:
+        return list(rows[0])
+    rows = np.asarray(rows)
+    h = np.mean(10. ** (rows[:, 1] / 20.) * np.exp(1j * np.radians(rows[:, 2])))
+    noise = np.mean(10. ** (-rows[:, 3] / 10.)) / len(rows)
+    snr = -10. * math.log10(noise) if noise > 0. else math.inf
+    return [float(rows[0, 0]), 20. * math.log10(abs(h)), math.degrees(np.angle(h)), snr]
+
+
+def combine_points(rows, points):
+    """Return the rows combined per point, in the order the points first appear."""
+    order = []
+    groups = {}
+    for row, point in zip(rows, points):
+        if point not in groups:
+            order.append(point)
+            groups[point] = []
+        groups[point].append(row)
+    return np.array([combine(groups[point]) for point in order]).reshape(len(order), 4)
+
+
+class SweepArchive(object):
+    """The raw buffers of a Bode sweep with the settings of every point.
+
+    info holds settings of the sweep as a whole, such as the wavegen
+    amplitude and offset and the estimator the sweep was analyzed with,
+    and must be JSON serializable.  Repeated acquisitions of a sweep point
+    share its number in points.  Analyses use the archived estimator
+    unless given another.
+    """
+
+    def __init__(self, info=None):
+        self.info = dict(info or {})
+        self.buffers = []
+        self.points = []
+        self.settings = {name: [] for name in POINT_FIELDS}
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def append(self, buffer, settings, point=None):
+        self.buffers.append(np.asarray(buffer, dtype=np.uint16))
+        self.points.append(len(self.points) if point is None else int(point))
+        for name in POINT_FIELDS:
+            self.settings[name].append(settings[name])
+
+    def arrays(self):
+        """Return [buffers, settings] with the buffers stacked and each setting as an array."""
+        buffers = np.array(self.buffers, dtype=np.uint16).reshape(len(self.buffers), -1)
+        return [buffers, {name: np.array(self.settings[name]) for name in POINT_FIELDS}]
+
+    def save(self, path):
+        [buffers, settings] = self.arrays()
+        np.savez_compressed(path, buffers=buffers, points=np.array(self.points, dtype=np.int64), info=np.array(json.dumps(self.info)), **settings)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            archive = cls(json.loads(str(data['info'])))
+            archive.buffers = list(data['buffers'])
+            archive.points = list(data['points']) if 'points' in data else list(range(len(archive.buffers)))
+            archive.settings = {name: list(data[name]) for name in POINT_FIELDS}
+        return archive
+
+    @property
+    def estimator(self):
+        """The estimator of the live sweep, or the default for archives that do not record one."""
+        estimator = self.info.get('estimator', DEFAULT_ESTIMATOR)
+        return estimator if estimator in ESTIMATORS else DEFAULT_ESTIMATOR
+
+    def analyze(self, ch2_skew=CH2_SKEW, estimator=None):
+        """Return an array of [freq, gain, phase, snr] rows per point, in the order the points were captured."""
+        [buffers, settings] = self.arrays()
+        return combine_points(analyze_points(buffers, settings, ch2_skew, estimator or self.estimator), self.points)
+
+
+def reanalyze(archives, ch2_skew=CH2_SKEW, estimator=None, max_workers=None):
+    """Re-analyze archives, given as SweepArchive objects or paths, on a process pool.
+
+    Returns one array of [freq, gain, phase, snr] rows per archive.  The buffers
+    of all archives are split into chunks of CHUNK_POINTS, so a single long
+    archive is spread over the pool as well as a batch of short ones.
+    """
+    archives = [SweepArchive.load(archive) if isinstance(archive, (str, os.PathLike)) else archive for archive in archives]
+    tasks = []
+    for number, archive in enumerate(archives):
+        [buffers, settings] = archive.arrays()
+        for start in range(0, len(buffers), CHUNK_POINTS):
+            chunk = {name: values[start:start + CHUNK_POINTS] for name, values in settings.items()}
+            tasks.append((number, buffers[start:start + CHUNK_POINTS], chunk, estimator or archive.estimator))
+    results = [[] for archive in archives]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(analyze_points, buffers, chunk, ch2_skew, chunk_estimator) for number, buffers, chunk, chunk_estimator in tasks]
+        for [number, buffers, chunk, chunk_estimator], future in zip(tasks, futures):
+            results[number].append(future.result())
+    rows = [np.concatenate(chunks) if chunks else np.zeros((0, 4)) for chunks in results]
+    return [combine_points(archive_rows, archive.points) for archive_rows, archive in zip(rows, archives)]
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    if len(sys.argv) > 1:
+        import argparse
+
+        parser = argparse.ArgumentParser(description='Re-analyze Bode sweep archives into CSV files next to them.')
+        parser.add_argument('archives', nargs='+')
+        parser.add_argument('--estimator', choices=list(ESTIMATORS), default=None, help='estimator to use instead of the one the sweep was analyzed with')
+        parser.add_argument('--skew', type=float, default=CH2_SKEW, help='CH2 sample skew in seconds')
+        args = parser.parse_args()
+        for path, results in zip(args.archives, reanalyze(args.archives, args.skew, args.estimator)):
+            csv_path = os.path.splitext(path)[0] + '.csv'
+            np.savetxt(csv_path, results[np.argsort(results[:, 0])], delimiter=',', header='freq,gain,phase,snr', comments='')
+            print('{}: {} points -> {}'.format(path, len(results), csv_path))
+        sys.exit()
+
+    import simscope
+
+    def reference_gain_phase(ch1, ch2, sampling_interval, freq):
+        # the demodulation as BodeRoot.process_buffer did it, one Python sum
+        # per window
+        num_samples = len(ch1)
+        per_est = 1. / (sampling_interval * freq)
+        per_est_int = int(per_est)
+        per_est_frac = per_est - float(per_est_int)
+        Z = range(num_samples)
+        s = [math.sin(2. * math.pi * i / per_est) for i in Z]
+        c = [math.cos(2. * math.pi * i / per_est) for i in Z]
+        values = []
+        for x in ([ch1[i] * s[i] for i in Z], [ch1[i] * c[i] for i in Z], [ch2[i] * s[i] for i in Z], [ch2[i] * c[i] for i in Z]):
+            windows = [2. * (sum(x[i:i + per_est_int]) - 0.5 * (x[i] + x[i + per_est_int]) + per_est_frac * (x[i + per_est_int] + 0.5 * per_est_frac * (x[i + per_est_int + 1] - x[i + per_est_int]))) / per_est for i in range(num_samples - per_est_int - 1)]
+            values.append(sum(windows) / float(len(windows)))
+        [ch1_AcosPhi, ch1_AsinPhi, ch2_AcosPhi, ch2_AsinPhi] = values
+        ch2_offset = 2. * math.pi * 0.125e-6 * freq
+        ch2_AcosPhi, ch2_AsinPhi = ch2_AcosPhi * math.cos(ch2_offset) + ch2_AsinPhi * math.sin(ch2_offset), ch2_AsinPhi * math.cos(ch2_offset) - ch2_AcosPhi * math.sin(ch2_offset)
+        ch1_A = math.sqrt(ch1_AcosPhi ** 2 + ch1_AsinPhi ** 2)
+        ch2_A = math.sqrt(ch2_AcosPhi ** 2 + ch2_AsinPhi ** 2)
+        sign = 1. if ch1_AcosPhi * ch2_AsinPhi - ch1_AsinPhi * ch2_AcosPhi >= 0. else -1.
+        return [20. * math.log10(ch2_A / ch1_A), sign * 180. * math.acos((ch1_AcosPhi * ch2_AcosPhi + ch1_AsinPhi * ch2_AsinPhi) / (ch1_A * ch2_A)) / math.pi]
+
+    def rc_lowpass(freq, corner=1e3):
+        # CH1 drives an RC low-pass whose output is on CH2
+        h = 1. / (1. + 1j * freq / corner)
+        return [simscope.sine(1., freq), lambda t: abs(h) * np.sin(2. * math.pi * freq * t + np.angle(h))]
+
+    # a sweep as BodeRoot runs it, archived as it goes
+    dev = simscope.SimulatedScope(seed=0)
+    dev.set_ch1range(1)
+    dev.set_ch2range(1)
+    archive = SweepArchive({'amplitude': 1., 'offset': 2.5})
+    live = []
+    live_time = 0.
+    reference_time = 0.
+    for target in np.logspace(1., 5., 41):
+        dev.set_freq(target)
+        dev.dev.set_signals(*rc_lowpass(dev.get_freq()))
+        dev.set_period(12. / (dev.SCOPE_BUFFER_SIZE * target))
+        buffer = np.array(dev.trigger(), dtype=np.uint16)
+        settings = point_settings(dev)
+        start = time.perf_counter()
+        sliding = analyze_point(buffer, settings, estimator='Sliding')
+        live_time += time.perf_counter() - start
+        live.append(analyze_point(buffer, settings))
+        archive.append(buffer, settings)
+        [ch1, ch2] = calibrate(buffer, settings)
+        start = time.perf_counter()
+        expected = reference_gain_phase(list(ch1), list(ch2), settings['sampling_interval'], settings['freq'])
+        reference_time += time.perf_counter() - start
+        assert abs(sliding[1] - expected[0]) < 1e-9 and abs(sliding[2] - expected[1]) < 1e-9, 'demodulation differs from the original'
+    live = np.array(live)
+    [true_gain, true_phase] = [20. * np.log10(np.abs(1. / (1. + 1j * live[:, 0] / 1e3))), np.degrees(np.angle(1. / (1. + 1j * live[:, 0] / 1e3)))]
+    print('{} points, sliding average {:.2f} ms/point (was {:.1f} ms/point), sine fit worst error {:.3f} dB, {:.2f} degrees'.format(
+        len(live), 1e3 * live_time / len(live), 1e3 * reference_time / len(live), np.abs(live[:, 1] - true_gain).max(), np.abs(live[:, 2] - true_phase).max()))
+
+    # saved and re-analyzed offline, alone and in a batch, on a pool
+    import tempfile
+    folder = tempfile.TemporaryDirectory()
+    path = os.path.join(folder.name, 'bodeanalysis_selfcheck.npz')
+    archive.save(path)
+    loaded = SweepArchive.load(path)
+    assert loaded.info == archive.info and len(loaded) == len(archive)
+    assert np.array_equal(loaded.analyze(), live), 'archive does not reproduce the live results'
+    batch = [path] * 8
+    start = time.perf_counter()
+    results = reanalyze(batch)
+    elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    serial = [SweepArchive.load(archive).analyze() for archive in batch]
+    serial_elapsed = time.perf_counter() - start
+    print('{} archives re-analyzed in {:.3f} s on {} processes ({:.3f} s serially)'.format(len(batch), elapsed, os.cpu_count(), serial_elapsed))
+    assert all(np.array_equal(result, live) for result in results + serial), 'pool results differ from the live results'
+
+    # a different skew correction moves only the phase
+    unskewed = loaded.analyze(ch2_skew=0.)
+    assert np.allclose(unskewed[:, 1], live[:, 1], rtol=0., atol=1e-9)
+    assert abs((live[-1, 2] - unskewed[-1, 2]) + 360. * CH2_SKEW * live[-1, 0]) < 1e-6
+
+    # the archived estimator is used unless another is given
+    archive.info['estimator'] = 'Sliding'
+    archive.save(path)
+    sliding = SweepArchive.load(path).analyze(estimator='Sliding')
+    assert not np.array_equal(sliding, live)
+    assert all(np.array_equal(result, sliding) for result in [SweepArchive.load(path).analyze()] + reanalyze([path, archive]))
+    assert np.array_equal(reanalyze([path], estimator=DEFAULT_ESTIMATOR)[0], live)
+    folder.cleanup()
+
+    # estimator accuracy and cost on synthetic points: 1 V on CH1 and a
+    # -40 dB, -60 degree response on CH2 with 1 mV of noise, a DC offset and
+    # a non-integer number of periods in the record
+    rng = np.random.default_rng(1)
+    num_samples = dev.SCOPE_BUFFER_SIZE // 2
+    n = np.arange(num_samples)
+    true_gain = -40.
+    true_phase = -60.
+    noise = 1e-3
+    cases = [('6.3 periods', 6.3 / num_samples, 0.),
+             ('2.4 periods', 2.4 / num_samples, 0.),
+             ('6.3 periods, 1% frequency error', 6.3 / num_samples, 1e-2)]
+    print('{:>34s} {:>12s} {:>10s} {:>10s} {:>8s} {:>9s}'.format('case', 'estimator', 'gain err', 'phase err', 'SNR', 'us/point'))
+    errors = {}
+    for case, cycles_per_sample, clock_error in cases:
+        for name in ESTIMATORS:
+            gain_errors = []
+            phase_errors = []
+            snrs = []
+            elapsed = 0.
+            for trial in range(50):
+                phase0 = rng.uniform(0., 2. * math.pi)
+                w = 2. * math.pi * cycles_per_sample * (1. + clock_error)
+                ch1 = 2.5 + np.sin(w * n + phase0) + noise * rng.standard_normal(num_samples)
+                ch2 = 2.5 + 10. ** (true_gain / 20.) * np.sin(w * n + phase0 + math.radians(true_phase)) + noise * rng.standard_normal(num_samples)
+                start = time.perf_counter()
+                [gain, phase, snr] = gain_phase(ch1, ch2, 1., cycles_per_sample, 0., name)
+                elapsed += time.perf_counter() - start
+                gain_errors.append(gain - true_gain)
+                phase_errors.append(phase - true_phase)
+                snrs.append(snr)
+            errors[case, name] = [math.sqrt(np.mean(np.square(gain_errors))), math.sqrt(np.mean(np.square(phase_errors))), float(np.median(snrs))]
+            print('{:>34s} {:>12s} {:8.3f}dB {:9.2f}° {:6.1f}dB {:9.1f}'.format(case, name, errors[case, name][0], errors[case, name][1], errors[case, name][2], 1e6 * elapsed / 50))
+    # 10 mV peak over 1 mV RMS of noise
+    expected_snr = 20. * math.log10(10e-3 / math.sqrt(2.) / noise)
+    assert all(abs(errors[cases[0][0], name][2] - expected_snr) < 1. for name in ('Sine Fit', 'Sine Fit 4P', 'DFT Bin')), 'reported SNR is off'
+    for case, cycles_per_sample, clock_error in cases:
+        assert errors[case, 'Sine Fit'][0] <= 1.2 * errors[case, 'Sliding'][0] + 1e-3
+        assert errors[case, 'Sine Fit 4P'][1] <= 1.2 * errors[case, 'Sine Fit'][1] + 0.05
+    assert errors[cases[2][0], 'Sine Fit 4P'][0] < errors[cases[2][0], 'Sine Fit'][0]
+
+    # averaging repeated acquisitions of a noisy point raises its SNR by
+    # 10 log10(N) and does not bias it
+    rows = []
+    for trial in range(4):
+        ch1 = np.sin(2. * math.pi * n / 250. + trial)
+        ch2 = 10. ** (true_gain / 20.) * np.sin(2. * math.pi * n / 250. + trial + math.radians(true_phase)) + noise * rng.standard_normal(num_samples)
+        rows.append([1e3] + gain_phase(ch1, ch2, 4e-6, 1e3, 0., 'Sine Fit'))
+    combined = combine(rows)
+    assert abs(combined[3] - np.mean([row[3] for row in rows]) - 10. * math.log10(4.)) < 1.
+    assert abs(combined[1] - true_gain) < 0.3 and abs(combined[2] - true_phase) < 2.
+    assert combine(rows[:1]) == rows[0]
+    print('OK')
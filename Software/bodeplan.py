@@ -0,0 +1,199 @@
+"""
+Acquisition planner for Whoa-Scope Bode sweeps.
+Chooses the sampling interval and the device averaging for each point of a
+Bode sweep instead of capturing about six cycles at every frequency.  The
+interval is picked from the settings that the sampling timer can actually
+produce, so that the record holds a whole number of cycles, and the number
+of cycles is reduced at low frequencies to keep each point within a wall
+time budget.  Device averaging is raised just enough to reach a target
+signal-to-noise ratio, predicted from the SNR measured at the previous
+point.  The time a sweep will take follows from the plans of its points,
+so it can be reported before the sweep starts.
+"""
+
+import math
+
+import numpy as np
+
+import bodeanalysis
+
+
+# serial round trips, the buffer transfer and the UI scheduling per point
+DEFAULT_OVERHEAD = 0.08
+
+# largest value of the period register
+MAX_PR2 = 65535
+# PR2 at the 4MSps mode
+FAST_PR2 = 3
+
+# fewest samples per cycle
+MIN_SAMPLES_PER_CYCLE = 4
+
+
+class AcquisitionPlanner(object):
+    """Per-point sampling interval and averaging for a Bode sweep on an oscope (or SimulatedScope).
+
+    plan() returns a dict with the register values PR2 and T2CON, the
+    sampling interval, the number of cycles in the record, max_avg and the
+    num_avg that the firmware will use with it, and the predicted time of
+    the point.  Records hold target_cycles cycles unless that takes longer
+    than max_point_time, in which case they hold fewer but never fewer
+    than min_cycles.  Cycle counts within tolerance of a whole number are
+    treated as whole.  The PR2 and num_avg that the firmware will use for
+    a setting come from the driver's acquire_mode(), so that the planner
+    follows the driver when the firmware changes.
+    """
+
+    def __init__(self, dev, target_cycles=6, min_cycles=2, max_point_time=1., target_snr=bodeanalysis.DEFAULT_MIN_SNR, overhead=DEFAULT_OVERHEAD, tolerance=0.01):
+        self.num_samples = dev.SCOPE_BUFFER_SIZE // 2
+        self.timer_multipliers = dev.timer_multipliers
+        self.avg_Tcy_thresholds = dev.avg_Tcy_thresholds
+        self.acquire_mode = dev.acquire_mode
+        self.target_cycles = target_cycles
+        self.min_cycles = min_cycles
+        self.max_point_time = max_point_time
+        self.target_snr = target_snr
+        self.overhead = overhead
+        self.tolerance = tolerance
+
+    def interval(self, PR2, T2CON):
+        return self.timer_multipliers[(T2CON & 0x0030) >> 4] * (PR2 + 1.)
+
+    def averaging(self, snr, snr_num_avg):
+        """Return the max_avg that lifts snr, measured with snr_num_avg, to the target; each doubling of the samples adds 3 dB."""
+        if snr is None:
+            return 0
+        for max_avg in range(len(self.avg_Tcy_thresholds)):
+            if snr + 10. * math.log10(2.) * (max_avg - snr_num_avg) >= self.target_snr:
+                return max_avg
+        return len(self.avg_Tcy_thresholds) - 1
+
+    def cycle_range(self, freq):
+        # the fewest cycles the fastest interval can hold, and the most
+        # that fit within the time budget
+        fastest = self.num_samples * self.interval(FAST_PR2, 0) * freq
+        most = self.target_cycles if self.target_cycles <= self.max_point_time * freq else math.floor(self.max_point_time * freq)
+        least = max(self.min_cycles, math.ceil(fastest - self.tolerance))
+        return [least, max(least, most)]
+
+    def candidates(self, freq, max_avg):
+        """Return (PR2, T2CON, cycles) for the timer settings near whole numbers of cycles.
+
+        Beyond the budget, counts up to four times the fewest possible are
+        tried as well, for high frequencies where the intervals near the
+        fastest one cannot hold a whole number of cycles.
+        """
+        found = {}
+        [least, most] = self.cycle_range(freq)
+        top = max(most, min(4 * least, self.num_samples // MIN_SAMPLES_PER_CYCLE))
+        for cycles in range(least, top + 1):
+            for index, multiplier in enumerate(self.timer_multipliers):
+                T2CON = index << 4
+                ideal = cycles / (multiplier * freq * self.num_samples) - 1.
+                for PR2 in (math.floor(ideal), math.ceil(ideal)):
+                    if not 0 <= PR2 <= MAX_PR2:
+                        continue
+                    [PR2, num_avg] = self.acquire_mode(PR2, T2CON, max_avg)
+                    actual = self.num_samples * self.interval(PR2, T2CON) * freq
+                    if (actual >= self.min_cycles - self.tolerance) and (actual * MIN_SAMPLES_PER_CYCLE <= self.num_samples):
+                        found[PR2, T2CON] = actual
+        return [(PR2, T2CON, cycles) for (PR2, T2CON), cycles in found.items()]
+
+    def plan(self, freq, snr=None, snr_num_avg=0):
+        """Return the plan for one point at freq, given the SNR measured at the previous point if any."""
+        max_avg = self.averaging(snr, snr_num_avg)
+        candidates = self.candidates(freq, max_avg)
+        if not candidates:
+            # slower than the slowest interval can cover; take the slowest
+            candidates = [(MAX_PR2, 0x0030, self.num_samples * self.interval(MAX_PR2, 0x0030) * freq)]
+        [least, most] = self.cycle_range(freq)
+        errors = np.array([abs(cycles - round(cycles)) for PR2, T2CON, cycles in candidates])
+        whole = [candidate for candidate, error in zip(candidates, errors) if error <= max(self.tolerance, errors.min())]
+        # the most cycles within the budget, and otherwise the fewest; for
+        # the same cycles the finer prescaler
+        within = [candidate for candidate in whole if candidate[2] <= most + self.tolerance]
+        if within:
+            [PR2, T2CON, cycles] = max(within, key=lambda candidate: (round(candidate[2]), -candidate[1]))
+        else:
+            [PR2, T2CON, cycles] = min(whole, key=lambda candidate: (round(candidate[2]), candidate[1]))
+        [PR2, num_avg] = self.acquire_mode(PR2, T2CON, max_avg)
+        interval = self.interval(PR2, T2CON)
+        return {'freq': freq, 'PR2': PR2, 'T2CON': T2CON, 'interval': interval, 'cycles': cycles,
+                'max_avg': max_avg, 'num_avg': num_avg, 'time': self.num_samples * interval + self.overhead}
+
+    def apply(self, dev, plan):
+        """Configure dev for a plan; setting the interval also cancels a sweep in progress."""
+        if plan['max_avg'] != dev.max_avg:
+            dev.set_max_avg(plan['max_avg'])
+        dev.set_interval_vals(plan['PR2'], plan['T2CON'])
+
+    def sweep_time(self, freqs, snr=None, snr_num_avg=0):
+        """Return the predicted time of a sweep over freqs with one acquisition per point."""
+        return sum(self.plan(freq, snr, snr_num_avg)['time'] for freq in freqs)
+
+
+if __name__ == '__main__':
+    import time
+
+    import simscope
+
+    dev = simscope.SimulatedScope(seed=0)
+    planner = AcquisitionPlanner(dev)
+    num_samples = dev.SCOPE_BUFFER_SIZE // 2
+
+    def fixed_period(freq):
+        # what BodeRoot did before: six cycles, whatever the frequency
+        return 12. / (dev.SCOPE_BUFFER_SIZE * freq)
+
+    print('{:>10s} {:>10s} {:>9s} {:>8s} {:>10s} {:>9s} {:>8s}'.format('freq', 'interval', 'cycles', 'time', 'old int.', 'old cyc.', 'old time'))
+    for freq in (0.05, 0.3, 1., 3.7, 10., 123., 1e3, 12.3e3, 50e3, 100e3, 200e3):
+        plan = planner.plan(freq)
+        planner.apply(dev, plan)
+        assert dev.interval_vals == [plan['PR2'], plan['T2CON']] and dev.sampling_interval == plan['interval']
+        dev.set_period(fixed_period(freq))
+        old_cycles = num_samples * dev.sampling_interval * freq
+        print('{:>10s} {:>10s} {:9.3f} {:7.2f}s {:>10s} {:9.3f} {:7.2f}s'.format('{:g}'.format(freq), '{:.4g}'.format(plan['interval']), plan['cycles'], plan['time'],
+              '{:.4g}'.format(dev.sampling_interval), old_cycles, num_samples * dev.sampling_interval + DEFAULT_OVERHEAD))
+        assert abs(plan['cycles'] - round(plan['cycles'])) <= planner.tolerance or freq > 100e3, freq
+        assert plan['cycles'] >= planner.min_cycles - planner.tolerance
+        assert (plan['time'] <= planner.max_point_time + planner.overhead + 1e-9) or (round(plan['cycles']) == planner.min_cycles), freq
+        assert plan['interval'] * freq <= 0.25, 'fewer than 4 samples per cycle'
+
+    # the default sweep of the Bode window, 101 points from 1 Hz to 100 kHz
+    freqs = np.logspace(0., 5., 101)
+    predicted = planner.sweep_time(freqs)
+    old = 0.
+    for freq in freqs:
+        dev.set_period(fixed_period(freq))
+        old += num_samples * dev.sampling_interval + DEFAULT_OVERHEAD
+    # and the measured acquisition time of the same sweep on the simulator
+    dev.dev.acquisition_time = 0.
+    start = time.perf_counter()
+    plans = [planner.plan(freq) for freq in freqs]
+    elapsed = time.perf_counter() - start
+    for plan in plans:
+        planner.apply(dev, plan)
+        dev.trigger_sweep()
+    print('1 Hz to 100 kHz, 101 points: predicted {:.1f} s (six cycles per point: {:.1f} s); planned in {:.1f} ms'.format(predicted, old, 1e3 * elapsed))
+    assert abs(dev.dev.acquisition_time + DEFAULT_OVERHEAD * len(freqs) - predicted) < 1e-6
+    assert predicted < 0.6 * old
+
+    # whole cycles make the estimators agree with the sliding average
+    freq = 123.
+    dev.set_freq(freq)
+    dev.dev.set_signals(simscope.sine(1., dev.get_freq()), simscope.sine(0.5, dev.get_freq(), 0.5))
+    planner.apply(dev, planner.plan(dev.get_freq()))
+    buffer = dev.trigger()
+    settings = bodeanalysis.point_settings(dev)
+    for estimator in bodeanalysis.ESTIMATORS:
+        [f, gain, phase, snr] = bodeanalysis.analyze_point(buffer, settings, estimator=estimator)
+        assert abs(gain + 20. * math.log10(2.)) < 0.05 and abs(phase) < 0.5, estimator
+
+    # averaging just enough to reach the target SNR
+    assert planner.plan(1e3, 40.)['max_avg'] == 0
+    assert planner.plan(1e3, 25., 0)['max_avg'] == 2
+    assert planner.plan(1e3, 25., 1)['max_avg'] == 3
+    assert planner.plan(1e3, 0.)['max_avg'] == 4
+    # the 4MSps interval cannot average, so the firmware drops it
+    assert planner.plan(150e3, 25.)['num_avg'] == 0
+    print('OK')
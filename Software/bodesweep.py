@@ -0,0 +1,173 @@
+"""
+Adaptive Bode sweep for Whoa-Scope.
+Chooses the frequencies of a Bode measurement as it goes instead of
+measuring a fixed logarithmic grid.  The sweep starts with a coarse grid
+and then repeatedly splits, at its midpoint on a log scale, the interval
+where the response changes fastest: where gain or phase change between
+neighbouring points by more than a tolerance, or where a point lies far
+from the straight line through its neighbours, which is what a resonance
+or a corner looks like on a coarse grid.  It stops when every interval is
+within tolerance or the point budget is used up, so flat stretches get a
+few points and features get most of them.
+
+The sweep only does the bookkeeping; the caller measures each frequency
+returned by next_frequency() and hands the result back with add().
+"""
+
+import math
+
+import numpy as np
+
+
+# deviations from the line through the neighbours are held to a quarter of
+# the tolerance on the change between neighbours, since a point that bends
+# the curve that much is already visible as a kink
+CURVATURE_FRACTION = 0.25
+
+
+def wrap_phase(phase):
+    """Return phase differences in degrees wrapped to [-180, 180)."""
+    return (np.asarray(phase) + 180.) % 360. - 180.
+
+
+class AdaptiveSweep(object):
+    """Frequency plan of an adaptive sweep from start_freq to end_freq.
+
+    The first initial_points frequencies are a logarithmic grid; after
+    those, each frequency is the log midpoint of the worst interval.
+    gain_tolerance is in dB and phase_tolerance in degrees.  Intervals
+    narrower than min_spacing decades are not split further.  Frequencies
+    are reported back to add() as the targets returned by next_frequency()
+    rather than the frequency the wavegen actually produced, so that the
+    plan does not depend on the frequency resolution of the board.
+    """
+
+    def __init__(self, start_freq, end_freq, max_points=101, initial_points=9, gain_tolerance=2., phase_tolerance=10., min_spacing=1e-3):
+        self.max_points = max(int(max_points), 1)
+        self.gain_tolerance = gain_tolerance
+        self.phase_tolerance = phase_tolerance
+        self.min_spacing = min_spacing
+        num_initial = min(max(int(initial_points), 2), self.max_points)
+        if (num_initial == 1) or (start_freq == end_freq):
+            self.pending = [start_freq]
+        else:
+            self.pending = list(np.logspace(math.log10(start_freq), math.log10(end_freq), num_initial))
+        self.freq = []
+        self.gain = []
+        self.phase = []
+        self.target = None
+
+    @property
+    def num_points(self):
+        return len(self.freq)
+
+    @property
+    def done(self):
+        return self.next_frequency() is None
+
+    def add(self, freq, gain, phase):
+        """Record the gain (dB) and phase (degrees) measured at the target frequency freq."""
+        index = int(np.searchsorted(self.freq, freq))
+        self.freq.insert(index, freq)
+        self.gain.insert(index, gain)
+        self.phase.insert(index, phase)
+        if self.pending and (freq == self.pending[0]):
+            self.pending.pop(0)
+        self.target = None
+
+    def scores(self):
+        """Return the score of every interval between neighbouring points; intervals with a score above 1 need refining."""
+        x = np.log10(self.freq)
+        gain = np.array(self.gain)
+        phase = np.array(self.phase)
+        scores = np.maximum(np.abs(np.diff(gain)) / self.gain_tolerance, np.abs(wrap_phase(np.diff(phase))) / self.phase_tolerance)
+        if len(x) > 2:
+            # distance of each interior point from the chord between its
+            # neighbours, charged to the intervals on both sides of it
+            weight = (x[1:-1] - x[:-2]) / (x[2:] - x[:-2])
+            gain_deviation = np.abs(gain[1:-1] - gain[:-2] - weight * (gain[2:] - gain[:-2]))
+            phase_rise = wrap_phase(phase[2:] - phase[:-2])
+            phase_deviation = np.abs(wrap_phase(phase[1:-1] - phase[:-2] - weight * phase_rise))
+            curvature = np.maximum(gain_deviation / self.gain_tolerance, phase_deviation / self.phase_tolerance) / CURVATURE_FRACTION
+            scores[:-1] = np.maximum(scores[:-1], curvature)
+            scores[1:] = np.maximum(scores[1:], curvature)
+        # too narrow to split
+        scores[np.diff(x) < 2. * self.min_spacing] = 0.
+        return scores
+
+    def next_frequency(self):
+        """Return the next frequency to measure, or None once the sweep is complete."""
+        if self.target is not None:
+            return self.target
+        if self.pending:
+            self.target = self.pending[0]
+        elif (len(self.freq) >= 2) and (len(self.freq) < self.max_points):
+            scores = self.scores()
+            index = int(np.argmax(scores))
+            if scores[index] > 1.:
+                self.target = math.sqrt(self.freq[index] * self.freq[index + 1])
+        return self.target
+
+
+if __name__ == '__main__':
+    import time
+
+    rng = np.random.default_rng(0)
+
+    def response(freq, f0=2e3, q=20., pole=20e3):
+        # a second-order low-pass resonance followed by a real pole
+        s = 1j * np.asarray(freq) / f0
+        h = 1. / (s ** 2 + s / q + 1.) / (1. + 1j * np.asarray(freq) / pole)
+        return [20. * np.log10(np.abs(h)), np.degrees(np.angle(h))]
+
+    def measure(freq):
+        # measurement noise of a few hundredths of a dB and tenths of a degree
+        [gain, phase] = response(freq)
+        return [float(gain) + 0.03 * rng.standard_normal(), float(wrap_phase(phase + 0.3 * rng.standard_normal()))]
+
+    def max_error(freq, gain, phase, truth_freq, truth_gain, truth_phase):
+        # worst error of the plotted (linearly interpolated) curves
+        x = np.log10(freq)
+        gain_error = np.abs(np.interp(np.log10(truth_freq), x, gain) - truth_gain).max()
+        phase_error = np.abs(wrap_phase(np.interp(np.log10(truth_freq), x, np.unwrap(phase, period=360.)) - truth_phase)).max()
+        return [gain_error, phase_error]
+
+    start_freq = 10.
+    end_freq = 100e3
+    truth_freq = np.logspace(1., 5., 20001)
+    [truth_gain, truth_phase] = response(truth_freq)
+
+    print('{:>16s} {:>7s} {:>9s} {:>10s} {:>10s} {:>9s}'.format('sweep', 'points', 'peak dB', 'gain err', 'phase err', 'ms'))
+    errors = {}
+    for name, budget in (('fixed 101', 101), ('fixed 201', 201), ('adaptive 51', 51), ('adaptive 101', 101)):
+        start = time.perf_counter()
+        if name.startswith('fixed'):
+            freq = np.logspace(1., 5., budget)
+            measured = np.array([measure(f) for f in freq])
+            [gain, phase] = [measured[:, 0], measured[:, 1]]
+        else:
+            sweep = AdaptiveSweep(start_freq, end_freq, budget)
+            while not sweep.done:
+                f = sweep.next_frequency()
+                sweep.add(f, *measure(f))
+            [freq, gain, phase] = [np.array(sweep.freq), np.array(sweep.gain), np.array(sweep.phase)]
+            assert np.all(np.diff(freq) > 0.)
+        elapsed = time.perf_counter() - start
+        errors[name] = max_error(freq, gain, phase, truth_freq, truth_gain, truth_phase)
+        print('{:>16s} {:7d} {:9.2f} {:9.2f}dB {:9.1f}° {:9.1f}'.format(name, len(freq), gain.max(), errors[name][0], errors[name][1], 1e3 * elapsed))
+
+    # half the points of the fixed grid, and at least as good at the resonance
+    assert errors['adaptive 51'][0] < errors['fixed 101'][0]
+    assert errors['adaptive 101'][0] < errors['fixed 201'][0]
+    assert errors['adaptive 101'][1] < errors['fixed 201'][1]
+
+    # a flat response stops at the coarse grid
+    sweep = AdaptiveSweep(start_freq, end_freq, 101)
+    while not sweep.done:
+        sweep.add(sweep.next_frequency(), 0., 0.)
+    assert sweep.num_points == 9
+    # a single point
+    sweep = AdaptiveSweep(1e3, 1e3, 1)
+    sweep.add(sweep.next_frequency(), 0., 0.)
+    assert sweep.done and sweep.freq == [1e3]
+    print('OK')
@@ -0,0 +1,240 @@
+"""
+Multi-device manager for Whoa-Scope.
+Opens every connected O-Scope board, drives each one from its own worker
+thread, and provides synchronized trigger/collect operations across all of
+them as well as a per-device stream of captured frames.
+"""
+
+import queue
+import threading
+import time
+
+import serial.tools.list_ports as list_ports
+
+import oscope
+
+
+OSCOPE_VID = 0x6666
+OSCOPE_PID = 0xCDC
+
+
+def find_devices():
+    """Return the serial port names of all attached O-Scope boards."""
+    return sorted(device.device for device in list_ports.comports()
+                  if device.vid == OSCOPE_VID and device.pid == OSCOPE_PID)
+
+
+class DeviceWorker(threading.Thread):
+    """Worker thread that owns a single board and runs commands on it in order."""
+
+    def __init__(self, port, stream_depth=8):
+        super(DeviceWorker, self).__init__(name='oscope-{!s}'.format(port), daemon=True)
+        self.port = port
+        self.dev = oscope.oscope(port)
+        self.commands = queue.Queue()
+        self.frames = queue.Queue(maxsize=stream_depth)
+        self.streaming = threading.Event()
+        self.frame_count = 0
+        self.dropped_frames = 0
+
+    @property
+    def connected(self):
+        return self.dev.connected
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(dev, *args, **kwargs) and return a Future-like result slot."""
+        result = _Result()
+        self.commands.put((func, args, kwargs, result))
+        return result
+
+    def call(self, method, *args, **kwargs):
+        """Queue a call to the named oscope method."""
+        return self.submit(lambda dev, *a, **k: getattr(dev, method)(*a, **k), *args, **kwargs)
+
+    def stop(self):
+        self.streaming.clear()
+        self.commands.put(None)
+
+    def run(self):
+        while True:
+            if self.streaming.is_set():
+                try:
+                    item = self.commands.get_nowait()
+                except queue.Empty:
+                    self._capture_to_stream()
+                    continue
+            else:
+                item = self.commands.get()
+            if item is None:
+                break
+            func, args, kwargs, result = item
+            try:
+                result.set(func(self.dev, *args, **kwargs))
+            except Exception as e:
+                self.dev.connected = False
+                self.streaming.clear()
+                result.set_exception(e)
+        if self.dev.dev is not None:
+            try:
+                self.dev.dev.close()
+            except:
+                pass
+        self.dev.connected = False
+
+    def _capture_to_stream(self):
+        try:
+            frame = (time.monotonic(), self.dev.trigger())
+        except Exception:
+            self.dev.connected = False
+            self.streaming.clear()
+            return
+        self.frame_count += 1
+        if self.frames.full():
+            try:
+                self.frames.get_nowait()
+                self.dropped_frames += 1
+            except queue.Empty:
+                pass
+        self.frames.put_nowait(frame)
+
+
+class _Result(object):
+    """Minimal one-shot result slot filled in by a worker thread."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._exception = None
+
+    def set(self, value):
+        self._value = value
+        self._done.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+    def get(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError('device did not respond within {!s} s'.format(timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._value
+
+
+class DeviceManager(object):
+    """Drives every attached board in parallel, one worker thread per board."""
+
+    def __init__(self, ports=None, stream_depth=8):
+        if ports is None:
+            ports = find_devices()
+        self.workers = []
+        for port in ports:
+            worker = DeviceWorker(port, stream_depth)
+            if worker.connected:
+                worker.start()
+                self.workers.append(worker)
+                print('Connected to {!s}...'.format(port))
+
+    def __len__(self):
+        return len(self.workers)
+
+    @property
+    def ports(self):
+        return [worker.port for worker in self.workers]
+
+    @property
+    def devices(self):
+        return [worker.dev for worker in self.workers]
+
+    def call_all(self, method, *args, **kwargs):
+        """Call the named oscope method on every board in parallel and return the results."""
+        results = [worker.call(method, *args, **kwargs) for worker in self.workers]
+        return [result.get() for result in results]
+
+    def trigger_all(self):
+        """Start a sweep on every board as close to simultaneously as possible.
+
+        Each worker waits at a shared barrier before sending SCOPE:TRIGGER so
+        the skew between boards is limited to thread wake-up latency rather
+        than a full serial round-trip per board.
+        """
+        if not self.workers:
+            return
+        barrier = threading.Barrier(len(self.workers))
+
+        def trigger(dev):
+            barrier.wait()
+            dev.write('SCOPE:TRIGGER')
+            return time.monotonic()
+
+        results = [worker.submit(trigger) for worker in self.workers]
+        return [result.get() for result in results]
+
+    def collect_all(self, wait=True):
+        """Read back the capture buffer from every board in parallel."""
+
+        def collect(dev):
+            if wait:
+                while dev.sweep_in_progress():
+                    time.sleep(0.001)
+            return dev.get_bufferbin()
+
+        results = [worker.submit(collect) for worker in self.workers]
+        return [result.get() for result in results]
+
+    def capture_all(self):
+        """Trigger all boards together and return one frame per board."""
+        self.trigger_all()
+        return self.collect_all()
+
+    def start_streaming(self):
+        """Have each worker trigger and read back frames continuously into its frame queue."""
+        for worker in self.workers:
+            worker.streaming.set()
+            # wake up workers that are blocked waiting for a command
+            worker.submit(lambda dev: None)
+
+    def stop_streaming(self):
+        for worker in self.workers:
+            worker.streaming.clear()
+
+    def stream(self, index):
+        """Return the frame queue of the given board; items are (timestamp, frame)."""
+        return self.workers[index].frames
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            worker.join(1.)
+        self.workers = []
+
+
+def benchmark(duration=5.):
+    """Measure aggregate streaming throughput as boards are added one at a time."""
+    ports = find_devices()
+    if not ports:
+        print('No O-Scope boards found.')
+        return []
+    results = []
+    print('{:>7s} {:>12s} {:>14s} {:>12s}'.format('boards', 'frames/s', 'frames/s/board', 'MB/s'))
+    for n in range(1, len(ports) + 1):
+        manager = DeviceManager(ports[:n])
+        counts = [worker.frame_count for worker in manager.workers]
+        start = time.monotonic()
+        manager.start_streaming()
+        time.sleep(duration)
+        manager.stop_streaming()
+        elapsed = time.monotonic() - start
+        frames = sum(worker.frame_count - count for worker, count in zip(manager.workers, counts))
+        rate = frames / elapsed
+        nbytes = 2 * manager.workers[0].dev.SCOPE_BUFFER_SIZE
+        print('{:7d} {:12.1f} {:14.1f} {:12.3f}'.format(len(manager), rate, rate / len(manager), rate * nbytes / 1e6))
+        results.append((len(manager), rate))
+        manager.close()
+    return results
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,156 @@
+"""
+Hot-plug watcher for Whoa-Scope.
+Notifies the application when serial devices come and go so that it can
+reconnect to a board as soon as one is plugged in, instead of repeatedly
+enumerating and opening serial ports while none is attached.
+
+On Linux the kernel's uevent netlink socket is used when available (the
+same event stream udev listens to), with an inotify watch on /dev as the
+next choice. Elsewhere, or if neither can be set up, the list of attached
+boards is polled with an exponentially growing interval that resets
+whenever it changes.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+
+from devicemanager import find_devices
+
+
+NETLINK_KOBJECT_UEVENT = 15
+
+IN_ATTRIB = 0x00000004
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+TTY_PREFIXES = ('ttyACM', 'ttyUSB', 'tty.usbmodem', 'cu.usbmodem')
+
+
+class DeviceWatcher(object):
+    """Calls callback() from a background thread whenever serial devices change."""
+
+    def __init__(self, callback, min_poll_interval=0.2, max_poll_interval=5.):
+        self.callback = callback
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.mode = None
+        self._fd = None
+        self._sock = None
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._stop_r, self._stop_w = os.pipe()
+
+    @property
+    def event_driven(self):
+        """True when device changes are reported by the OS rather than found by polling."""
+        return self.mode in ('netlink', 'inotify')
+
+    def start(self):
+        if self._thread is not None:
+            return
+        if sys.platform.startswith('linux'):
+            if self._open_netlink():
+                self.mode = 'netlink'
+            elif self._open_inotify():
+                self.mode = 'inotify'
+        if self.mode is None:
+            self.mode = 'poll'
+        self._thread = threading.Thread(target=getattr(self, '_run_' + self.mode), name='device-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        os.write(self._stop_w, b'x')
+        self._thread.join(1.)
+        self._thread = None
+        os.read(self._stop_r, 1)
+        self._stop_event.clear()
+        self.mode = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _notify(self):
+        try:
+            self.callback()
+        except Exception as e:
+            print(f"Error in device watcher callback: {e}")
+
+    def _open_netlink(self):
+        try:
+            self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            self._sock.bind((0, 1))
+            return True
+        except (AttributeError, OSError):
+            self._sock = None
+            return False
+
+    def _open_inotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+            if fd < 0:
+                return False
+            if libc.inotify_add_watch(fd, b'/dev', IN_CREATE | IN_DELETE | IN_ATTRIB) < 0:
+                os.close(fd)
+                return False
+            self._fd = fd
+            return True
+        except (AttributeError, OSError):
+            return False
+
+    def _run_netlink(self):
+        while True:
+            ready, _, _ = select.select([self._sock, self._stop_r], [], [])
+            if self._stop_r in ready:
+                break
+            try:
+                msg = self._sock.recv(8192)
+            except OSError:
+                continue
+            fields = msg.split(b'\0')
+            if (b'SUBSYSTEM=tty' in fields) and any(field.startswith(b'ACTION=add') or field.startswith(b'ACTION=remove') for field in fields):
+                self._notify()
+
+    def _run_inotify(self):
+        while True:
+            ready, _, _ = select.select([self._fd, self._stop_r], [], [])
+            if self._stop_r in ready:
+                break
+            try:
+                buf = os.read(self._fd, 4096)
+            except OSError:
+                continue
+            changed = False
+            pos = 0
+            while pos + 16 <= len(buf):
+                _, _, _, name_len = struct.unpack_from('iIII', buf, pos)
+                name = buf[pos + 16:pos + 16 + name_len].rstrip(b'\0').decode(errors='replace')
+                pos += 16 + name_len
+                if name.startswith(TTY_PREFIXES):
+                    changed = True
+            if changed:
+                self._notify()
+
+    def _run_poll(self):
+        interval = self.min_poll_interval
+        ports = find_devices()
+        while not self._stop_event.wait(interval):
+            new_ports = find_devices()
+            if new_ports != ports:
+                ports = new_ports
+                interval = self.min_poll_interval
+                self._notify()
+            else:
+                interval = min(2. * interval, self.max_poll_interval)
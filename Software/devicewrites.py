@@ -0,0 +1,132 @@
+"""
+Coalesced device writes for Whoa-Scope.
+Sliders and dragged control points change a setting many times a second,
+and writing every intermediate value to the board, each a serial round trip
+or more, backs up the link and holds up the acquisition loop.  Writes from
+those controls are queued here by the register they set instead; a newer
+value for a register replaces the one still waiting, and the queue goes out
+at most once per interval, or right away when the control is released, so
+only the latest value of each register is ever sent.
+"""
+
+import collections
+import time
+
+
+# shortest time between flushes, in seconds
+DEFAULT_INTERVAL = 0.05
+
+
+class CoalescingWriter(object):
+    """Queue of pending device writes, keyed by register, that keeps the latest write for each.
+
+    write() queues function(*args) for a key, replacing a write still
+    pending for that key, and returns how long the caller should wait
+    before calling flush(); zero means that it can flush right away.
+    flush() makes the pending writes in the order that they were last
+    queued, and calls each one's done function, if any, after its write.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, clock=time.monotonic):
+        self.interval = interval
+        self.clock = clock
+        self.pending = collections.OrderedDict()
+        self.last_flush = None
+        self.num_queued = 0
+        self.num_written = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def write(self, key, function, *args, done=None):
+        self.pending.pop(key, None)
+        self.pending[key] = (function, args, done)
+        self.num_queued += 1
+        return self.delay()
+
+    def delay(self):
+        """Return the time left until the queue may be flushed again."""
+        if self.last_flush is None:
+            return 0.
+        return max(self.last_flush + self.interval - self.clock(), 0.)
+
+    def flush(self):
+        """Make the pending writes; one that raises is dropped along with the exception."""
+        self.last_flush = self.clock()
+        while self.pending:
+            [function, args, done] = self.pending.popitem(last=False)[1]
+            function(*args)
+            self.num_written += 1
+            if done is not None:
+                done()
+
+    def clear(self):
+        self.pending.clear()
+
+
+if __name__ == '__main__':
+    import simscope
+
+    # a drag of the amplitude and frequency control point, one touch event
+    # every 10 ms for two seconds, with a simulated clock
+    class Clock(object):
+        def __init__(self):
+            self.now = 0.
+        def __call__(self):
+            return self.now
+
+    dev = simscope.SimulatedScope(seed=0)
+    port = dev.dev
+    events = [(0.01 * i, 1. + 0.5 * i / 200., 1e3 * (1. + i / 200.)) for i in range(200)]
+
+    port.num_commands = 0
+    for now, amplitude, frequency in events:
+        dev.set_amplitude(amplitude)
+        dev.set_freq(frequency)
+        dev.get_freq()
+    direct = port.num_commands
+
+    clock = Clock()
+    writer = CoalescingWriter(clock=clock)
+    port.num_commands = 0
+    frequencies = []
+    flush_at = None
+    for now, amplitude, frequency in events:
+        clock.now = now
+        # what the Clock event scheduled by MainApp.queue_write() does
+        if (flush_at is not None) and (now >= flush_at):
+            writer.flush()
+            flush_at = None
+        writer.write('WAVEGEN:AMP', dev.set_amplitude, amplitude)
+        delay = writer.write('WAVEGEN:FREQ', dev.set_freq, frequency, done=lambda: frequencies.append(dev.get_freq()))
+        if flush_at is None:
+            if delay == 0.:
+                writer.flush()
+            else:
+                flush_at = now + delay
+    # and the release
+    writer.flush()
+    coalesced = port.num_commands
+    print('200 drag events: {} commands written directly, {} coalesced ({} of {} writes sent)'.format(direct, coalesced, writer.num_written, writer.num_queued))
+    assert len(writer) == 0
+    assert coalesced < 0.25 * direct
+    # the board ends up where the drag left it
+    assert abs(dev.get_amplitude() - events[-1][1]) < 0.01
+    assert frequencies[-1] == dev.get_freq() and abs(dev.get_freq() - events[-1][2]) < 0.01 * events[-1][2]
+    # no more than one flush per interval
+    assert writer.num_written <= 2 * (2. / writer.interval + 2)
+
+    # newer values replace older ones, and the writes keep the order in
+    # which they were last queued
+    made = []
+    writer = CoalescingWriter(clock=clock)
+    writer.write('A', made.append, 1)
+    writer.write('B', made.append, 2)
+    writer.write('A', made.append, 3)
+    assert len(writer) == 2
+    writer.flush()
+    assert made == [2, 3]
+    assert abs(writer.delay() - writer.interval) < 1e-9
+    clock.now += writer.interval
+    assert writer.delay() == 0.
+    print('OK')
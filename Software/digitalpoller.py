@@ -0,0 +1,134 @@
+"""
+Digital input polling for Whoa-Scope.
+Reads the digital pins that are inputs with a single transaction per poll,
+the reads for all of the pins going out back to back, instead of a round
+trip for each pin, and keeps the last level of every pin along with the
+times at which they changed.  The digital control panel shows the levels
+from here, and anything else that wants to follow the inputs, such as a
+logic timeline, subscribes to every poll rather than reading the pins
+again.
+
+The poller shares the serial port with the rest of the app, which talks to
+the board from the Kivy clock, so it is polled from there as well rather
+than from a thread of its own.
+"""
+
+import collections
+import time
+
+
+NUM_PINS = 4
+
+# edges kept for the display
+MAX_EDGES = 1000
+
+
+class DigitalPoller(object):
+    """Poller of the digital inputs of an oscope (or SimulatedScope).
+
+    poll() reads the pins given to set_pins() and returns the edges that it
+    found, as (time, pin, level), with the time the middle of the
+    transaction.  states holds the last level of every pin, None for pins
+    not read yet, and edges the most recent edges.  Every function in
+    listeners is called as listener(time, pins, levels) after each poll.
+    """
+
+    def __init__(self, dev, clock=time.monotonic, max_edges=MAX_EDGES):
+        self.dev = dev
+        self.clock = clock
+        self.pins = []
+        self.states = [None] * NUM_PINS
+        self.edges = collections.deque(maxlen=max_edges)
+        self.listeners = []
+        self.last_poll = None
+        self.num_polls = 0
+
+    def set_pins(self, pins):
+        pins = sorted(set(int(pin) for pin in pins))
+        dropped = [pin for pin in self.pins if pin not in pins]
+        for pin in range(NUM_PINS):
+            # a pin that stops being polled has no level to compare with
+            if pin not in pins:
+                self.states[pin] = None
+        self.pins = pins
+        if dropped:
+            # tell the listeners that the dropped pins are no longer known
+            known = [pin for pin in pins if self.states[pin] is not None]
+            now = self.clock()
+            for listener in self.listeners:
+                listener(now, known, [self.states[pin] for pin in known])
+
+    def poll(self):
+        if not self.pins:
+            return []
+
+        start = self.clock()
+        levels = self.dev.dig_read_pins(self.pins)
+        now = 0.5 * (start + self.clock())
+        changes = []
+        for pin, level in zip(self.pins, levels):
+            if (self.states[pin] is not None) and (level != self.states[pin]):
+                changes.append((now, pin, level))
+            self.states[pin] = level
+        self.edges.extend(changes)
+        self.last_poll = now
+        self.num_polls += 1
+        for listener in self.listeners:
+            listener(now, self.pins, levels)
+        return changes
+
+    def last_edge(self, pin):
+        """Return the time of the most recent edge on pin that is still kept, or None."""
+        for t, edge_pin, level in reversed(self.edges):
+            if edge_pin == pin:
+                return t
+        return None
+
+
+if __name__ == '__main__':
+    import simscope
+
+    dev = simscope.SimulatedScope(seed=0)
+    port = dev.dev
+    now = [0.]
+    poller = DigitalPoller(dev, clock=lambda: now[0])
+    published = []
+    poller.listeners.append(lambda t, pins, levels: published.append((t, list(pins), list(levels))))
+
+    # nothing to read, nothing sent
+    port.num_writes = 0
+    assert poller.poll() == [] and port.num_writes == 0
+
+    # what update_button_displays() did before: a round trip per input
+    for num_inputs in (1, 2, 4):
+        pins = list(range(num_inputs))
+        port.num_writes = 0
+        port.num_replies = 0
+        levels = [dev.dig_read(pin) for pin in pins]
+        before = (port.num_writes, port.num_replies)
+        poller.set_pins(pins)
+        port.num_writes = 0
+        port.num_replies = 0
+        poller.poll()
+        after = (port.num_writes, port.num_replies)
+        print('{} inputs: {} writes before, {} with the poller'.format(num_inputs, before[0], after[0]))
+        assert before[0] == num_inputs and after[0] == 1 and after[1] == num_inputs
+
+    # levels and edges, with a changing input on D1 and D3
+    poller.set_pins([1, 3])
+    assert poller.states[0] is None and poller.states[2] is None
+    sequence = [(0, 0), (1, 0), (1, 0), (0, 1), (0, 1), (1, 1)]
+    edges = []
+    for step, (d1, d3) in enumerate(sequence):
+        now[0] = step / 20.
+        port.dig_levels[1] = d1
+        port.dig_levels[3] = d3
+        edges.extend(poller.poll())
+        assert poller.states[1] == d1 and poller.states[3] == d3
+    assert edges == [(0.05, 1, 1), (0.15, 1, 0), (0.15, 3, 1), (0.25, 1, 1)]
+    assert poller.last_edge(1) == 0.25 and poller.last_edge(3) == 0.15 and poller.last_edge(0) is None
+    assert published[-1] == (0.25, [1, 3], [1, 1])
+    # and the replies are consumed in order, so other commands still work
+    assert dev.dig_read(3) == 1
+    assert port.output == b''
+    print('OK')
@@ -0,0 +1,150 @@
+"""
+Frame processor for Whoa-Scope.
+Converts raw scope buffers into calibrated voltages, locates the trigger
+and builds the time axes using work buffers that are allocated once, so
+that processing a frame in steady state does not allocate any arrays.
+"""
+
+import math
+
+import numpy as np
+
+
+class FrameProcessor(object):
+    """Owns the preallocated buffers used to turn raw sweeps into traces."""
+
+    def __init__(self, num_samples=1500, max_time_bases=16):
+        self.num_samples = num_samples
+        self.max_time_bases = max_time_bases
+        self.raw = np.zeros((2, num_samples), dtype=np.uint16)
+        self.chs = np.zeros((2, num_samples))
+        self.ts = np.zeros((2, num_samples))
+        self.work = np.zeros(num_samples)
+        self.mask1 = np.zeros(num_samples, dtype=bool)
+        self.mask2 = np.zeros(num_samples, dtype=bool)
+        self.ramp = np.arange(num_samples, dtype=np.float64)
+        self.time_bases = {}
+
+    def load(self, data, num_avg):
+        """Load a SCOPE:BUFFERBIN? reply holding CH1 samples followed by as many CH2 samples.
+
+        Returns the number of samples per channel.
+        """
+        vals = np.frombuffer(data, dtype='<u2')
+        count = len(vals) >> 1
+        np.right_shift(vals.reshape(2, count), num_avg, out=self.raw[:, :count])
+        return count
+
+    def load_channel(self, index, data, num_avg):
+        """Load a SCOPE:BUFFERBIN? reply holding samples of a single channel."""
+        vals = np.frombuffer(data, dtype='<u2')
+        np.right_shift(vals, num_avg, out=self.raw[index, :len(vals)])
+        return len(vals)
+
+    def scale(self, index, count, volts_per_lsb, gain, zero, out=None):
+        """Convert raw samples of a channel to volts, in self.chs unless out is given."""
+        if out is None:
+            out = self.chs[index, :count]
+        # widen first; mixing uint16 and float64 in one ufunc call makes 
+        # numpy allocate a casting buffer
+        np.copyto(out, self.raw[index, :count])
+        np.subtract(out, zero, out=out)
+        np.multiply(out, volts_per_lsb * gain, out=out)
+        return out
+
+    def find_trigger(self, ch, level, edge, middle):
+        """Find the edge crossing of level nearest to sample middle.
+
+        Returns [position, offset], where offset is the sub-sample position
+        of the crossing past ch[position], or None if there is none.
+        """
+        n = len(ch) - 1
+        if n < 1:
+            return None
+        before = self.mask1[:n]
+        after = self.mask2[:n]
+        if edge == 'Rising':
+            np.less_equal(ch[:-1], level, out=before)
+            np.greater(ch[1:], level, out=after)
+        elif edge == 'Falling':
+            np.greater_equal(ch[:-1], level, out=before)
+            np.less(ch[1:], level, out=after)
+        else:
+            return None
+        crossings = np.logical_and(before, after, out=before)
+
+        middle = min(max(int(middle), 0), n)
+        pos = None
+        if crossings[middle:].any():
+            pos = middle + int(crossings[middle:].argmax())
+        if crossings[:middle].any():
+            prev = middle - 1 - int(crossings[middle - 1::-1].argmax())
+            if (pos is None) or (middle - prev <= pos - middle):
+                pos = prev
+        if pos is None:
+            return None
+        return [pos, (level - ch[pos]) / (ch[pos + 1] - ch[pos])]
+
+    def time_base(self, sampling_interval):
+        """Return sampling_interval * [0, 1, 2, ...], cached per sampling interval."""
+        base = self.time_bases.get(sampling_interval)
+        if base is None:
+            if len(self.time_bases) >= self.max_time_bases:
+                self.time_bases.clear()
+            base = sampling_interval * self.ramp
+            self.time_bases[sampling_interval] = base
+        return base
+
+    def times(self, count, sampling_interval, zero, ch1_skew=0., ch2_skew=0.):
+        """Fill the time axes of both channels so that sample position zero is at t = 0."""
+        base = self.time_base(sampling_interval)[:count]
+        t1 = self.ts[0, :count]
+        t2 = self.ts[1, :count]
+        np.subtract(base, sampling_interval * zero - ch1_skew, out=t1)
+        np.subtract(base, sampling_interval * zero - ch2_skew, out=t2)
+        return [t1, t2]
+
+    def mean_rms(self, ch):
+        """Return the mean and the RMS deviation from the mean of a trace."""
+        n = len(ch)
+        mean = float(ch.sum()) / n
+        work = self.work[:n]
+        np.subtract(ch, mean, out=work)
+        return [mean, math.sqrt(float(np.dot(work, work)) / n)]
+
+
+if __name__ == '__main__':
+    import tracemalloc
+
+    num_samples = 1500
+    t = np.arange(num_samples)
+    frame = np.concatenate((2048 + 1000 * np.sin(2. * np.pi * t / 137.), 2048 + 500 * np.cos(2. * np.pi * t / 137.))).astype('<u2').tobytes()
+    processor = FrameProcessor(num_samples)
+
+    def process():
+        count = processor.load(frame, 0)
+        ch1 = processor.scale(0, count, 5e-3, 1., 2048.)
+        ch2 = processor.scale(1, count, 5e-3, 1., 2048.)
+        [zero, offset] = processor.find_trigger(ch1, 0., 'Rising', count >> 1)
+        processor.times(count, 1e-6, zero + offset, 0., 0.125e-6)
+        processor.mean_rms(ch1)
+        processor.mean_rms(ch2)
+
+    for i in range(10):
+        process()
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    for i in range(1000):
+        process()
+    peak = tracemalloc.get_traced_memory()[1]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    growth = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    print('net growth over 1000 frames: {:d} bytes, peak while processing: {:d} bytes'.format(growth, peak))
+    # a single array of one channel's samples would take 12000 bytes
+    assert peak < 8 * num_samples, 'frame processing allocated an array'
+    assert growth < 8 * num_samples, 'frame processing leaks memory'
+    print('OK')
@@ -106,6 +106,9 @@ class Plot(Widget):
         self.curve_id = 0
         self.curves = {}
 
+        self.image = None
+        self.image_texture = None
+
         self.xaxis_mode = 'linear'
         self.xaxis_sign = 1.
         self.xaxis_color = None
@@ -302,6 +305,7 @@ class Plot(Widget):
     def draw_plot(self):
         self.draw_background()
         self.draw_axes_background()
+        self.draw_image()
         self.draw_grid()
         self.draw_x_ticks()
         self.draw_y_ticks()
@@ -358,6 +362,16 @@ class Plot(Widget):
         self.canvas.add(Color(*get_color_from_hex(self.axes_background_color)))
         self.canvas.add(Rectangle(pos = [self.axes_left, self.axes_bottom], size = [self.axes_width, self.axes_height]))
 
+    def draw_image(self):
+        if self.image is None:
+            return
+        height, width = self.image.shape[:2]
+        if (self.image_texture is None) or (tuple(self.image_texture.size) != (width, height)):
+            self.image_texture = Texture.create(size = (width, height), colorfmt = 'rgba')
+        self.image_texture.blit_buffer(self.image.tobytes(), colorfmt = 'rgba', bufferfmt = 'ubyte')
+        self.canvas.add(Color(1., 1., 1., 1.))
+        self.canvas.add(Rectangle(texture = self.image_texture, pos = [self.axes_left, self.axes_bottom], size = [self.axes_width, self.axes_height]))
+
     def draw_axes(self):
         self.canvas.add(Color(*get_color_from_hex(self.axes_color)))
         self.canvas.add(Line(points = [self.axes_left, self.axes_top, self.axes_right, self.axes_top]))
@@ -0,0 +1,248 @@
+"""
+Logic timeline for Whoa-Scope.
+Records the levels of the digital inputs, as the digital poller reads them,
+so that the history of status lines on a device under test can be looked
+back over, zoomed into, and saved as a VCD file for a waveform viewer such
+as GTKWave.  Only changes are kept: every entry is the time at which the
+inputs changed and their new state, packed into a byte holding the level of
+each pin and whether the pin was being read at all, so the memory used grows
+with the number of transitions rather than the time logged, and hours of
+quiet inputs take next to nothing.
+
+Edges are timed by the poll that saw them, so they are only as exact as
+the polling interval, about 50 ms in the app, and pulses shorter than that
+can be missed.
+"""
+
+import time
+
+import numpy as np
+
+
+NUM_PINS = 4
+
+# initial number of entries; the arrays double when they fill up
+INITIAL_CAPACITY = 256
+
+# VCD identifiers of the pins
+VCD_IDS = ('!', '"', '#', '$')
+
+
+class LogicTimeline(object):
+    """Run-length encoded record of the levels of the digital pins over time.
+
+    record() takes the polls of a digitalpoller.DigitalPoller, as one of its
+    listeners, and appends an entry only when the state changes.  Times
+    are those of the poller's clock; start is the time of the first entry
+    and end that of the latest poll, and start_wall is the wall-clock time
+    of the first entry, for the VCD header.  Pins that are not read in a
+    poll are unknown until they are read again.
+    """
+
+    def __init__(self, num_pins=NUM_PINS, capacity=INITIAL_CAPACITY):
+        self.num_pins = num_pins
+        self.times = np.empty(capacity, dtype=np.float64)
+        self.states = np.empty(capacity, dtype=np.uint8)
+        self.length = 0
+        self.start = None
+        self.end = None
+        self.start_wall = None
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def nbytes(self):
+        return self.times.nbytes + self.states.nbytes
+
+    def clear(self):
+        self.length = 0
+        self.start = None
+        self.end = None
+        self.start_wall = None
+
+    def record(self, t, pins, levels):
+        # low nibble: levels, high nibble: pins that were read
+        state = 0
+        for pin, level in zip(pins, levels):
+            state |= (0x10 | (1 if level else 0)) << pin
+        if self.length == 0:
+            if state == 0:
+                return
+            self.start = t
+            self.start_wall = time.time()
+        elif self.states[self.length - 1] == state:
+            self.end = t
+            return
+        if self.length == len(self.times):
+            self.times = np.concatenate((self.times, np.empty(len(self.times), dtype=np.float64)))
+            self.states = np.concatenate((self.states, np.empty(len(self.states), dtype=np.uint8)))
+        self.times[self.length] = t
+        self.states[self.length] = state
+        self.length += 1
+        self.end = t
+
+    def state_at(self, t):
+        """Return the levels of the pins at time t, with None for the unknown ones."""
+        index = np.searchsorted(self.times[:self.length], t, side='right') - 1
+        if (index < 0) or (t > self.end):
+            return [None] * self.num_pins
+        state = int(self.states[index])
+        return [(state >> pin) & 1 if (state >> (4 + pin)) & 1 else None for pin in range(self.num_pins)]
+
+    def segments(self, t0=None, t1=None):
+        """Return the start and end times, relative to start, and the states of the entries overlapping [t0, t1]."""
+        if self.length == 0:
+            return [np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.uint8)]
+        times = self.times[:self.length]
+        t0 = self.start if t0 is None else max(t0 + self.start, self.start)
+        t1 = self.end if t1 is None else min(t1 + self.start, self.end)
+        if t1 < t0:
+            return [np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.uint8)]
+        first = max(np.searchsorted(times, t0, side='right') - 1, 0)
+        last = max(np.searchsorted(times, t1, side='left'), first + 1)
+        starts = times[first:last].copy()
+        ends = np.append(times[first + 1:last], t1)
+        starts[0] = t0
+        return [starts - self.start, ends - self.start, self.states[first:last]]
+
+    def trace(self, pin, t0=None, t1=None, base=0., height=1.):
+        """Return [points_x, points_y] of the steps of pin between t0 and t1, relative to start, for a kvplot curve.
+
+        The levels are drawn at base and base + height, with one run of
+        points for every stretch where the pin was being read.
+        """
+        [starts, ends, states] = self.segments(t0, t1)
+        known = (states >> (4 + pin)) & 1 == 1
+        levels = base + height * ((states >> pin) & 1)
+        points_x = []
+        points_y = []
+        boundaries = np.flatnonzero(np.diff(known.astype(np.int8))) + 1
+        for run in np.split(np.arange(len(states)), boundaries):
+            if len(run) and known[run[0]]:
+                points_x.append(np.column_stack((starts[run], ends[run])).ravel())
+                points_y.append(np.repeat(levels[run], 2))
+        return [points_x, points_y]
+
+    def vcd(self, timescale=1e-6):
+        """Yield the lines of a VCD file of the timeline."""
+        units = {1e-9: '1 ns', 1e-6: '1 us', 1e-3: '1 ms'}
+        if timescale not in units:
+            raise ValueError('timescale must be 1e-9, 1e-6, or 1e-3')
+        date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.start_wall if self.start_wall is not None else time.time()))
+        yield '$date {} $end'.format(date)
+        yield '$version Whoa-Scope logic timeline $end'
+        yield '$timescale {} $end'.format(units[timescale])
+        yield '$scope module whoa_scope $end'
+        for pin in range(self.num_pins):
+            yield '$var wire 1 {} D{:d} $end'.format(VCD_IDS[pin], pin)
+        yield '$upscope $end'
+        yield '$enddefinitions $end'
+        values = ['x'] * self.num_pins
+        yield '#0'
+        yield '$dumpvars'
+        for pin in range(self.num_pins):
+            yield 'x{}'.format(VCD_IDS[pin])
+        yield '$end'
+        if self.length == 0:
+            return
+        ticks = np.rint((self.times[:self.length] - self.start) / timescale).astype(np.int64)
+        for tick, state in zip(ticks, self.states[:self.length]):
+            changes = []
+            for pin in range(self.num_pins):
+                value = str((state >> pin) & 1) if (state >> (4 + pin)) & 1 else 'x'
+                if value != values[pin]:
+                    values[pin] = value
+                    changes.append(value + VCD_IDS[pin])
+            if changes:
+                yield '#{:d}'.format(tick)
+                yield from changes
+        yield '#{:d}'.format(int(round((self.end - self.start) / timescale)))
+
+    def export_vcd(self, filename, timescale=1e-6):
+        with open(filename, 'w') as outfile:
+            for line in self.vcd(timescale):
+                outfile.write(line + '\n')
+
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+
+    import digitalpoller
+    import simscope
+
+    dev = simscope.SimulatedScope(seed=0)
+    port = dev.dev
+    now = [0.]
+    poller = digitalpoller.DigitalPoller(dev, clock=lambda: now[0])
+    timeline = LogicTimeline()
+    poller.listeners.append(timeline.record)
+
+    # an hour of polls every 50 ms of D0 and D2, with D0 toggling every
+    # 10 s and a pulse on D2 once a minute
+    poller.set_pins([0, 2])
+    num_polls = 72000
+    for poll in range(num_polls):
+        now[0] = poll / 20.
+        port.dig_levels[0] = (poll // 200) % 2
+        port.dig_levels[2] = 1 if poll % 1200 < 10 else 0
+        poller.poll()
+    # 359 edges on D0 and 119 on D2, 59 of them at the same polls, and the
+    # first poll
+    print('1 hour, {} polls, {} edges: {} entries in {} bytes, against {} bytes for every poll'.format(num_polls, len(poller.edges), len(timeline), timeline.nbytes, num_polls * 9))
+    assert len(poller.edges) == 359 + 119
+    assert len(timeline) == 1 + 359 + 119 - 59
+    assert timeline.nbytes < num_polls
+    assert timeline.start == 0. and timeline.end == (num_polls - 1) / 20.
+
+    # levels at any time
+    assert timeline.state_at(0.2) == [0, None, 1, None]
+    assert timeline.state_at(5.) == [0, None, 0, None]
+    assert timeline.state_at(10.2) == [1, None, 0, None]
+    assert timeline.state_at(60.2) == [0, None, 1, None]
+    assert timeline.state_at(-1.) == [None] * 4
+
+    # a window of the D0 trace, as steps
+    [points_x, points_y] = timeline.trace(0, 5., 35.)
+    assert len(points_x) == 1
+    x = points_x[0]
+    y = points_y[0]
+    assert x[0] == 5. and x[-1] == 35.
+    edges_x = x[1:-1:2][np.diff(y[::2]) != 0]
+    assert np.allclose(edges_x, [10., 20., 30.])
+    assert np.all(np.diff(x) >= 0.)
+    # D1 was never read
+    assert timeline.trace(1) == [[], []]
+    # with stacking
+    [points_x, points_y] = timeline.trace(2, 0., 130., base=3., height=0.8)
+    assert set(np.unique(points_y[0])) == {3., 3.8}
+
+    # reading stops and starts again: unknown in between
+    poller.set_pins([])
+    now[0] += 10.
+    poller.set_pins([0])
+    for poll in range(2):
+        now[0] += 0.05
+        poller.poll()
+    assert timeline.state_at(now[0] - 5.) == [None] * 4
+    [points_x, points_y] = timeline.trace(0)
+    assert len(points_x) == 2
+
+    # VCD
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, 'logic.vcd')
+        timeline.export_vcd(filename)
+        with open(filename) as infile:
+            lines = infile.read().splitlines()
+    assert '$enddefinitions $end' in lines and '$var wire 1 ! D0 $end' in lines
+    body = lines[lines.index('$end', lines.index('$dumpvars')) + 1:]
+    stamps = [int(line[1:]) for line in body if line.startswith('#')]
+    assert stamps == sorted(stamps) and stamps[0] == 0
+    assert body[:3] == ['#0', '0!', '1#']
+    assert body[3:5] == ['#500000', '0#']
+    assert body[body.index('#10000000') + 1:body.index('#10000000') + 3] == ['1!', '#20000000']
+    assert body[body.index('#60000000') + 1:body.index('#60000000') + 4] == ['0!', '1#', '#60500000']
+    assert 'x!' in body and 'x#' in body
+    print('{} lines of VCD'.format(len(lines)))
+    print('OK')
@@ -0,0 +1,336 @@
+"""
+Automatic measurements for Whoa-Scope.
+Computes the standard scope measurements (frequency, period, levels,
+rise/fall time, duty cycle, overshoot, CH1 to CH2 delay and phase) for a
+selected subset from each frame, and keeps running statistics of every
+measurement over any number of frames.  Nothing here depends on the UI,
+so the engine can be fed frames from oscope.oscope directly in scripts.
+
+Edges are found with hysteresis between the 10% and 90% levels of the
+waveform, located with sub-sample precision by linear interpolation, and
+all edges of a frame are handled at once with array operations.
+"""
+
+import math
+
+import numpy as np
+
+
+CHANNEL_MEASUREMENTS = ('frequency', 'period', 'vpp', 'vmax', 'vmin', 'vtop', 'vbase', 'vamp', 'vmean', 'vrms',
+                        'rise_time', 'fall_time', 'duty', 'overshoot', 'preshoot')
+PAIR_MEASUREMENTS = ('delay', 'phase')
+
+UNITS = {'frequency': 'Hz', 'period': 's', 'vpp': 'V', 'vmax': 'V', 'vmin': 'V', 'vtop': 'V', 'vbase': 'V',
+         'vamp': 'V', 'vmean': 'V', 'vrms': 'V', 'rise_time': 's', 'fall_time': 's', 'duty': '%',
+         'overshoot': '%', 'preshoot': '%', 'delay': 's', 'phase': '\xB0'}
+
+
+def crossings(ch, level, rising=True):
+    """Return the interpolated sample positions where ch crosses level in the given direction."""
+    if rising:
+        where = np.flatnonzero((ch[:-1] < level) & (ch[1:] >= level))
+    else:
+        where = np.flatnonzero((ch[:-1] > level) & (ch[1:] <= level))
+    if len(where) == 0:
+        return where.astype(np.float64)
+    return where + (level - ch[where]) / (ch[where + 1] - ch[where])
+
+
+class ChannelAnalysis(object):
+    """Levels and edges of one frame of one channel, computed on demand and shared between measurements."""
+
+    def __init__(self, ch, sampling_interval, histogram_bins=64):
+        self.ch = ch
+        self.sampling_interval = sampling_interval
+        self.histogram_bins = histogram_bins
+        self.vmax = float(ch.max())
+        self.vmin = float(ch.min())
+        self._levels = None
+        self._edges = None
+
+    @property
+    def levels(self):
+        """Return [base, top] found as the most common levels in the lower and upper halves of the range.
+
+        Waveforms without flat tops, like sines, fall back to the minimum
+        and maximum.
+        """
+        if self._levels is None:
+            span = self.vmax - self.vmin
+            if span <= 0.:
+                self._levels = [self.vmin, self.vmax]
+            else:
+                bins = self.histogram_bins
+                index = np.minimum(((self.ch - self.vmin) * (bins / span)).astype(np.int64), bins - 1)
+                counts = np.bincount(index, minlength=bins)
+                half = bins >> 1
+                threshold = 0.05 * len(self.ch)
+                low = int(np.argmax(counts[:half]))
+                high = half + int(np.argmax(counts[half:]))
+                base = self.vmin + (low + 0.5) * span / bins if counts[low] >= threshold else self.vmin
+                top = self.vmin + (high + 0.5) * span / bins if counts[high] >= threshold else self.vmax
+                self._levels = [base, top]
+        return self._levels
+
+    @property
+    def edges(self):
+        """Return [rising, falling], the edges of the frame.
+
+        Each is a (3, n) array with the positions of the 10%, 50% and 90%
+        crossings of each edge, in samples.  A rising edge runs from a sample
+        below the 10% level to the next sample above the 90% level, which
+        rejects noise around the middle level.
+        """
+        if self._edges is None:
+            ch = self.ch
+            [base, top] = self.levels
+            amplitude = top - base
+            lo = base + 0.1 * amplitude
+            mid = base + 0.5 * amplitude
+            hi = base + 0.9 * amplitude
+            if amplitude <= 0.:
+                empty = np.zeros((3, 0))
+                self._edges = [empty, empty]
+                return self._edges
+
+            above = ch > hi
+            below = ch < lo
+            where = np.flatnonzero(above | below)
+            states = above[where]
+            change = np.flatnonzero(states[1:] != states[:-1])
+            # position of the first sample past the far threshold in each transition
+            arrivals = where[change + 1]
+            rises = arrivals[states[change + 1]]
+            falls = arrivals[~states[change + 1]]
+
+            edges = []
+            for arrivals, rising, levels in ((rises, True, (lo, mid, hi)), (falls, False, (hi, mid, lo))):
+                positions = np.zeros((3, len(arrivals)))
+                for i, level in enumerate(levels):
+                    cross = crossings(ch, level, rising)
+                    # the last crossing of each level before the transition completes
+                    index = np.searchsorted(cross, arrivals) - 1
+                    valid = index >= 0
+                    positions[i] = np.where(valid, cross[np.maximum(index, 0)], np.nan) if len(cross) else np.nan
+                edges.append(positions)
+            self._edges = edges
+        return self._edges
+
+
+class RunningStatistics(object):
+    """Count, minimum, maximum, mean and standard deviation of many values at once, updated with Welford's method."""
+
+    def __init__(self, size):
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        self.count = np.zeros(self.size, dtype=np.int64)
+        self.mean = np.zeros(self.size)
+        self.m2 = np.zeros(self.size)
+        self.min = np.full(self.size, np.inf)
+        self.max = np.full(self.size, -np.inf)
+
+    def update(self, values):
+        """Add one value per slot; NaN values leave their slot unchanged."""
+        valid = ~np.isnan(values)
+        self.count += valid
+        delta = np.where(valid, values - self.mean, 0.)
+        self.mean += np.where(valid, delta / np.maximum(self.count, 1), 0.)
+        self.m2 += np.where(valid, delta * (values - self.mean), 0.)
+        np.fmin(self.min, values, out=self.min)
+        np.fmax(self.max, values, out=self.max)
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / np.maximum(self.count - 1, 1))
+
+
+class MeasurementEngine(object):
+    """Measures a selected set of quantities on each frame and accumulates their statistics.
+
+    selection holds (channel, name) pairs, where channel is 'CH1' or 'CH2'
+    for the per-channel measurements and 'CH1-CH2' for delay and phase.
+    """
+
+    def __init__(self, selection=None):
+        if selection is None:
+            selection = [(ch, name) for ch in ('CH1', 'CH2') for name in CHANNEL_MEASUREMENTS]
+            selection += [('CH1-CH2', name) for name in PAIR_MEASUREMENTS]
+        self.select(selection)
+
+    def select(self, selection):
+        for channel, name in selection:
+            if (channel in ('CH1', 'CH2')) and (name not in CHANNEL_MEASUREMENTS):
+                raise ValueError('unknown channel measurement {!r}'.format(name))
+            if (channel == 'CH1-CH2') and (name not in PAIR_MEASUREMENTS):
+                raise ValueError('unknown channel pair measurement {!r}'.format(name))
+            if channel not in ('CH1', 'CH2', 'CH1-CH2'):
+                raise ValueError('unknown channel {!r}'.format(channel))
+        self.selection = list(selection)
+        self.statistics = RunningStatistics(len(self.selection))
+        self.values = np.full(len(self.selection), np.nan)
+
+    def reset(self):
+        self.statistics.reset()
+        self.values[:] = np.nan
+
+    def update(self, ch1, ch2, sampling_interval, ch2_skew=0.):
+        """Measure one frame, add it to the statistics and return {(channel, name): value}.
+
+        ch2_skew is the time by which CH2 samples lag the CH1 samples with
+        the same index.  Measurements that are undefined for the frame, such
+        as the frequency of a DC level, are NaN and are left out of the
+        statistics.
+        """
+        analyses = {'CH1': ChannelAnalysis(np.asarray(ch1, dtype=np.float64), sampling_interval),
+                    'CH2': ChannelAnalysis(np.asarray(ch2, dtype=np.float64), sampling_interval)}
+        for i, (channel, name) in enumerate(self.selection):
+            if channel == 'CH1-CH2':
+                self.values[i] = self.measure_pair(analyses['CH1'], analyses['CH2'], name, ch2_skew)
+            else:
+                self.values[i] = self.measure(analyses[channel], name)
+        self.statistics.update(self.values)
+        return dict(zip(self.selection, self.values.tolist()))
+
+    def measure(self, analysis, name):
+        si = analysis.sampling_interval
+        if name == 'vmax':
+            return analysis.vmax
+        elif name == 'vmin':
+            return analysis.vmin
+        elif name == 'vpp':
+            return analysis.vmax - analysis.vmin
+        elif name == 'vmean':
+            return float(analysis.ch.mean())
+        elif name == 'vrms':
+            return math.sqrt(float(np.dot(analysis.ch, analysis.ch)) / len(analysis.ch))
+        elif name in ('vtop', 'vbase', 'vamp', 'overshoot', 'preshoot'):
+            [base, top] = analysis.levels
+            amplitude = top - base
+            if name == 'vtop':
+                return top
+            elif name == 'vbase':
+                return base
+            elif name == 'vamp':
+                return amplitude
+            elif amplitude <= 0.:
+                return math.nan
+            elif name == 'overshoot':
+                return 100. * (analysis.vmax - top) / amplitude
+            else:
+                return 100. * (base - analysis.vmin) / amplitude
+
+        [rising, falling] = analysis.edges
+        if name in ('period', 'frequency'):
+            period = self.period(rising[1]) * si
+            if name == 'period':
+                return period
+            return 1. / period if period > 0. else math.nan
+        elif name == 'rise_time':
+            return float(np.nanmean(rising[2] - rising[0])) * si if np.any(np.isfinite(rising[0])) else math.nan
+        elif name == 'fall_time':
+            return float(np.nanmean(falling[2] - falling[0])) * si if np.any(np.isfinite(falling[0])) else math.nan
+        elif name == 'duty':
+            rises = rising[1][np.isfinite(rising[1])]
+            falls = falling[1][np.isfinite(falling[1])]
+            period = self.period(rising[1])
+            if (len(rises) < 2) or (len(falls) == 0) or not (period > 0.):
+                return math.nan
+            # pair each rising edge but the last with the first falling edge after it
+            index = np.searchsorted(falls, rises[:-1])
+            valid = index < len(falls)
+            if not np.any(valid):
+                return math.nan
+            high = falls[index[valid]] - rises[:-1][valid]
+            return 100. * float(np.mean(high)) / period
+        raise ValueError('unknown measurement {!r}'.format(name))
+
+    def measure_pair(self, analysis1, analysis2, name, ch2_skew):
+        si = analysis1.sampling_interval
+        rises1 = analysis1.edges[0][1]
+        rises1 = rises1[np.isfinite(rises1)]
+        rises2 = analysis2.edges[0][1]
+        rises2 = rises2[np.isfinite(rises2)]
+        if (len(rises1) == 0) or (len(rises2) == 0):
+            return math.nan
+        period = self.period(rises1)
+        # delay from each CH1 edge to the nearest CH2 edge
+        times2 = rises2 + ch2_skew / si
+        index = np.clip(np.searchsorted(times2, rises1), 1, len(times2) - 1) if len(times2) > 1 else np.zeros(len(rises1), dtype=np.int64)
+        before = times2[np.maximum(index - 1, 0)] - rises1
+        after = times2[index] - rises1
+        delays = np.where(np.abs(before) < np.abs(after), before, after)
+        if period > 0.:
+            # the nearest CH2 edge of a CH1 edge at the end of the frame may
+            # belong to another cycle
+            delays -= period * np.floor(delays / period + 0.5)
+        delay = float(np.mean(delays))
+        if name == 'delay':
+            return delay * si
+        if not (period > 0.):
+            return math.nan
+        phase = 360. * delay / period
+        return phase - 360. * math.floor((phase + 180.) / 360.)
+
+    @staticmethod
+    def period(rises):
+        """Return the mean spacing of the finite edge positions in rises, in samples, or NaN."""
+        rises = rises[np.isfinite(rises)]
+        if len(rises) < 2:
+            return math.nan
+        return float(rises[-1] - rises[0]) / (len(rises) - 1)
+
+    def results(self):
+        """Return {(channel, name): [current, minimum, maximum, mean, standard deviation, count]} for the selection."""
+        stats = self.statistics
+        std = stats.std
+        results = {}
+        for i, key in enumerate(self.selection):
+            if stats.count[i] == 0:
+                results[key] = [float(self.values[i]), math.nan, math.nan, math.nan, math.nan, 0]
+            else:
+                results[key] = [float(self.values[i]), float(stats.min[i]), float(stats.max[i]),
+                                float(stats.mean[i]), float(std[i]), int(stats.count[i])]
+        return results
+
+
+if __name__ == '__main__':
+    import time
+
+    num_samples = 1500
+    sampling_interval = 1e-6
+    t = sampling_interval * np.arange(num_samples)
+    rng = np.random.default_rng(0)
+    engine = MeasurementEngine()
+
+    def square(t, frequency, duty, rise_time):
+        phase = (t * frequency) % 1.
+        # trapezoid with linear edges of the given 0-100% rise time
+        ramp = rise_time * frequency
+        ch = np.clip(phase / ramp, 0., 1.)
+        ch = np.where(phase > duty, np.clip(1. - (phase - duty) / ramp, 0., 1.), ch)
+        return ch
+
+    frequency = 7300.
+    frames = 2000
+    start = time.perf_counter()
+    for i in range(frames):
+        offset = rng.uniform(0., 1. / frequency)
+        ch1 = 4. * square(t + offset, frequency, 0.3, 10e-6) - 2. + 0.01 * rng.standard_normal(num_samples)
+        ch2 = 1.5 * np.sin(2. * np.pi * frequency * (t + offset) - np.pi / 4.) + 0.01 * rng.standard_normal(num_samples)
+        engine.update(ch1, ch2, sampling_interval)
+    elapsed = (time.perf_counter() - start) / frames
+
+    results = engine.results()
+    print('{:d} measurements in {:.3f} ms per frame'.format(len(engine.selection), 1e3 * elapsed))
+    for (channel, name), [current, lo, hi, mean, std, count] in sorted(results.items()):
+        print('{:>8s} {:>10s}: mean {:12.6g} std {:10.3g} min {:12.6g} max {:12.6g} [{:s}] n={:d}'.format(channel, name, mean, std, lo, hi, UNITS[name], count))
+
+    assert abs(results[('CH1', 'frequency')][3] - frequency) < 0.01 * frequency
+    assert abs(results[('CH1', 'duty')][3] - 30.) < 1.
+    # 10-90% of a linear 10 us edge
+    assert abs(results[('CH1', 'rise_time')][3] - 8e-6) < 0.5e-6
+    assert abs(results[('CH2', 'vpp')][3] - 3.) < 0.1
+    assert abs(results[('CH1', 'vamp')][3] - 4.) < 0.2
+    print('OK')
@@ -0,0 +1,285 @@
+"""
+Offset waveform synthesis for Whoa-Scope.
+Builds offset waveforms from a short description instead of a text file of
+voltages.  A description is a list of segments separated by semicolons,
+which play one after the other, for example
+
+    hold(0, 0.5); ramp(0, 2, 1); staircase(2, 0, 5, 1); chirp(2, 1, 20, 0.5, 1)
+
+Every segment is sampled at the offset interval with NumPy, so waveforms of
+thousands of samples take about a millisecond, and the samples and
+their 10-bit DAC codes are cached by the description, the interval and the
+calibration, so that previewing and then uploading a waveform computes it
+once.  The codes go straight to the board with offsetupload.
+
+Durations are in seconds, levels and amplitudes in volts and frequencies
+in hertz.  Time t starts from zero at the beginning of every segment.
+
+Descriptions are parsed with ast and never run as Python: every segment
+must be a call of one of the segment functions, and its arguments numbers,
+strings, True or False, lists of them, or arithmetic on numbers and pi,
+which is worked out by the math channel evaluator, as is the body of
+expr().
+"""
+
+import ast
+import collections
+import functools
+import math
+
+import numpy as np
+
+import mathchannels
+
+
+MAX_CACHED = 16
+
+
+def num_samples(duration, interval):
+    """Return the number of samples in a segment of the given duration, at least one."""
+    return max(int(round(duration / interval)), 1)
+
+
+def times(duration, interval):
+    """Return the sample times of a segment of the given duration, at least one sample long."""
+    return interval * np.arange(num_samples(duration, interval))
+
+
+def segment(duration, samples):
+    # segments know their duration, so that their length can be checked
+    # before any samples are made
+    samples.duration = duration
+    return samples
+
+
+def hold(level, duration):
+    """A constant level."""
+    return segment(duration, lambda interval: np.full(num_samples(duration, interval), float(level)))
+
+
+def ramp(start, stop, duration):
+    """A straight line from start to stop, which the next segment begins after."""
+    return segment(duration, lambda interval: start + (stop - start) / duration * times(duration, interval))
+
+
+def staircase(start, stop, steps, duration):
+    """steps equal steps from start to stop, each lasting duration / steps."""
+    steps = max(int(steps), 1)
+    def samples(interval):
+        index = np.minimum((times(duration, interval) * steps / duration).astype(np.int64), steps - 1)
+        return start + (stop - start) * index / max(steps - 1, 1)
+    return segment(duration, samples)
+
+
+def pwl(points):
+    """Straight lines through [time, level] points, from the first point's time to the last's."""
+    points = np.asarray(points, dtype=np.float64)
+    if (points.ndim != 2) or (points.shape[1] != 2) or (len(points) < 2) or np.any(np.diff(points[:, 0]) < 0.):
+        raise ValueError('pwl() takes two or more [time, level] points in increasing time')
+    duration = points[-1, 0] - points[0, 0]
+    return segment(duration, lambda interval: np.interp(points[0, 0] + times(duration, interval), points[:, 0], points[:, 1]))
+
+
+def noise(duration, level=0., std=0.1, seed=0):
+    """Gaussian noise around level; the same seed gives the same samples."""
+    return segment(duration, lambda interval: level + std * np.random.default_rng(seed).standard_normal(num_samples(duration, interval)))
+
+
+def chirp(duration, f0, f1, amplitude=1., level=0., log=False):
+    """A sine whose frequency sweeps from f0 to f1, linearly or, with log, exponentially."""
+    def samples(interval):
+        t = times(duration, interval)
+        if log and (f0 > 0.) and (f1 > 0.) and (f0 != f1):
+            k = math.log(f1 / f0) / duration
+            phase = f0 * np.expm1(k * t) / k
+        else:
+            phase = f0 * t + 0.5 * (f1 - f0) / duration * t * t
+        return level + amplitude * np.sin(2. * math.pi * phase)
+    return segment(duration, samples)
+
+
+def expr(expression, duration):
+    """An expression in t with the functions of a math channel, for example '1 + 0.5 * sin(2 * pi * 3 * t)'."""
+    expression = mathchannels.MathExpression(expression)
+    if expression.variables - {'t'}:
+        raise ValueError('expr() only takes t')
+    def samples(interval):
+        t = times(duration, interval)
+        return expression.evaluate(t, t, t)
+    return segment(duration, samples)
+
+
+SEGMENTS = {'hold': hold, 'ramp': ramp, 'staircase': staircase, 'pwl': pwl, 'noise': noise, 'chirp': chirp, 'expr': expr}
+
+
+def argument(node, description):
+    """Return the value of a segment argument given as an ast node of description."""
+    if isinstance(node, ast.Constant) and isinstance(node.value, (str, bool, int, float)):
+        return node.value
+    elif isinstance(node, (ast.List, ast.Tuple)):
+        return [argument(element, description) for element in node.elts]
+    return mathchannels.constant(ast.get_source_segment(description, node))
+
+
+def parse(description):
+    """Return the segments of description as (text, function, args, kwargs)."""
+    try:
+        tree = ast.parse(description, mode='exec')
+    except SyntaxError as e:
+        raise ValueError('invalid description: {}'.format(e.msg))
+    segments = []
+    for statement in tree.body:
+        text = ast.get_source_segment(description, statement)
+        call = statement.value if isinstance(statement, ast.Expr) else None
+        if not (isinstance(call, ast.Call) and isinstance(call.func, ast.Name) and (call.func.id in SEGMENTS)):
+            raise ValueError('{}: not one of {}()'.format(text, '(), '.join(SEGMENTS)))
+        if any(keyword.arg is None for keyword in call.keywords) or any(isinstance(arg, ast.Starred) for arg in call.args):
+            raise ValueError('{}: unsupported arguments'.format(text))
+        try:
+            args = [argument(arg, description) for arg in call.args]
+            kwargs = {keyword.arg: argument(keyword.value, description) for keyword in call.keywords}
+        except ValueError as e:
+            raise ValueError('{}: {}'.format(text, e)) from e
+        segments.append((text, SEGMENTS[call.func.id], args, kwargs))
+    return segments
+
+
+@functools.lru_cache(maxsize=MAX_CACHED)
+def synthesize(description, interval, max_samples=None):
+    """Return the read-only array of voltages that description produces at the given sample interval.
+
+    Raises ValueError for descriptions that do not parse or evaluate, and,
+    before making any samples, for ones longer than max_samples.
+    """
+    parts = []
+    total = 0
+    for text, function, args, kwargs in parse(description.strip()):
+        try:
+            part = function(*args, **kwargs)
+            total += num_samples(part.duration, interval)
+        except Exception as e:
+            raise ValueError('{}: {}'.format(text, e)) from e
+        parts.append((text, part))
+    if (max_samples is not None) and (total > max_samples):
+        raise ValueError('{:d} points is more than the {:d} that fit; use a longer interval or a shorter waveform'.format(total, max_samples))
+    segments = []
+    for text, part in parts:
+        try:
+            segments.append(np.asarray(part(interval), dtype=np.float64))
+        except Exception as e:
+            raise ValueError('{}: {}'.format(text, e)) from e
+    voltages = np.concatenate(segments) if segments else np.zeros(0)
+    voltages.flags.writeable = False
+    return voltages
+
+
+_codes = collections.OrderedDict()
+
+
+def codes(dev, description, interval, max_samples=None):
+    """Return the read-only array of offset DAC codes for description on dev, cached with the calibration."""
+    key = (description, interval, dev.vo_gain, dev.vo_zero)
+    if key in _codes:
+        _codes.move_to_end(key)
+        if (max_samples is not None) and (len(_codes[key]) > max_samples):
+            raise ValueError('{:d} points is more than the {:d} that fit; use a longer interval or a shorter waveform'.format(len(_codes[key]), max_samples))
+        return _codes[key]
+    result = dev.offset_waveform_codes(synthesize(description, interval, max_samples))
+    result.flags.writeable = False
+    _codes[key] = result
+    if len(_codes) > MAX_CACHED:
+        _codes.popitem(last=False)
+    return result
+
+
+def voltages(dev, codes):
+    """Return the voltages that the board produces for codes."""
+    return 5e-3 * dev.vo_gain * (np.asarray(codes, dtype=np.float64) - dev.vo_zero)
+
+
+if __name__ == '__main__':
+    import time
+
+    import offsetupload
+    import simscope
+
+    interval = 1e-3
+    description = 'hold(0, 0.5); ramp(0, 2, 1); staircase(2, 0, 5, 1); pwl([[0, 0], [0.2, 1], [0.4, -1], [0.5, 0]]); chirp(2, 1, 20, 0.5, 1); noise(1, 1, 0.1); expr("1 + 0.5 * sin(2 * pi * 3 * t)", 1)'
+    start = time.perf_counter()
+    v = synthesize(description, interval)
+    elapsed = time.perf_counter() - start
+    print('{} samples over {:g} s in {:.2f} ms'.format(len(v), len(v) * interval, 1e3 * elapsed))
+    assert len(v) == round((0.5 + 1. + 1. + 0.5 + 2. + 1. + 1.) / interval)
+    assert np.all(v[:500] == 0.) and abs(v[1499] - 2. * 999. / 1000.) < 1e-12
+    assert np.allclose(np.unique(v[1500:2500]), np.linspace(0., 2., 5))
+    assert abs(v[2500 + 200] - 1.) < 1e-12 and abs(v[2500 + 400] + 1.) < 1e-12
+    chirp_samples = v[3000:5000]
+    assert abs(chirp_samples.max() - 1.5) < 1e-3 and abs(chirp_samples.min() - 0.5) < 1e-3
+    assert abs(v[5000:6000].mean() - 1.) < 0.02 and abs(v[5000:6000].std() - 0.1) < 0.01
+    assert abs(v[6000] - 1.) < 1e-12 and abs(v[6000 + 83] - (1. + 0.5 * math.sin(2. * math.pi * 3. * 0.083))) < 1e-12
+    # a log chirp passes through the geometric mean frequency half way
+    log_chirp = chirp(2., 1., 100., log=True)(1e-4)
+    crossings = np.flatnonzero(np.diff(np.sign(log_chirp)) > 0)
+    index = np.searchsorted(crossings, 10000)
+    assert abs(1. / (1e-4 * (crossings[index] - crossings[index - 1])) - 10.) < 1.
+
+    # cached by the description and interval
+    start = time.perf_counter()
+    assert synthesize(description, interval) is v
+    assert 1e3 * (time.perf_counter() - start) < 0.1
+    assert not v.flags.writeable
+    start = time.perf_counter()
+    assert len(synthesize(description, 2e-3)) == len(v) // 2
+    print('{} samples at 2 ms in {:.2f} ms'.format(len(v) // 2, 1e3 * (time.perf_counter() - start)))
+    # a semicolon inside a string does not split the segment, and arguments
+    # can be arithmetic on numbers
+    assert len(synthesize('hold(-1 / 2, 2 * pi / 100); ramp(0, 1, 1e-2)', interval)) == 63 + 10
+    try:
+        synthesize('expr("1; hold(0, 1)", 1)', interval)
+    except ValueError as e:
+        assert str(e).startswith('expr("1; hold(0, 1)", 1): ')
+    else:
+        raise AssertionError('split inside a string')
+    for bad in ('ramp(0, 2)', 'foo(1)', 'pwl([[0, 1]])', 'expr("t +", 1)', '__import__("os")', 'expr("ch1", 1)',
+                'hold(().__class__, 1)', 'expr("().__class__.__base__.__subclasses__()", 1)', 'hold(1, 1) + hold(2, 1)',
+                'x = hold(1, 1)', 'hold(*[1, 1])', 'hold(1, 1);; hold(2, 1)'):
+        try:
+            synthesize(bad, interval)
+        except ValueError as e:
+            print('rejected {!r}: {}'.format(bad, e))
+        else:
+            raise AssertionError(bad)
+
+    # too long a waveform is turned down before any samples are made
+    for long in ('hold(0, 1e6)', 'ramp(0, 1, 1e300)', 'hold(0, 1); staircase(0, 1, 1e12, 1e9)', 'expr("t", 3e9)'):
+        start = time.perf_counter()
+        try:
+            synthesize(long, interval, 8000)
+        except ValueError as e:
+            assert 'more than the 8000 that fit' in str(e), e
+        else:
+            raise AssertionError(long)
+        assert time.perf_counter() - start < 0.01
+    assert len(synthesize('hold(0, 4); ramp(0, 1, 4)', interval, 8000)) == 8000
+    try:
+        synthesize('hold(0, 1e400)', interval, 8000)
+    except ValueError as e:
+        print('rejected {!r}: {}'.format('hold(0, 1e400)', e))
+    else:
+        raise AssertionError('hold(0, 1e400)')
+
+    # quantized with the calibration, and straight to the board
+    dev = simscope.SimulatedScope(seed=0)
+    dev.vo_gain = 1.02
+    dev.vo_zero = 511.5
+    c = codes(dev, description, interval)
+    assert codes(dev, description, interval) is c
+    assert np.abs(voltages(dev, c) - np.clip(v, voltages(dev, 0), voltages(dev, 1023))).max() <= 2.5e-3 * dev.vo_gain + 1e-12
+    dev.vo_zero = 512.
+    assert codes(dev, description, interval) is not c
+    upload = offsetupload.OffsetWaveformUpload(dev, codes(dev, description, interval))
+    upload.start()
+    upload.join()
+    assert upload.result == 'ok'
+    assert np.array_equal(dev.read_offset_waveform(), codes(dev, description, interval))
+    print('OK')
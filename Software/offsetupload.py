@@ -0,0 +1,211 @@
+"""
+Offset-waveform upload for Whoa-Scope.
+Programs an arbitrary offset waveform into the board's flash from a
+background thread, so that the GUI keeps running while a long waveform
+goes out.  The samples are sent in packets as long as the firmware's
+command buffer allows, back to back, and the waveform is read back once in
+bulk at the end to verify it, rather than after every few samples.  The
+upload reports its progress and can be cancelled between packets; a
+cancelled upload leaves an empty waveform on the board.  Pages that already
+hold the right samples are not touched, so re-uploading an edited waveform
+only rewrites the pages around the edits.
+"""
+
+import threading
+
+import numpy as np
+
+
+def load_voltages(filename):
+    """Return the offset voltages in a text file with one value per line."""
+    return np.loadtxt(filename, ndmin=1)
+
+
+class OffsetWaveformUpload(threading.Thread):
+    """Worker thread that uploads an offset waveform, given as 10-bit codes, to an oscope.
+
+    progress goes from 0 to 1 as packets are written.  Once the thread has
+    finished, done is set and result is 'ok', 'mismatch' if the read back
+    differs, 'cancelled', or 'error' with the exception in error.  Each
+    of the oscope's commands and its reply is a transaction under the
+    oscope's lock, so the board can still be used from other threads while
+    the upload is running; their commands go out between its packets.
+    """
+
+    def __init__(self, dev, codes):
+        super(OffsetWaveformUpload, self).__init__(name='offset-upload', daemon=True)
+        self.dev = dev
+        self.codes = np.asarray(codes, dtype=np.uint16)
+        self.progress = 0.
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        try:
+            for done in self.dev.upload_offset_waveform(self.codes):
+                self.progress = done
+                if self.cancelled.is_set():
+                    self.result = 'cancelled'
+                    return
+            self.progress = 1.
+            self.result = 'ok' if self.dev.verify_flash() else 'mismatch'
+        except Exception as e:
+            self.error = e
+            self.result = 'error'
+        finally:
+            self.done.set()
+
+
+if __name__ == '__main__':
+    import time
+
+    import simscope
+
+    # what write_offset_waveform_as_voltages() did before: 8 samples per
+    # FLASH:WRITE, each followed by a FLASH:READ of the same samples
+    def write_and_verify_each_packet(dev, samples):
+        samples = [len(samples)] + [int(sample) for sample in samples]
+        starting_address = dev.OFFSET_WAVEFORM_ADDRESS
+        num_pages = 1 + len(samples) // 0x200
+        for address in range(starting_address, starting_address + num_pages * 0x400, 0x400):
+            dev.erase_flash(address)
+        address = starting_address
+        for start in range(0, len(samples), 8):
+            vals = []
+            for sample in samples[start:start + 8]:
+                vals.extend((sample & 0x00FF, sample >> 8, 0, 0))
+            dev.write_flash(address, vals)
+            read_vals = dev.read_flash(address, len(vals))
+            assert read_vals == vals
+            address += 16
+
+    # rough cost on hardware: a USB round trip per reply, about 1 Mbit/s
+    # of command text and 1.5 ms per row written
+    def modelled_time(port):
+        return 2e-3 * port.num_replies + 10. * port.bytes_written / 1e6 + 1.5e-3 * (port.num_commands - port.num_replies)
+
+    rng = np.random.default_rng(0)
+    dev = simscope.SimulatedScope(seed=0)
+    port = dev.dev
+    dev.vo_gain = 1.02
+    dev.vo_zero = 511.5
+
+    print('{:>8s} {:>6s} {:>9s} {:>9s} {:>9s} {:>6s}'.format('samples', 'method', 'commands', 'replies', 'modelled', 'ms'))
+    for num_samples in (100, 1000, 4000):
+        t = np.arange(num_samples) / num_samples
+        voltages = 2. * np.sin(2. * np.pi * 3. * t) + 0.1 * rng.standard_normal(num_samples)
+        codes = dev.offset_waveform_codes(voltages)
+        results = {}
+        for method in ('old', 'new'):
+            port.flash = {}
+            dev.flash_pages = {}
+            [port.num_commands, port.num_replies, port.bytes_written] = [0, 0, 0]
+            start = time.perf_counter()
+            if method == 'old':
+                write_and_verify_each_packet(dev, codes)
+            else:
+                upload = OffsetWaveformUpload(dev, codes)
+                upload.start()
+                upload.join()
+                assert upload.result == 'ok', upload.result
+            elapsed = time.perf_counter() - start
+            results[method] = modelled_time(port)
+            print('{:8d} {:>6s} {:9d} {:9d} {:8.2f}s {:6.1f}'.format(num_samples, method, port.num_commands, port.num_replies, results[method], 1e3 * elapsed))
+            assert np.array_equal(dev.read_offset_waveform(), codes)
+        assert port.dropped_commands == 0
+        assert results['new'] < 0.6 * results['old']
+
+    # re-uploading an edited waveform rewrites the page around the edit, the
+    # first one and the one holding the CRC, and reading it back is two
+    # short reads
+    codes = codes.copy()
+    for label, edit in (('same', None), ('edited', slice(2500, 2510))):
+        if edit is not None:
+            codes[edit] = 1023 - codes[edit]
+        [port.num_commands, port.num_replies, port.bytes_written] = [0, 0, 0]
+        assert dev.write_offset_waveform(codes)
+        [commands, replies] = [port.num_commands, port.num_replies]
+        assert np.array_equal(dev.read_offset_waveform(), codes)
+        print('{:>8s} {:>6s} {:9d} {:9d} {:8.2f}s, read back with {} replies'.format(label, 'new', commands, replies, modelled_time(port), port.num_replies - replies))
+        assert port.num_replies - replies == 2
+        # an erase and six packets per row for each page
+        assert commands <= (0 if edit is None else 3 * (1 + 8 * 6))
+    # the cache notices when another program rewrites the waveform
+    other = simscope.SimulatedScope()
+    other.dev = port
+    write_and_verify_each_packet(other, 1023 - codes)
+    assert np.array_equal(dev.read_offset_waveform(), 1023 - codes)
+
+    # calibration values are rewritten only when they change
+    dev.flash_pages = {}
+    dev.read_calibration_vals()
+    [port.num_commands, port.num_replies] = [0, 0]
+    dev.write_calibration_vals()
+    dev.write_calibration_vals()
+    first = port.num_commands
+    dev.vo_zero = 500.25
+    dev.write_calibration_vals()
+    print('calibration: {} commands to write, none to write again, {} to change one value'.format(first, port.num_commands - first))
+    reloaded = simscope.SimulatedScope()
+    reloaded.dev.flash = port.flash
+    reloaded.dev.num_replies = 0
+    reloaded.flash_pages = {}
+    reloaded.read_calibration_vals()
+    assert reloaded.vo_zero == 500.25 and abs(reloaded.vo_gain - dev.vo_gain) < 1. / 32768.
+    assert reloaded.dev.num_replies == 1
+
+    # the quantization matches the line-by-line parser
+    for voltage in np.linspace(-3., 3., 61):
+        val = int(voltage / (5e-3 * dev.vo_gain) + dev.vo_zero + 0.5)
+        val = val if val > 0 else 0
+        val = val if val < 1023 else 1023
+        assert dev.offset_waveform_codes([voltage])[0] == val, voltage
+
+    # packets fill the command buffer and never cross a row
+    vals = [0xFF, 3, 0, 0] * 1000
+    for address, packet in dev.flash_packets(dev.OFFSET_WAVEFORM_ADDRESS + 2, vals):
+        command = 'FLASH:WRITE {:X},{:X}'.format(address >> 16, address & 0xFFFF) + ''.join(',{:X}'.format(val) for val in packet)
+        assert len(command) <= dev.MAX_COMMAND_LENGTH
+        assert address // dev.FLASH_ROW_SIZE == (address + len(packet) // 2 - 2) // dev.FLASH_ROW_SIZE
+
+    # a cancelled upload leaves an empty waveform
+    upload = OffsetWaveformUpload(dev, np.arange(2000) % 1024)
+    upload.cancel()
+    upload.start()
+    upload.join()
+    assert upload.result == 'cancelled' and dev.read_offset_waveform() == []
+    upload = OffsetWaveformUpload(dev, np.arange(2000) % 1024)
+    upload.start()
+    upload.join()
+    assert upload.result == 'ok' and dev.read_offset_waveform() == list(np.arange(2000) % 1024)
+    # the GUI keeps talking to the board during an upload
+    codes = (np.arange(4000) * 7) % 1024
+    upload = OffsetWaveformUpload(dev, codes)
+    upload.start()
+    num_queries = 0
+    while not upload.done.is_set():
+        frequency = 100. * (1 + num_queries % 50)
+        dev.set_freq(frequency)
+        assert abs(dev.get_freq() - frequency) < 1e-3 * frequency
+        port.dig_levels[num_queries % 4] ^= 1
+        assert dev.dig_read_pins() == [port.dig_levels[pin] for pin in range(4)]
+        num_queries += 1
+    upload.join()
+    print('{} queries answered during an upload'.format(num_queries))
+    assert upload.result == 'ok' and np.array_equal(dev.read_offset_waveform(), codes)
+    assert port.dropped_commands == 0 and port.output == b''
+    # and the file front end
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, 'offset.txt')
+        np.savetxt(filename, np.linspace(-1., 1., 300))
+        assert dev.write_offset_waveform_as_voltages(filename)
+        assert np.allclose(dev.read_offset_waveform_as_voltages(), np.linspace(-1., 1., 300), atol=5.2e-3 * dev.vo_gain / 2.)
+        assert not dev.write_offset_waveform_as_voltages(os.path.join(folder, 'missing.txt'))
+    print('OK')
@@ -1,16 +1,23 @@
 import serial
 import serial.tools.list_ports as list_ports
-import string, array
+import string, array, math, binascii
+import functools, inspect, threading
+import numpy as np
 
 class oscope:
 
     def __init__(self, port = ''):
+        # held for every command and its reply; see _transaction() below
+        self.lock = threading.RLock()
+
         self.FCY = 16e6
         self.TCY = 62.5e-9
         self.timer_multipliers = [self.TCY, 8. * self.TCY, 64. * self.TCY, 256. * self.TCY]
 
         self.SCOPE_BUFFER_SIZE = 3000
 
+        self.avg_Tcy_thresholds = (0, 42, 50, 66, 98)
+
         self.volts_per_lsb = (5e-3, 1e-3)
 
         self.ch1_zero = [[2048., 2048.], 
@@ -51,6 +58,41 @@ class oscope:
         self.vo_gain = 1.
         self.vo_zero = 0.
 
+        # program memory is addressed in PC units, two per instruction; a 
+        # FLASH:WRITE programs part of one row and FLASH:ERASE a whole page
+        self.FLASH_ROW_SIZE = 0x80
+        self.FLASH_PAGE_SIZE = 0x400
+        self.OFFSET_WAVEFORM_ADDRESS = 0x10400
+        # the offset waveform runs up to the end of program memory, less the 
+        # sample count and the CRC
+        self.MAX_OFFSET_SAMPLES = (0x15400 - 0x10400) // 2 - 2
+        # longest command that fits the firmware's 128-character command 
+        # buffer along with the terminating carriage return
+        self.MAX_COMMAND_LENGTH = 126
+        # how an erased instruction reads back
+        self.FLASH_ERASED = [0xFF, 0xFF, 0xFF, 0x00]
+        # last known contents of flash pages, and the pages programmed 
+        # since the last verify_flash()
+        self.flash_pages = {}
+        self.flash_unverified = set()
+
+        self.ch1_range = 0
+        self.ch2_range = 0
+        self.interval_vals = [0, 0]
+        self.sampling_interval = self.TCY
+        self.max_avg = 0
+        self.num_avg = 0
+        self.wg_range = 0
+        self.shape_val = 0
+        self.freq_vals = [0, 0]
+        self.phase_val = 0
+        self.amplitude_val = 0
+        self.offset_val = 0
+        self.sq_offset_adj = 0
+        self.nsq_offset_adj = 0
+        self.dig_modes = [0, 0, 0, 0]
+        self.dig_ods = [0, 0, 0, 0]
+
         if port == '':
             self.dev = None
             self.connected = False
@@ -75,12 +117,44 @@ class oscope:
 
         if self.connected:
             self.write('')
-            self.num_avg = self.get_num_avg()
-            self.sampling_interval = self.get_period()
-            self.ch1_range = self.get_ch1range()
-            self.ch2_range = self.get_ch2range()
+            self.refresh()
             self.read_calibration_vals()
 
+    def refresh(self):
+        if self.connected:
+            self.write('SCOPE:CH1GAIN?')
+            self.ch1_range = int(self.read(), 16)
+            self.write('SCOPE:CH2GAIN?')
+            self.ch2_range = int(self.read(), 16)
+            self.write('SCOPE:INTERVAL?')
+            self.interval_vals = [int(val, 16) for val in self.read().split(',')]
+            self.sampling_interval = self.interval2period(*self.interval_vals)
+            self.write('SCOPE:MAXAVG?')
+            self.max_avg = int(self.read(), 16)
+            self.write('SCOPE:NUMAVG?')
+            self.num_avg = int(self.read(), 16)
+            self.write('WAVEGEN:GAIN?')
+            self.wg_range = int(self.read(), 16)
+            self.write('WAVEGEN:SHAPE?')
+            self.shape_val = int(self.read(), 16)
+            self.write('WAVEGEN:FREQ?')
+            self.freq_vals = [int(val, 16) for val in self.read().split(',')]
+            self.write('WAVEGEN:PHASE?')
+            self.phase_val = int(self.read(), 16)
+            self.write('WAVEGEN:AMPLITUDE?')
+            self.amplitude_val = int(self.read(), 16)
+            self.write('WAVEGEN:OFFSET?')
+            self.offset_val = int(self.read(), 16)
+            self.write('WAVEGEN:SQADJ?')
+            self.sq_offset_adj = int(self.read(), 16)
+            self.write('WAVEGEN:NSQADJ?')
+            self.nsq_offset_adj = int(self.read(), 16)
+            for pin in range(4):
+                self.write('DIG:MODE? {:X}'.format(pin))
+                self.dig_modes[pin] = int(self.read(), 16)
+                self.write('DIG:OD? {:X}'.format(pin))
+                self.dig_ods[pin] = int(self.read(), 16)
+
     def write(self, command):
         if self.connected:
             self.dev.write('{!s}\r'.format(command).encode())
@@ -136,29 +210,30 @@ class oscope:
     def set_ch1gain(self, val):
         if self.connected:
             self.write('SCOPE:CH1GAIN {:X}'.format(int(val)))
+            self.ch1_range = 1 if int(val) else 0
 
     def get_ch1gain(self):
         if self.connected:
-            self.write('SCOPE:CH1GAIN?')
-            return int(self.read(), 16)
+            return self.ch1_range
 
     def set_ch2gain(self, val):
         if self.connected:
             self.write('SCOPE:CH2GAIN {:X}'.format(int(val)))
+            self.ch2_range = 1 if int(val) else 0
 
     def get_ch2gain(self):
         if self.connected:
-            self.write('SCOPE:CH2GAIN?')
-            return int(self.read(), 16)
+            return self.ch2_range
 
     def dig_set_mode(self, pin, mode):
         if self.connected:
             self.write('DIG:MODE {:X},{:X}'.format(int(pin), int(mode)))
+            if (0 <= int(pin) < 4) and (0 <= int(mode) <= 3):
+                self.dig_modes[int(pin)] = int(mode)
 
     def dig_get_mode(self, pin):
         if self.connected:
-            self.write('DIG:MODE? {:X}'.format(int(pin)))
-            return int(self.read(), 16)
+            return self.dig_modes[int(pin)] if 0 <= int(pin) < 4 else 0xFFFF
 
     def dig_set(self, pin):
         if self.connected:
@@ -181,14 +256,26 @@ class oscope:
             self.write('DIG:READ {:X}'.format(int(pin)))
             return int(self.read(), 16)
 
+    def dig_read_pins(self, pins = (0, 1, 2, 3)):
+        # The firmware has no command that reads all of the pins at once, so
+        # the reads go out back to back in one write and the replies are
+        # collected afterward, for one round trip however many pins are read.
+        if self.connected:
+            pins = [int(pin) for pin in pins]
+            if not pins:
+                return []
+            self.dev.write(''.join('DIG:READ {:X}\r'.format(pin) for pin in pins).encode())
+            return [int(self.read(), 16) for pin in pins]
+
     def dig_set_od(self, pin, val):
         if self.connected:
             self.write('DIG:OD {:X},{:X}'.format(int(pin), int(val)))
+            if 0 <= int(pin) < 4:
+                self.dig_ods[int(pin)] = 1 if int(val) else 0
 
     def dig_get_od(self, pin):
         if self.connected:
-            self.write('DIG:OD? {:X}'.format(int(pin)))
-            return int(self.read(), 16)
+            return self.dig_ods[int(pin)] if 0 <= int(pin) < 4 else 0
 
     def dig_set_freq(self, pin, freq):
         if self.connected:
@@ -258,9 +345,13 @@ class oscope:
 
     def trigger(self):
         if self.connected:
-            self.write('SCOPE:TRIGGER')
+            self.trigger_sweep()
             return self.get_bufferbin()
 
+    def trigger_sweep(self):
+        if self.connected:
+            self.write('SCOPE:TRIGGER')
+
     def get_buffer(self):
         if self.connected:
             self.write('SCOPE:BUFFER? 0,{:X}'.format(self.SCOPE_BUFFER_SIZE))
@@ -268,18 +359,26 @@ class oscope:
             vals = ret.split(',')
             return [int(val, 16) >> self.num_avg for val in vals]
 
-    def get_bufferbin(self):
+    def get_bufferbin(self, start = 0, count = None):
         if self.connected:
-            self.write('SCOPE:BUFFERBIN? 0,{:X}'.format(self.SCOPE_BUFFER_SIZE))
-            ret = b''
-            while len(ret) < 2 * self.SCOPE_BUFFER_SIZE:
-                bytes_waiting = self.dev.inWaiting()
-                if bytes_waiting > 0:
-                    ret += self.dev.read(bytes_waiting)
             vals = array.array('H')
-            vals.frombytes(ret)
+            vals.frombytes(self.get_bufferbin_raw(start, count))
             return [int(val) >> self.num_avg for val in vals]
 
+    def get_bufferbin_raw(self, start = 0, count = None):
+        if self.connected:
+            start = min(max(int(start), 0), self.SCOPE_BUFFER_SIZE - 1)
+            count = self.SCOPE_BUFFER_SIZE - start if count is None else min(max(int(count), 1), self.SCOPE_BUFFER_SIZE - start)
+            self.write('SCOPE:BUFFERBIN? {:X},{:X}'.format(start, count))
+            return self.dev.read(2 * count)
+
+    def get_bufferbin_window(self, start, count):
+        if self.connected:
+            num_samples = self.SCOPE_BUFFER_SIZE // 2
+            start = min(max(int(start), 0), num_samples - 1)
+            count = min(max(int(count), 1), num_samples - start)
+            return [self.get_bufferbin(start, count), self.get_bufferbin(num_samples + start, count)]
+
     def set_period(self, period):
         if self.connected:
             if period > 256. * 65536. * self.TCY:
@@ -299,18 +398,39 @@ class oscope:
             else:
                 T2CON = 0x0000
                 PR2 = 3
-            self.write('SCOPE:INTERVAL {:X},{:X}'.format(PR2, T2CON))
-            self.sampling_interval = self.get_period()
-            self.num_avg = self.get_num_avg()
+            self.set_interval_vals(PR2, T2CON)
+
+    def set_interval_vals(self, PR2, T2CON):
+        if self.connected:
+            self.write('SCOPE:INTERVAL {:X},{:X}'.format(int(PR2), int(T2CON)))
+            self.interval_vals = [int(PR2), int(T2CON)]
+            self.update_acquire_mode()
 
     def get_period(self):
         if self.connected:
-            self.write('SCOPE:INTERVAL?')
-            vals = self.read().split(',')
-            PR2 = int(vals[0], 16)
-            T2CON = int(vals[1], 16)
-            prescalar = (T2CON & 0x0030) >> 4
-            return self.timer_multipliers[prescalar] * (float(PR2) + 1.)
+            return self.sampling_interval
+
+    def interval2period(self, PR2, T2CON):
+        prescalar = (T2CON & 0x0030) >> 4
+        return self.timer_multipliers[prescalar] * (float(PR2) + 1.)
+
+    def acquire_mode(self, PR2, T2CON, max_avg):
+        # mirrors update_acquire_mode() in the firmware, which picks num_avg 
+        # from PR2 and max_avg and clamps PR2 when sampling at 4MSps; 
+        # returns [PR2, num_avg] without changing any settings
+        if (T2CON & 0x0030) == 0:
+            num_avg = max_avg
+            while (num_avg > 0) and (PR2 < self.avg_Tcy_thresholds[num_avg]):
+                num_avg -= 1
+        else:
+            num_avg = max_avg
+        if (num_avg == 0) and ((T2CON & 0x0030) == 0) and (PR2 < 7):
+            PR2 = 3
+        return [PR2, num_avg]
+
+    def update_acquire_mode(self):
+        [self.interval_vals[0], self.num_avg] = self.acquire_mode(self.interval_vals[0], self.interval_vals[1], self.max_avg)
+        self.sampling_interval = self.interval2period(*self.interval_vals)
 
     def get_sweep_progress(self):
         if self.connected:
@@ -325,7 +445,6 @@ class oscope:
     def set_ch1range(self, val):
         if self.connected:
             self.set_ch1gain(val)
-            self.ch1_range = self.get_ch1range()
 
     def get_ch1range(self):
         if self.connected:
@@ -334,7 +453,6 @@ class oscope:
     def set_ch2range(self, val):
         if self.connected:
             self.set_ch2gain(val)
-            self.ch2_range = self.get_ch2range()
 
     def get_ch2range(self):
         if self.connected:
@@ -343,92 +461,148 @@ class oscope:
     def set_max_avg(self, val):
         if self.connected:
             self.write('SCOPE:MAXAVG {:X}'.format(val))
-            self.num_avg = self.get_num_avg()
+            if 0 <= int(val) < 5:
+                self.max_avg = int(val)
+                self.update_acquire_mode()
 
     def get_max_avg(self):
         if self.connected:
-            self.write('SCOPE:MAXAVG?')
-            return int(self.read(), 16)
+            return self.max_avg
 
     def get_num_avg(self):
         if self.connected:
-            self.write('SCOPE:NUMAVG?')
-            return int(self.read(), 16)
+            return self.num_avg
 
     def set_wgrange(self, val):
         if self.connected:
             self.write('WAVEGEN:GAIN {:X}'.format(int(val)))
+            self.wg_range = 1 if int(val) else 0
 
     def get_wgrange(self):
         if self.connected:
-            self.write('WAVEGEN:GAIN?')
-            return int(self.read(), 16)
+            return self.wg_range
 
     def set_shape_val(self, val):
         if self.connected:
             self.write('WAVEGEN:SHAPE {:X}'.format(int(val)))
+            if 0 <= int(val) <= 3:
+                self.shape_val = int(val)
 
     def get_shape_val(self):
         if self.connected:
-            self.write('WAVEGEN:SHAPE?')
-            return int(self.read(), 16)
+            return self.shape_val
 
     def set_freq_vals(self, val1, val2):
         if self.connected:
             self.write('WAVEGEN:FREQ {:X},{:X}'.format(int(val1), int(val2)))
+            self.freq_vals = [int(val1), int(val2)]
 
     def get_freq_vals(self):
         if self.connected:
-            self.write('WAVEGEN:FREQ?')
-            ret = self.read()
-            vals = ret.split(',')
-            return [int(val, 16) for val in vals]
+            return list(self.freq_vals)
 
     def set_phase_val(self, val):
         if self.connected:
             self.write('WAVEGEN:PHASE {:X}'.format(int(val)))
+            self.phase_val = int(val) & 0xFFFF
 
     def get_phase_val(self):
         if self.connected:
-            self.write('WAVEGEN:PHASE?')
-            return int(self.read(), 16)
+            return self.phase_val
 
     def set_amplitude_val(self, val):
         if self.connected:
             self.write('WAVEGEN:AMPLITUDE {:X}'.format(int(val)))
+            self.amplitude_val = int(val) & 0xFF
 
     def get_amplitude_val(self):
         if self.connected:
-            self.write('WAVEGEN:AMPLITUDE?')
-            return int(self.read(), 16)
+            return self.amplitude_val
 
     def set_offset_val(self, val):
         if self.connected:
             self.write('WAVEGEN:OFFSET {:X}'.format(int(val)))
+            self.offset_val = int(val) & 0x03FF
 
     def get_offset_val(self):
         if self.connected:
-            self.write('WAVEGEN:OFFSET?')
-            return int(self.read(), 16)
+            return self.offset_val
 
     def set_sq_offset_adj(self, val):
         if self.connected:
             self.write('WAVEGEN:SQADJ {:X}'.format(int(val)))
+            self.sq_offset_adj = int(val) & 0x03FF
 
     def get_sq_offset_adj(self):
         if self.connected:
-            self.write('WAVEGEN:SQADJ?')
-            return int(self.read(), 16)
+            return self.sq_offset_adj
 
     def set_nsq_offset_adj(self, val):
         if self.connected:
             self.write('WAVEGEN:NSQADJ {:X}'.format(int(val)))
+            self.nsq_offset_adj = int(val) & 0x03FF
 
     def get_nsq_offset_adj(self):
         if self.connected:
-            self.write('WAVEGEN:NSQADJ?')
+            return self.nsq_offset_adj
+
+    def set_offset_interval(self, interval):
+        if self.connected:
+            if interval > 256. * 65536. * self.TCY:
+                return
+            elif interval > 64. * 65536. * self.TCY:
+                T3CON = 0x0030
+                PR3 = int(interval * (self.FCY / 256.)) - 1
+            elif interval > 8. * 65536. * self.TCY:
+                T3CON = 0x0020
+                PR3 = int(interval * (self.FCY / 64.)) - 1
+            elif interval > 65536. * self.TCY:
+                T3CON = 0x0010
+                PR3 = int(interval * (self.FCY / 8.)) - 1
+            elif interval >= 8. * self.TCY:
+                T3CON = 0x0000
+                PR3 = int(interval * self.FCY) - 1
+            else:
+                T3CON = 0x0000
+                PR3 = 3
+            self.write('WAVEGEN:OFFSET:INTERVAL {:X},{:X}'.format(PR3, T3CON))
+
+    def get_offset_interval(self):
+        if self.connected:
+            self.write('WAVEGEN:OFFSET:INTERVAL?')
+            vals = self.read().split(',')
+            PR3 = int(vals[0], 16)
+            T3CON = int(vals[1], 16)
+            prescalar = (T3CON & 0x0030) >> 4
+            return self.timer_multipliers[prescalar] * (float(PR3) + 1.)
+
+    def set_offset_mode(self, val):
+        if self.connected:
+            self.write('WAVEGEN:OFFSET:MODE {:X}'.format(int(val)))
+
+    def get_offset_mode(self):
+        if self.connected:
+            self.write('WAVEGEN:OFFSET:MODE?')
             return int(self.read(), 16)
 
+    def offset_start(self):
+        if self.connected:
+            self.write('WAVEGEN:OFFSET:START')
+
+    def offset_stop(self):
+        if self.connected:
+            self.write('WAVEGEN:OFFSET:STOP')
+
+    def offset_get_sweep_progress(self):
+        if self.connected:
+            self.write('WAVEGEN:OFFSET:SWEEP?')
+            vals = self.read().split(',')
+            return [int(val, 16) for val in vals]
+
+    def offset_sweep_in_progress(self):
+        if self.connected:
+            return True if self.offset_get_sweep_progress()[0] != 0 else False
+
     def set_freq(self, freq):
         if self.connected:
             freq_reg_val = int(268435456. * freq / self.MCLK_FREQ + 0.5)
@@ -536,6 +710,7 @@ class oscope:
 
     def write_flash(self, address, values):
         if self.connected:
+            self.flash_pages.pop(self.flash_page_address(address), None)
             cmd = 'FLASH:WRITE {:X},{:X}'.format(int(address) >> 16, int(address) & 0xFFFF)
             for value in values:
                 cmd += ',{:X}'.format(int(value & 0xFF))
@@ -543,186 +718,238 @@ class oscope:
 
     def erase_flash(self, address):
         if self.connected:
+            self.flash_pages.pop(self.flash_page_address(address), None)
             self.write('FLASH:ERASE {:X},{:X}'.format(int(address) >> 16, int(address) & 0xFFFF))
 
+    def flash_page_address(self, address):
+        return int(address) & ~(self.FLASH_PAGE_SIZE - 1)
+
+    def read_flash_page(self, page):
+        """Return the contents of the flash page at page as bytes, four per instruction, from the cache if it is there."""
+        if self.connected and page not in self.flash_pages:
+            self.flash_pages[page] = bytes(self.read_flash(page, 2 * self.FLASH_PAGE_SIZE))
+        return self.flash_pages.get(page, b'')
+
+    def read_flash_cached(self, address, num_bytes):
+        """Like read_flash(), but through the page cache."""
+        vals = []
+        address = int(address)
+        while len(vals) < num_bytes:
+            page = self.flash_page_address(address)
+            offset = 2 * (address - page)
+            count = min(num_bytes - len(vals), 2 * self.FLASH_PAGE_SIZE - offset)
+            chunk = self.read_flash_page(page)[offset:offset + count]
+            if not chunk:
+                break
+            vals.extend(chunk)
+            address += count // 2
+        return vals
+
+    def flash_image(self, address, values):
+        """Return {page: bytes} for the pages holding values from address, erased everywhere else."""
+        pages = {}
+        end = address + len(values) // 2
+        for page in range(self.flash_page_address(address), end, self.FLASH_PAGE_SIZE):
+            image = bytearray(self.FLASH_ERASED * (self.FLASH_PAGE_SIZE // 2))
+            lo = max(address, page)
+            hi = min(end, page + self.FLASH_PAGE_SIZE)
+            image[2 * (lo - page):2 * (hi - page)] = bytes(int(value) & 0xFF for value in values[2 * (lo - address):2 * (hi - address)])
+            pages[page] = bytes(image)
+        return pages
+
+    def program_flash(self, address, values):
+        """Make the pages holding values from address read back as values and erased elsewhere, yielding the fraction done after each packet.
+
+        Pages whose contents are already known to match, from the cache or 
+        from reading them once, are left alone, and only the rows of a page 
+        that are not blank get programmed.  If anything changes, the first 
+        page is erased before and programmed after all the others, with its 
+        first instruction last, since that is where the offset waveform and 
+        the calibration keep what says that the data is there; a write that 
+        stops part way then leaves that instruction erased.
+        """
+        pages = sorted(self.flash_image(address, values).items())
+        changed = [[page, image] for page, image in pages if self.read_flash_page(page) != image]
+        if not changed:
+            return
+        if changed[0][0] != pages[0][0]:
+            changed.insert(0, list(pages[0]))
+
+        erased_instruction = bytes(self.FLASH_ERASED)
+        packets = []
+        for page, image in changed:
+            page_packets = []
+            for row in range(page, page + self.FLASH_PAGE_SIZE, self.FLASH_ROW_SIZE):
+                instructions = [image[offset:offset + 4] for offset in range(2 * (row - page), 2 * (row - page + self.FLASH_ROW_SIZE), 4)]
+                used = [index for index, instruction in enumerate(instructions) if instruction != erased_instruction]
+                if used:
+                    page_packets.extend(self.flash_packets(row + 2 * used[0], list(b''.join(instructions[used[0]:used[-1] + 1]))))
+            packets.append(page_packets)
+        packets = packets[1:] + [packets[0][::-1]]
+        changed = changed[1:] + changed[:1]
+        total = max(sum(len(packet) for page_packets in packets for [packet_address, packet] in page_packets), 1)
+
+        self.erase_flash(changed[-1][0])
+        done = 0
+        for [page, image], page_packets in zip(changed, packets):
+            if page != changed[-1][0]:
+                self.erase_flash(page)
+            for packet_address, packet in page_packets:
+                self.write_flash(packet_address, packet)
+                done += len(packet)
+                yield done / total
+            self.flash_pages[page] = image
+            self.flash_unverified.add(page)
+
+    def verify_flash(self):
+        """Read back every page programmed since the last call in bulk and return whether they all match the cache."""
+        ok = True
+        for page in sorted(self.flash_unverified):
+            image = self.flash_pages.pop(page, None)
+            if self.read_flash_page(page) != image:
+                ok = False
+        self.flash_unverified = set()
+        return ok
+
     def read_calibration_vals(self):
         if self.connected:
+            # one read of the whole page rather than one per value
             for num_avg in range(5):
                 for ch_range in range(2):
-                    vals = self.read_flash(0x10000 + 2 * (2 * num_avg + ch_range), 4)
+                    vals = self.read_flash_cached(0x10000 + 2 * (2 * num_avg + ch_range), 4)
                     if (vals[0] != 255) or (vals[1] != 255) or (vals[2] != 255):
                         self.ch1_zero[num_avg][ch_range] = (vals[0] + 256 * vals[1]) / 16.
 
             for num_avg in range(5):
                 for ch_range in range(2):
-                    vals = self.read_flash(0x10014 + 2 * (2 * num_avg + ch_range), 4)
+                    vals = self.read_flash_cached(0x10014 + 2 * (2 * num_avg + ch_range), 4)
                     if (vals[0] != 255) or (vals[1] != 255) or (vals[2] != 255):
                         self.ch2_zero[num_avg][ch_range] = (vals[0] + 256 * vals[1]) / 16.
 
             for ch_range in range(2):
-                vals = self.read_flash(0x10028 + 2 * ch_range, 4)
+                vals = self.read_flash_cached(0x10028 + 2 * ch_range, 4)
                 if (vals[0] != 255) or (vals[1] != 255) or (vals[2] != 255):
                     self.ch1_zero_4MSps[ch_range] = (vals[0] + 256 * vals[1]) / 16.
 
             for ch_range in range(2):
-                vals = self.read_flash(0x1002C + 2 * ch_range, 4)
+                vals = self.read_flash_cached(0x1002C + 2 * ch_range, 4)
                 if (vals[0] != 255) or (vals[1] != 255) or (vals[2] != 255):
                     self.ch2_zero_4MSps[ch_range] = (vals[0] + 256 * vals[1]) / 16.
 
             for num_avg in range(5):
                 for ch_range in range(2):
-                    vals = self.read_flash(0x10030 + 2 * (2 * num_avg + ch_range), 4)
+                    vals = self.read_flash_cached(0x10030 + 2 * (2 * num_avg + ch_range), 4)
                     if (vals[0] != 255) or (vals[1] != 255) or (vals[2] != 255):
                         self.ch1_gain[num_avg][ch_range] = (vals[0] + 256 * vals[1]) / 32768.
 
             for num_avg in range(5):
                 for ch_range in range(2):
-                    vals = self.read_flash(0x10044 + 2 * (2 * num_avg + ch_range), 4)
+                    vals = self.read_flash_cached(0x10044 + 2 * (2 * num_avg + ch_range), 4)
                     if (vals[0] != 255) or (vals[1] != 255) or (vals[2] != 255):
                         self.ch2_gain[num_avg][ch_range] = (vals[0] + 256 * vals[1]) / 32768.
 
             for ch_range in range(2):
-                vals = self.read_flash(0x10058 + 2 * ch_range, 4)
+                vals = self.read_flash_cached(0x10058 + 2 * ch_range, 4)
                 if (vals[0] != 255) or (vals[1] != 255) or (vals[2] != 255):
                     self.ch1_gain_4MSps[ch_range] = (vals[0] + 256 * vals[1]) / 32768.
 
             for ch_range in range(2):
-                vals = self.read_flash(0x1005C + 2 * ch_range, 4)
+                vals = self.read_flash_cached(0x1005C + 2 * ch_range, 4)
                 if (vals[0] != 255) or (vals[1] != 255) or (vals[2] != 255):
                     self.ch2_gain_4MSps[ch_range] = (vals[0] + 256 * vals[1]) / 32768.
 
-            vals = self.read_flash(0x10060, 4)
+            vals = self.read_flash_cached(0x10060, 4)
             if (vals[0] != 255) or (vals[1] != 255) or (vals[2] != 255):
                 self.set_sq_offset_adj(vals[0] + 256 * vals[1])
 
-            vals = self.read_flash(0x10062, 4)
+            vals = self.read_flash_cached(0x10062, 4)
             if (vals[0] != 255) or (vals[1] != 255) or (vals[2] != 255):
                 self.set_nsq_offset_adj(vals[0] + 256 * vals[1])
 
             for wg_range in range(2):
-                vals = self.read_flash(0x10064 + 2 * wg_range, 4)
+                vals = self.read_flash_cached(0x10064 + 2 * wg_range, 4)
                 if (vals[0] != 255) or (vals[1] != 255) or (vals[2] != 255):
                     self.wg_sq_gain[wg_range] = (vals[0] + 256 * vals[1]) / 32768.
 
             for wg_range in range(2):
-                vals = self.read_flash(0x10068 + 2 * wg_range, 4)
+                vals = self.read_flash_cached(0x10068 + 2 * wg_range, 4)
                 if (vals[0] != 255) or (vals[1] != 255) or (vals[2] != 255):
                     self.wg_nsq_gain[wg_range] = (vals[0] + 256 * vals[1]) / 32768.
 
-            vals = self.read_flash(0x1006C, 4)
+            vals = self.read_flash_cached(0x1006C, 4)
             if (vals[0] != 255) or (vals[1] != 255) or (vals[2] != 255):
                 self.vo_gain = (vals[0] + 256 * vals[1]) / 32768.
 
-            vals = self.read_flash(0x1006E, 4)
+            vals = self.read_flash_cached(0x1006E, 4)
             if (vals[0] != 255) or (vals[1] != 255) or (vals[2] != 255):
                 val = ((vals[0] + 256 * vals[1]) & 0x7FFF) / 32.
                 self.vo_zero = val if vals[1] < 128 else -val
 
     def write_calibration_vals(self):
         if self.connected:
-            self.erase_flash(0x10000)
+            # everything from 0x10000 to 0x1006F, in order
+            vals = []
 
             for num_avg in range(5):
-                vals = []
                 for ch_range in range(2):
                     val = int(round(16. * self.ch1_zero[num_avg][ch_range]))
                     vals.append(val & 0x00FF)
                     vals.append(val >> 8)
                     vals.append(0)
                     vals.append(0)
-                self.write_flash(0x10000 + 4 * num_avg, vals)
-                read_vals = self.read_flash(0x10000 + 4 * num_avg, len(vals))
-                if not all([read_vals[i] == vals[i] for i in range(len(vals))]):
-                    print("Problem writing calibration values at {:X}: wrote {!s} but read {!s}.".format(0x10000 + 4 * num_avg, vals, read_vals))
 
             for num_avg in range(5):
-                vals = []
                 for ch_range in range(2):
                     val = int(round(16. * self.ch2_zero[num_avg][ch_range]))
                     vals.append(val & 0x00FF)
                     vals.append(val >> 8)
                     vals.append(0)
                     vals.append(0)
-                self.write_flash(0x10014 + 4 * num_avg, vals)
-                read_vals = self.read_flash(0x10014 + 4 * num_avg, len(vals))
-                if not all([read_vals[i] == vals[i] for i in range(len(vals))]):
-                    print("Problem writing calibration values at {:X}: wrote {!s} but read {!s}.".format(0x10014 + 4 * num_avg, vals, read_vals))
 
-            vals = []
             for ch_range in range(2):
                 val = int(round(16. * self.ch1_zero_4MSps[ch_range]))
                 vals.append(val & 0x00FF)
                 vals.append(val >> 8)
                 vals.append(0)
                 vals.append(0)
-            self.write_flash(0x10028, vals)
-            read_vals = self.read_flash(0x10028, len(vals))
-            if not all([read_vals[i] == vals[i] for i in range(len(vals))]):
-                print("Problem writing calibration values at {:X}: wrote {!s} but read {!s}.".format(0x10028, vals, read_vals))
 
-            vals = []
             for ch_range in range(2):
                 val = int(round(16. * self.ch2_zero_4MSps[ch_range]))
                 vals.append(val & 0x00FF)
                 vals.append(val >> 8)
                 vals.append(0)
                 vals.append(0)
-            self.write_flash(0x1002C, vals)
-            read_vals = self.read_flash(0x1002C, len(vals))
-            if not all([read_vals[i] == vals[i] for i in range(len(vals))]):
-                print("Problem writing calibration values at {:X}: wrote {!s} but read {!s}.".format(0x1002C, vals, read_vals))
 
             for num_avg in range(5):
-                vals = []
                 for ch_range in range(2):
                     val = int(round(32768. * self.ch1_gain[num_avg][ch_range]))
                     vals.append(val & 0x00FF)
                     vals.append(val >> 8)
                     vals.append(0)
                     vals.append(0)
-                self.write_flash(0x10030 + 4 * num_avg, vals)
-                read_vals = self.read_flash(0x10030 + 4 * num_avg, len(vals))
-                if not all([read_vals[i] == vals[i] for i in range(len(vals))]):
-                    print("Problem writing calibration values at {:X}: wrote {!s} but read {!s}.".format(0x10030 + 4 * num_avg, vals, read_vals))
 
             for num_avg in range(5):
-                vals = []
                 for ch_range in range(2):
                     val = int(round(32768. * self.ch2_gain[num_avg][ch_range]))
                     vals.append(val & 0x00FF)
                     vals.append(val >> 8)
                     vals.append(0)
                     vals.append(0)
-                self.write_flash(0x10044 + 4 * num_avg, vals)
-                read_vals = self.read_flash(0x10044 + 4 * num_avg, len(vals))
-                if not all([read_vals[i] == vals[i] for i in range(len(vals))]):
-                    print("Problem writing calibration values at {:X}: wrote {!s} but read {!s}.".format(0x10044 + 4 * num_avg, vals, read_vals))
 
-            vals = []
             for ch_range in range(2):
                 val = int(round(32768. * self.ch1_gain_4MSps[ch_range]))
                 vals.append(val & 0x00FF)
                 vals.append(val >> 8)
                 vals.append(0)
                 vals.append(0)
-            self.write_flash(0x10058, vals)
-            read_vals = self.read_flash(0x10058, len(vals))
-            if not all([read_vals[i] == vals[i] for i in range(len(vals))]):
-                print("Problem writing calibration values at {:X}: wrote {!s} but read {!s}.".format(0x10058, vals, read_vals))
 
-            vals = []
             for ch_range in range(2):
                 val = int(round(32768. * self.ch2_gain_4MSps[ch_range]))
                 vals.append(val & 0x00FF)
                 vals.append(val >> 8)
                 vals.append(0)
                 vals.append(0)
-            self.write_flash(0x1005C, vals)
-            read_vals = self.read_flash(0x1005C, len(vals))
-            if not all([read_vals[i] == vals[i] for i in range(len(vals))]):
-                print("Problem writing calibration values at {:X}: wrote {!s} but read {!s}.".format(0x1005C, vals, read_vals))
 
-            vals = []
             val = self.get_sq_offset_adj()
             vals.append(val & 0x00FF)
             vals.append(val >> 8)
@@ -735,12 +962,6 @@ class oscope:
             vals.append(0)
             vals.append(0)
 
-            self.write_flash(0x10060, vals)
-            read_vals = self.read_flash(0x10060, len(vals))
-            if not all([read_vals[i] == vals[i] for i in range(len(vals))]):
-                print("Problem writing calibration values at {:X}: wrote {!s} but read {!s}.".format(0x10060, vals, read_vals))
-
-            vals = []
             for wg_range in range(2):
                 val = int(round(32768. * self.wg_sq_gain[wg_range]))
                 vals.append(val & 0x00FF)
@@ -748,12 +969,6 @@ class oscope:
                 vals.append(0)
                 vals.append(0)
 
-            self.write_flash(0x10064, vals)
-            read_vals = self.read_flash(0x10064, len(vals))
-            if not all([read_vals[i] == vals[i] for i in range(len(vals))]):
-                print("Problem writing calibration values at {:X}: wrote {!s} but read {!s}.".format(0x10064, vals, read_vals))
-
-            vals = []
             for wg_range in range(2):
                 val = int(round(32768. * self.wg_nsq_gain[wg_range]))
                 vals.append(val & 0x00FF)
@@ -761,12 +976,6 @@ class oscope:
                 vals.append(0)
                 vals.append(0)
 
-            self.write_flash(0x10068, vals)
-            read_vals = self.read_flash(0x10068, len(vals))
-            if not all([read_vals[i] == vals[i] for i in range(len(vals))]):
-                print("Problem writing calibration values at {:X}: wrote {!s} but read {!s}.".format(0x10068, vals, read_vals))
-
-            vals = []
             val = int(round(32768. * self.vo_gain))
             vals.append(val & 0x00FF)
             vals.append(val >> 8)
@@ -779,8 +988,123 @@ class oscope:
             vals.append(0)
             vals.append(0)
 
-            self.write_flash(0x1006C, vals)
-            read_vals = self.read_flash(0x1006C, len(vals))
-            if not all([read_vals[i] == vals[i] for i in range(len(vals))]):
-                print("Problem writing calibration values at {:X}: wrote {!s} but read {!s}.".format(0x1006C, vals, read_vals))
-
+            for written in self.program_flash(0x10000, vals):
+                pass
+            if not self.verify_flash():
+                print("Problem writing calibration values at {:X}: read back differs from {!s}.".format(0x10000, vals))
+
+    def flash_packets(self, address, values):
+        """Split values, four bytes per instruction from address, into [address, values] packets for write_flash().
+
+        Each packet is as long as the command buffer allows and stays within 
+        one row, since the firmware programs a single row per FLASH:WRITE.
+        """
+        packets = []
+        start = 0
+        while start < len(values):
+            row_end = (address & ~(self.FLASH_ROW_SIZE - 1)) + self.FLASH_ROW_SIZE
+            length = len('FLASH:WRITE {:X},{:X}'.format(address >> 16, address & 0xFFFF))
+            end = start
+            while (end < len(values)) and (address + (end - start) // 2 < row_end):
+                instruction = sum(len(',{:X}'.format(int(value) & 0xFF)) for value in values[end:end + 4])
+                if length + instruction > self.MAX_COMMAND_LENGTH:
+                    break
+                length += instruction
+                end += 4
+            packets.append([address, values[start:end]])
+            address += (end - start) // 2
+            start = end
+        return packets
+
+    def offset_waveform_codes(self, voltages):
+        """Return the 10-bit offset DAC codes for an array of voltages."""
+        codes = np.floor(np.asarray(voltages, dtype = np.float64) / (5e-3 * self.vo_gain) + self.vo_zero + 0.5)
+        return np.clip(codes, 0, 1023).astype(np.uint16)
+
+    def offset_waveform_checksum(self, samples):
+        return binascii.crc_hqx(np.asarray(samples, dtype = '<u2').tobytes(), 0xFFFF)
+
+    def read_offset_waveform(self):
+        if not self.connected:
+            return []
+
+        # The instruction after the last sample holds a CRC of the samples, 
+        # which the firmware ignores.  If the sample count and the CRC read 
+        # back as cached, the samples are taken from the cache.
+        starting_address = self.OFFSET_WAVEFORM_ADDRESS
+        vals = self.read_flash(starting_address, 4)
+        if vals[2] == 255:
+            return []
+        num_samples = vals[0] + 256 * vals[1]
+        end = starting_address + 2 * (num_samples + 1)
+        pages = range(starting_address, end + 2, self.FLASH_PAGE_SIZE)
+        cached = all(self.flash_page_address(page) in self.flash_pages for page in pages)
+        if not cached or (self.read_flash_cached(starting_address, 4) != vals) or (self.read_flash_cached(end, 4) != self.read_flash(end, 4)):
+            for page in pages:
+                self.flash_pages.pop(self.flash_page_address(page), None)
+
+        # FLASH:READ streams its reply without going through the command 
+        # buffer, so each page comes back in one read
+        vals = self.read_flash_cached(starting_address + 2, 4 * num_samples)
+        return [vals[i] + 256 * vals[i + 1] for i in range(0, len(vals), 4)]
+
+    def upload_offset_waveform(self, samples):
+        """Program samples as the offset waveform, yielding the fraction done after each packet.
+
+        Only the pages that differ from what is on the board are erased and 
+        programmed, and the sample count goes in last, so that an upload 
+        that is stopped part way leaves an empty waveform rather than a 
+        truncated one.
+        """
+        samples = [int(sample) for sample in samples]
+        num_samples = len(samples)
+        checksum = self.offset_waveform_checksum(samples)
+
+        vals = [num_samples & 0x00FF, num_samples >> 8, 0, 0]
+        for sample in samples:
+            vals.extend((sample & 0x00FF, sample >> 8, 0, 0))
+        vals.extend((checksum & 0x00FF, checksum >> 8, 0, 0))
+        for done in self.program_flash(self.OFFSET_WAVEFORM_ADDRESS, vals):
+            yield done
+
+    def write_offset_waveform(self, samples):
+        if not self.connected:
+            return False
+
+        for done in self.upload_offset_waveform(samples):
+            pass
+        if not self.verify_flash():
+            print("Problem writing offset waveform at {:X}: read back differs from the {:d} samples written.".format(self.OFFSET_WAVEFORM_ADDRESS, len(samples)))
+            return False
+        return True
+
+    def read_offset_waveform_as_voltages(self):
+        vals = self.read_offset_waveform()
+        return [5e-3 * self.vo_gain * (float(val) - self.vo_zero) for val in vals]
+
+    def write_offset_waveform_as_voltages(self, filename):
+        if not self.connected:
+            return False
+
+        try:
+            voltages = np.loadtxt(filename, ndmin = 1)
+        except (OSError, ValueError):
+            return False
+
+        return self.write_offset_waveform(self.offset_waveform_codes(voltages))
+
+def _transaction(method):
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+# Every method that talks to the board runs as one transaction under the 
+# oscope's lock, so that a command and its reply are never split by another 
+# thread sharing the port, such as the offset waveform upload.  Generators 
+# are left alone; the methods that they call take the lock between the 
+# values that they yield.
+for _name, _method in list(vars(oscope).items()):
+    if inspect.isfunction(_method) and not _name.startswith('__') and not inspect.isgeneratorfunction(_method):
+        setattr(oscope, _name, _transaction(_method))
@@ -0,0 +1,183 @@
+"""
+Digital-phosphor persistence for Whoa-Scope.
+Accumulates the traces of successive frames into per-pixel hit counts over
+the plot axes and turns them into a single intensity-mapped RGBA image, so
+that intermittent glitches and jitter stay visible and the plot draws one
+texture instead of thousands of line segments.
+
+Every frame first decays the whole histogram by a constant factor (or not
+at all for infinite persistence) and then adds the new hits, so the cost
+per frame depends only on the pixel size of the map and the number of
+samples, never on how long hits persist.
+"""
+
+import numpy as np
+
+
+class PersistenceMap(object):
+    """Pixel-resolution hit-count histograms for a fixed number of traces."""
+
+    def __init__(self, num_traces=2, decay=0.9, width=1, height=1):
+        self.num_traces = num_traces
+        # the combined intensity levels of all traces index a 16-bit palette
+        self.num_levels = min(256, 1 << (16 // num_traces))
+        self.palette_key = None
+        self.decay = 1.
+        self.set_decay(decay)
+        self.width = 0
+        self.height = 0
+        self.resize(width, height)
+
+    def set_decay(self, decay):
+        """Set the fraction of hits kept from one frame to the next; 1 keeps them forever."""
+        self.decay = min(max(float(decay), 0.), 1.)
+
+    @property
+    def infinite(self):
+        return self.decay >= 1.
+
+    def resize(self, width, height):
+        width = max(int(width), 1)
+        height = max(int(height), 1)
+        if (width, height) != (self.width, self.height):
+            self.width = width
+            self.height = height
+            self.hits = np.zeros((self.num_traces, height, width), dtype=np.float32)
+            self.frame = np.zeros((height + 1) * width)
+            self.levels = np.zeros((height, width), dtype=np.float32)
+            self.level_indices = np.zeros((height, width), dtype=np.uint16)
+            self.indices = np.zeros((height, width), dtype=np.uint16)
+            self.rgba = np.zeros((height, width, 4), dtype=np.uint8)
+            self.columns = np.arange(width, dtype=np.float64) + 0.5
+        self.reset()
+
+    def reset(self):
+        self.hits[:] = 0.
+        self.num_frames = 0
+
+    def add_frame(self, traces):
+        """Decay the map and add one frame.
+
+        traces is a list of (index, x, y, xlim, ylim), where index selects
+        the histogram, x and y hold the samples of the trace in data units,
+        and xlim and ylim are the axis limits that the map spans.
+        """
+        if not self.infinite:
+            self.hits *= self.decay
+        for index, x, y, xlim, ylim in traces:
+            if len(x) > 1:
+                self.hits[index] += self.rasterize(x, y, xlim, ylim)
+        self.num_frames += 1
+
+    def rasterize(self, x, y, xlim, ylim):
+        """Return a (height, width) image of the pixels that the trace passes through.
+
+        Each segment between consecutive samples lights up the run of rows
+        between its ends in the column of its first sample.  The runs are
+        written as +1/-1 marks into a flattened difference image with
+        np.bincount and summed up each column with a cumulative sum.  Traces
+        with fewer samples than columns are first interpolated at the
+        column centers so that sparse traces do not leave gaps.
+        """
+        width = self.width
+        height = self.height
+        cols = (np.asarray(x, dtype=np.float64) - xlim[0]) * (width / (xlim[1] - xlim[0]))
+        rows = (np.asarray(y, dtype=np.float64) - ylim[0]) * (height / (ylim[1] - ylim[0]))
+
+        if len(cols) < width:
+            if cols[-1] < cols[0]:
+                cols = cols[::-1]
+                rows = rows[::-1]
+            if np.all(cols[1:] >= cols[:-1]):
+                inside = (self.columns >= cols[0]) & (self.columns <= cols[-1])
+                grid = self.columns[inside]
+                if len(grid) > 1:
+                    rows = np.interp(grid, cols, rows)
+                    cols = grid
+
+        col = np.floor(cols[:-1]).astype(np.int64)
+        lo = np.floor(np.minimum(rows[:-1], rows[1:])).astype(np.int64)
+        hi = np.floor(np.maximum(rows[:-1], rows[1:])).astype(np.int64)
+        keep = (col >= 0) & (col < width) & (hi >= 0) & (lo < height)
+        col = col[keep]
+        lo = np.clip(lo[keep], 0, height - 1)
+        hi = np.clip(hi[keep], 0, height - 1) + 1
+
+        size = (height + 1) * width
+        frame = self.frame
+        frame[:] = np.bincount(lo * width + col, minlength=size)
+        frame -= np.bincount(hi * width + col, minlength=size)
+        image = frame.reshape(height + 1, width)
+        np.cumsum(image, axis=0, out=image)
+        return image[:height]
+
+    def palette(self, colors):
+        """Return a packed RGBA color for every combination of trace intensity levels.
+
+        colors holds an (r, g, b) triple in [0, 1] for each trace.  The
+        colors of overlapping traces add up, and alpha follows the brightest
+        trace so that untouched pixels stay transparent.
+        """
+        key = tuple(tuple(color[:3]) for color in colors)
+        if key != self.palette_key:
+            levels = self.num_levels
+            steps = np.indices((levels,) * self.num_traces).reshape(self.num_traces, -1) / (levels - 1.)
+            table = np.zeros((levels ** self.num_traces, 4))
+            for index in range(self.num_traces):
+                table[:, :3] += np.outer(steps[index], colors[index][:3])
+            table[:, 3] = steps.max(axis=0)
+            table = np.rint(255. * np.minimum(table, 1.)).astype(np.uint8)
+            self.palette_table = table.view(np.uint32).ravel()
+            self.palette_key = key
+        return self.palette_table
+
+    def render(self, colors):
+        """Return the map as a (height, width, 4) uint8 RGBA image.
+
+        Hit counts are mapped logarithmically to intensity levels relative to
+        the most frequently hit pixel of each trace; the levels of all traces
+        are combined into one index per pixel that is looked up in the
+        palette, so compositing costs a single table lookup per pixel.
+        """
+        table = self.palette(colors)
+        self.indices[:] = 0
+        for index in range(self.num_traces):
+            self.indices *= self.num_levels
+            peak = float(self.hits[index].max())
+            if peak <= 0.:
+                continue
+            np.log1p(self.hits[index], out=self.levels)
+            self.levels *= (self.num_levels - 1) / np.log1p(peak)
+            np.copyto(self.level_indices, self.levels, casting='unsafe')
+            self.indices += self.level_indices
+        np.take(table, self.indices, out=self.rgba.view(np.uint32).reshape(self.height, self.width))
+        return self.rgba
+
+
+if __name__ == '__main__':
+    import time
+
+    num_samples = 1500
+    t = np.linspace(-1e-3, 1e-3, num_samples)
+    rng = np.random.default_rng(0)
+    persistence = PersistenceMap(2, width=900, height=500)
+
+    print('{:>8s} {:>14s}'.format('decay', 'ms per frame'))
+    for decay in (0.5, 0.9, 0.99, 0.999, 1.):
+        persistence.set_decay(decay)
+        persistence.reset()
+        start = time.perf_counter()
+        for i in range(200):
+            jitter = 2e-5 * rng.standard_normal()
+            ch1 = 5. * np.sign(np.sin(2. * np.pi * 2e3 * (t + jitter)))
+            ch2 = 3. * np.sin(2. * np.pi * 2e3 * (t + jitter))
+            persistence.add_frame([(0, t, ch1, [-1e-3, 1e-3], [-10., 10.]), (1, t, ch2, [-1e-3, 1e-3], [-10., 10.])])
+            persistence.render([(0., 1., 1.), (1., 0., 1.)])
+        print('{:8.3f} {:14.3f}'.format(decay, 1e3 * (time.perf_counter() - start) / 200))
+
+    # a vertical edge must light up every row it spans
+    persistence.set_decay(1.)
+    persistence.add_frame([(0, np.array([-1e-3, 0., 0., 1e-3]), np.array([-5., -5., 5., 5.]), [-1e-3, 1e-3], [-10., 10.])])
+    edge = persistence.hits[0][:, 450]
+    assert np.all(edge[125:375] > 0.), 'edge has gaps'
+    print('OK')
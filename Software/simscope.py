@@ -0,0 +1,265 @@
+"""
+Simulated Whoa-Scope for Whoa-Scope.
+Stands in for the serial port of the board and answers the same text
+commands as the firmware, so that host code written against the oscope
+class can be exercised without hardware.  Each scope sweep samples
+user-supplied signal functions of time at the configured sampling
+interval, with a random trigger phase, noise, 12-bit quantization and
+clipping at the limits of the selected input range.
+
+Sweeps complete as soon as they are triggered; the time that the real
+board would have spent acquiring is added up in acquisition_time instead,
+along with the number of commands sent and replies received, so that search
+strategies can be compared by how long they would take on hardware.  The
+levels on the digital pins are in dig_levels, for tests to set.
+
+Program memory is modelled the way the firmware sees it: addressed in PC
+units, two per instruction of four bytes, erased a page of 0x400 units at a
+time and programmed a row of 0x80 units at a time, with the write latches
+wrapping around within the row.  Programming can only clear bits.
+"""
+
+import math
+
+import numpy as np
+
+import oscope
+
+
+class SimulatedPort(object):
+    """Serial port look-alike that interprets the firmware's command set."""
+
+    SCOPE_BUFFER_SIZE = 3000
+    FCY = 16e6
+    AVG_TCY_THRESHOLDS = (0, 42, 50, 66, 98)
+    VOLTS_PER_LSB = (5e-3, 1e-3)
+    CMD_BUFFER_LENGTH = 128
+    FLASH_ROW_SIZE = 0x80
+    FLASH_PAGE_SIZE = 0x400
+    ERASED = (0xFF, 0xFF, 0xFF, 0x00)
+
+    def __init__(self, ch1=None, ch2=None, noise=2e-3, seed=None):
+        self.signals = [ch1, ch2]
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.output = bytearray()
+        self.pending = ''
+        self.buffer = np.full(self.SCOPE_BUFFER_SIZE, 2048, dtype=np.uint16)
+        self.gains = [0, 0]
+        self.interval_vals = [159, 0]
+        self.max_avg = 0
+        self.num_avg = 0
+        self.wavegen = {'GAIN': [0], 'SHAPE': [0], 'FREQ': [0, 0], 'PHASE': [0], 'AMPLITUDE': [0], 'OFFSET': [0], 'SQADJ': [0], 'NSQADJ': [0]}
+        self.dig = {'MODE': [0] * 4, 'OD': [0] * 4}
+        self.dig_levels = [0] * 4
+        self.offset = {'INTERVAL': [0x752F, 0x0010], 'MODE': [0]}
+        self.offset_running = False
+        self.flash = {}
+        self.num_commands = 0
+        self.num_replies = 0
+        self.bytes_written = 0
+        self.num_writes = 0
+        self.dropped_commands = 0
+        self.num_sweeps = 0
+        self.acquisition_time = 0.
+        self.update_acquire_mode()
+
+    def set_signals(self, ch1=None, ch2=None):
+        self.signals = [ch1, ch2]
+
+    @property
+    def sampling_interval(self):
+        [PR2, T2CON] = self.interval_vals
+        return (1, 8, 64, 256)[(T2CON & 0x0030) >> 4] * (PR2 + 1.) / self.FCY
+
+    def update_acquire_mode(self):
+        # mirrors update_acquire_mode() in the firmware
+        [PR2, T2CON] = self.interval_vals
+        if (T2CON & 0x0030) == 0:
+            self.num_avg = self.max_avg
+            while (self.num_avg > 0) and (PR2 < self.AVG_TCY_THRESHOLDS[self.num_avg]):
+                self.num_avg -= 1
+        else:
+            self.num_avg = self.max_avg
+        if (self.num_avg == 0) and ((T2CON & 0x0030) == 0) and (PR2 < 7):
+            self.interval_vals[0] = 3
+
+    def sweep(self):
+        num_samples = self.SCOPE_BUFFER_SIZE // 2
+        interval = self.sampling_interval
+        # the sweep starts at an arbitrary moment relative to the signal
+        t = interval * (np.arange(num_samples) + self.rng.uniform(0., 1e6))
+        for index, signal in enumerate(self.signals):
+            volts = np.zeros(num_samples) if signal is None else np.asarray(signal(t + index * 0.125e-6), dtype=np.float64) * np.ones(num_samples)
+            if self.noise > 0.:
+                volts = volts + self.noise * self.rng.standard_normal(num_samples)
+            codes = np.clip(np.rint(2048. + volts / self.VOLTS_PER_LSB[self.gains[index]]), 0, 4095).astype(np.uint16)
+            self.buffer[index * num_samples:(index + 1) * num_samples] = codes << self.num_avg
+        self.num_sweeps += 1
+        self.acquisition_time += num_samples * interval
+
+    def respond(self, text):
+        self.num_replies += 1
+        self.output += (text + '\r\n').encode()
+
+    def execute(self, command):
+        command = command.strip()
+        if command == '':
+            return
+        self.num_commands += 1
+        [name, _, args] = command.partition(' ')
+        args = [int(arg, 16) for arg in args.replace(',', ' ').split()] if args.strip() else []
+        [group, _, name] = name.partition(':')
+        hex_list = lambda vals: ','.join('{:X}'.format(int(val)) for val in vals)
+
+        if group == 'SCOPE':
+            if name in ('CH1GAIN', 'CH2GAIN') and args:
+                self.gains[int(name[2]) - 1] = 1 if args[0] else 0
+            elif name in ('CH1GAIN?', 'CH2GAIN?'):
+                self.respond(hex_list([self.gains[int(name[2]) - 1]]))
+            elif name == 'INTERVAL' and len(args) >= 2:
+                self.interval_vals = args[:2]
+                self.update_acquire_mode()
+            elif name == 'INTERVAL?':
+                self.respond(hex_list(self.interval_vals))
+            elif name == 'MAXAVG' and args and (args[0] < 5):
+                self.max_avg = args[0]
+                self.update_acquire_mode()
+            elif name == 'MAXAVG?':
+                self.respond(hex_list([self.max_avg]))
+            elif name == 'NUMAVG?':
+                self.respond(hex_list([self.num_avg]))
+            elif name == 'SWEEP?':
+                self.respond(hex_list([0, 0]))
+            elif name == 'TRIGGER':
+                self.sweep()
+            elif name in ('BUFFER?', 'BUFFERBIN?') and len(args) >= 2 and (args[0] < self.SCOPE_BUFFER_SIZE):
+                vals = self.buffer[args[0]:min(args[0] + args[1], self.SCOPE_BUFFER_SIZE)]
+                if name == 'BUFFER?':
+                    self.respond(hex_list(vals))
+                else:
+                    self.output += vals.astype('<u2').tobytes()
+        elif group == 'WAVEGEN' and name.startswith('OFFSET:'):
+            name = name[len('OFFSET:'):]
+            if name.endswith('?') and name[:-1] in self.offset:
+                self.respond(hex_list(self.offset[name[:-1]]))
+            elif name in self.offset and args:
+                self.offset[name] = args[:len(self.offset[name])]
+            elif name == 'START':
+                # a single pass is over at once; a repeating one runs until stopped
+                self.offset_running = self.offset['MODE'][0] == 1
+            elif name == 'STOP':
+                self.offset_running = False
+            elif name == 'SWEEP?':
+                self.respond(hex_list([1, 1]) if self.offset_running else hex_list([0, 0]))
+        elif group == 'WAVEGEN':
+            if name.endswith('?') and name[:-1] in self.wavegen:
+                self.respond(hex_list(self.wavegen[name[:-1]]))
+            elif name in self.wavegen and args:
+                self.wavegen[name] = args[:len(self.wavegen[name])]
+        elif group == 'DIG':
+            if name.endswith('?') and name[:-1] in self.dig and args:
+                self.respond(hex_list([self.dig[name[:-1]][args[0] & 3]]))
+            elif name in self.dig and len(args) >= 2:
+                self.dig[name][args[0] & 3] = args[1]
+            elif name == 'READ' and args:
+                self.respond(hex_list([self.dig_levels[args[0] & 3]]))
+            elif name == 'WRITE' and len(args) >= 2:
+                self.dig_levels[args[0] & 3] = 1 if args[1] else 0
+            elif name in ('SET', 'CLEAR', 'TOGGLE') and args:
+                level = self.dig_levels[args[0] & 3]
+                self.dig_levels[args[0] & 3] = {'SET': 1, 'CLEAR': 0, 'TOGGLE': 1 - level}[name]
+        elif group == 'FLASH':
+            if name == 'READ' and len(args) >= 3:
+                address = (args[0] << 16) + args[1]
+                vals = []
+                for offset in range(0, args[2], 4):
+                    vals.extend(self.flash.get(address + offset // 2, self.ERASED))
+                self.respond(hex_list(vals))
+            elif name == 'WRITE' and len(args) >= 2:
+                address = (args[0] << 16) + args[1]
+                row = address & ~(self.FLASH_ROW_SIZE - 1)
+                latches = {}
+                for offset in range(0, len(args) - 5, 4):
+                    latch = row + ((address + offset // 2) & (self.FLASH_ROW_SIZE - 1))
+                    latches[latch] = [val & 0xFF for val in args[2 + offset:6 + offset]]
+                for latch, vals in latches.items():
+                    old = self.flash.get(latch, self.ERASED)
+                    self.flash[latch] = tuple(a & b for a, b in zip(old, vals))
+            elif name == 'ERASE' and len(args) >= 2:
+                page = ((args[0] << 16) + args[1]) & ~(self.FLASH_PAGE_SIZE - 1)
+                for address in [address for address in self.flash if page <= address < page + self.FLASH_PAGE_SIZE]:
+                    del self.flash[address]
+
+    def write(self, data):
+        self.num_writes += 1
+        self.bytes_written += len(data)
+        self.pending += data.decode()
+        while '\r' in self.pending:
+            [command, _, self.pending] = self.pending.partition('\r')
+            # the firmware throws away commands that overflow its buffer
+            if len(command) > self.CMD_BUFFER_LENGTH - 2:
+                self.dropped_commands += 1
+                continue
+            self.execute(command)
+        return len(data)
+
+    def read(self, size=1):
+        data = bytes(self.output[:size])
+        del self.output[:size]
+        return data
+
+    def readline(self):
+        end = self.output.find(b'\n')
+        return self.read(len(self.output) if end < 0 else end + 1)
+
+
+class SimulatedScope(oscope.oscope):
+    """An oscope connected to a SimulatedPort instead of a board."""
+
+    def __init__(self, ch1=None, ch2=None, noise=2e-3, seed=None):
+        super(SimulatedScope, self).__init__(port = 'simulated')
+        self.dev = SimulatedPort(ch1, ch2, noise, seed)
+        self.connected = True
+        self.write('')
+        self.refresh()
+        self.read_calibration_vals()
+
+
+def sine(amplitude=1., frequency=1e3, offset=0.):
+    return lambda t: offset + amplitude * np.sin(2. * math.pi * frequency * t)
+
+
+def square(amplitude=1., frequency=1e3, offset=0., duty=0.5):
+    return lambda t: offset + np.where((t * frequency) % 1. < duty, amplitude, -amplitude)
+
+
+def triangle(amplitude=1., frequency=1e3, offset=0.):
+    return lambda t: offset + amplitude * (4. * np.abs((t * frequency) % 1. - 0.5) - 1.)
+
+
+def dc(level=0.):
+    return lambda t: np.full(len(t), float(level))
+
+
+if __name__ == '__main__':
+    import frameprocessor
+
+    dev = SimulatedScope(sine(1.5, 2e3), square(5., 500.), seed=0)
+    dev.set_period(10e-6)
+    dev.set_ch1range(1)
+    dev.trigger_sweep()
+    processor = frameprocessor.FrameProcessor(dev.SCOPE_BUFFER_SIZE // 2)
+    count = processor.load(dev.get_bufferbin_raw(), dev.num_avg)
+    ch1 = processor.scale(0, count, dev.volts_per_lsb[dev.ch1_range], dev.ch1_gain[dev.num_avg][dev.ch1_range], dev.ch1_zero[dev.num_avg][dev.ch1_range])
+    ch2 = processor.scale(1, count, dev.volts_per_lsb[dev.ch2_range], dev.ch2_gain[dev.num_avg][dev.ch2_range], dev.ch2_zero[dev.num_avg][dev.ch2_range])
+    print('interval {:g} s, num_avg {}, CH1 {:.3f}..{:.3f} V, CH2 {:.3f}..{:.3f} V, {} commands'.format(
+        dev.sampling_interval, dev.num_avg, ch1.min(), ch1.max(), ch2.min(), ch2.max(), dev.dev.num_commands))
+    assert abs(dev.sampling_interval - 10e-6) < 1e-12
+    assert abs(ch1.max() - 1.5) < 0.02 and abs(ch2.min() + 5.) < 0.05
+    # a 5 V signal clips on the 2 V range
+    dev.set_ch2range(1)
+    dev.trigger_sweep()
+    count = processor.load(dev.get_bufferbin_raw(), dev.num_avg)
+    assert processor.raw[1, :count].max() == 4095
+    print('OK')
@@ -0,0 +1,258 @@
+"""
+Spectrum analysis for Whoa-Scope.
+Computes windowed magnitude spectra of captured frames in dBV (RMS), with
+optional linear or exponential averaging across frames, and finds the
+fundamental and its harmonics in each channel.  Window arrays and
+frequency axes are cached per record length, window and sampling interval,
+and a worker thread lets the UI hand off frames without waiting for the
+analysis.
+"""
+
+import threading
+
+import numpy as np
+
+
+WINDOWS = ('Hann', 'Blackman-Harris', 'Flat Top', 'Rectangular')
+AVERAGING_MODES = ('None', 'Linear', 'Exponential')
+
+# half width of the main lobe of each window in bins, used to skip DC and
+# to search for harmonics near their nominal bins
+MAIN_LOBE_BINS = {'Hann': 2, 'Blackman-Harris': 4, 'Flat Top': 5, 'Rectangular': 1}
+
+
+def window_function(name, n):
+    """Return the named window of length n."""
+    k = 2. * np.pi * np.arange(n) / n
+    if name == 'Hann':
+        return 0.5 - 0.5 * np.cos(k)
+    elif name == 'Blackman-Harris':
+        return 0.35875 - 0.48829 * np.cos(k) + 0.14128 * np.cos(2. * k) - 0.01168 * np.cos(3. * k)
+    elif name == 'Flat Top':
+        return 0.21557895 - 0.41663158 * np.cos(k) + 0.277263158 * np.cos(2. * k) - 0.083578947 * np.cos(3. * k) + 0.006947368 * np.cos(4. * k)
+    elif name == 'Rectangular':
+        return np.ones(n)
+    raise ValueError('unknown window {!r}'.format(name))
+
+
+class SpectrumAnalyzer(object):
+    """Windowed rfft magnitude spectra with averaging and peak/harmonic search."""
+
+    def __init__(self, window='Hann', averaging='None', num_averages=8, num_harmonics=5, max_cache=16):
+        self.window = window
+        self.averaging = averaging
+        self.num_averages = num_averages
+        self.num_harmonics = num_harmonics
+        self.max_cache = max_cache
+        self.windows = {}
+        self.axes = {}
+        self.enbw = 1.
+        self.reset()
+
+    def reset(self):
+        self.key = None
+        self.power = None
+        self.num_frames = 0
+
+    def get_window(self, n):
+        """Return [window, enbw] for the current window of length n.
+
+        The window is scaled so that a sine of amplitude A peaks at A, and
+        enbw is its equivalent noise bandwidth in bins.
+        """
+        key = (n, self.window)
+        window = self.windows.get(key)
+        if window is None:
+            if len(self.windows) >= self.max_cache:
+                self.windows.clear()
+            samples = window_function(self.window, n)
+            enbw = n * np.dot(samples, samples) / samples.sum() ** 2
+            samples *= 2. / samples.sum()
+            window = [samples, enbw]
+            self.windows[key] = window
+        return window
+
+    def get_axes(self, n, sampling_interval):
+        """Return [frequencies, log10(frequencies)] of the rfft bins, without the DC bin in the latter."""
+        key = (n, sampling_interval)
+        axes = self.axes.get(key)
+        if axes is None:
+            if len(self.axes) >= self.max_cache:
+                self.axes.clear()
+            freqs = np.fft.rfftfreq(n, sampling_interval)
+            axes = [freqs, np.log10(freqs[1:])]
+            self.axes[key] = axes
+        return axes
+
+    def compute(self, chs, sampling_interval):
+        """Return [frequencies, log_frequencies, levels] for the frames in chs.
+
+        chs holds one frame per row; levels[i] is the averaged spectrum of
+        row i in dBV (RMS).  Averaging starts over whenever the record
+        length, sampling interval, window or averaging settings change.
+        """
+        chs = np.atleast_2d(np.asarray(chs, dtype=np.float64))
+        n = chs.shape[1]
+        key = (chs.shape, sampling_interval, self.window, self.averaging, self.num_averages)
+        if key != self.key:
+            self.reset()
+            self.key = key
+
+        [window, self.enbw] = self.get_window(n)
+        spectrum = np.fft.rfft(chs * window, axis=1)
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+
+        if (self.power is None) or (self.averaging == 'None'):
+            self.power = power
+            self.num_frames = 1
+        elif self.averaging == 'Linear':
+            if self.num_frames < self.num_averages:
+                self.num_frames += 1
+                self.power += (power - self.power) / self.num_frames
+        else:
+            self.num_frames += 1
+            self.power += (power - self.power) / min(self.num_frames, self.num_averages)
+
+        [freqs, log_freqs] = self.get_axes(n, sampling_interval)
+        # peak amplitude squared to RMS volts squared, floored at -200 dBV
+        levels = 10. * np.log10(np.maximum(0.5 * self.power, 1e-20))
+        return [freqs, log_freqs, levels]
+
+    def find_peak(self, levels, freqs, lo=None, hi=None):
+        """Return [frequency, level] of the largest peak in levels[lo:hi].
+
+        The frequency is refined by parabolic interpolation of the levels
+        around the peak bin, and the level is found from the power summed
+        over the main lobe, which does not suffer from scalloping loss
+        when the tone falls between bins.
+        """
+        lobe = MAIN_LOBE_BINS.get(self.window, 2)
+        if lo is None:
+            lo = lobe
+        if hi is None:
+            hi = len(levels)
+        lo = max(lo, 1)
+        hi = min(hi, len(levels) - 1)
+        if hi <= lo:
+            return None
+        k = lo + int(np.argmax(levels[lo:hi]))
+        [a, b, c] = levels[k - 1:k + 2]
+        curvature = a - 2. * b + c
+        delta = 0.5 * (a - c) / curvature if curvature < 0. else 0.
+        power = np.sum(10. ** (0.1 * levels[max(k - lobe, 0):k + lobe + 1])) / self.enbw
+        return [(k + delta) * (freqs[1] - freqs[0]), 10. * np.log10(power)]
+
+    def measure(self, levels, freqs):
+        """Find the fundamental and harmonics of a spectrum.
+
+        Returns a dict with the fundamental frequency and level, a list of
+        [frequency, level] for harmonics 2 through num_harmonics that fall
+        below Nyquist, and the THD in percent, or None if there is no peak.
+        """
+        peak = self.find_peak(levels, freqs)
+        if peak is None:
+            return None
+        [f0, level] = peak
+        df = freqs[1] - freqs[0]
+        lobe = MAIN_LOBE_BINS.get(self.window, 2)
+        harmonics = []
+        for h in range(2, self.num_harmonics + 1):
+            k = int(round(h * f0 / df))
+            if k + lobe >= len(levels):
+                break
+            harmonic = self.find_peak(levels, freqs, k - lobe, k + lobe + 1)
+            if harmonic is not None:
+                harmonics.append(harmonic)
+        power = sum(10. ** (0.1 * harmonic[1]) for harmonic in harmonics)
+        thd = 100. * np.sqrt(power / 10. ** (0.1 * level))
+        return {'frequency': f0, 'level': level, 'harmonics': harmonics, 'thd': thd}
+
+
+class SpectrumWorker(threading.Thread):
+    """Background thread that analyzes the most recently submitted frame.
+
+    Frames that arrive while the previous one is still being analyzed
+    replace each other, so the worker always works on the newest frame and
+    never builds up a backlog.
+    """
+
+    def __init__(self, analyzer=None):
+        super(SpectrumWorker, self).__init__(name='spectrum', daemon=True)
+        self.analyzer = SpectrumAnalyzer() if analyzer is None else analyzer
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.pending = None
+        self.result = None
+        self.reset_requested = False
+        self.running = True
+
+    def submit(self, chs, sampling_interval):
+        """Queue a copy of the frames in chs for analysis."""
+        frame = [np.array(chs, dtype=np.float64), sampling_interval]
+        with self.lock:
+            self.pending = frame
+        self.ready.set()
+
+    def reset(self):
+        """Drop the pending frame and the last result, and restart averaging."""
+        with self.lock:
+            self.pending = None
+            self.result = None
+            self.reset_requested = True
+
+    def latest(self):
+        """Return [frequencies, log_frequencies, levels, measurements] of the newest analyzed frame, or None."""
+        return self.result
+
+    def stop(self):
+        self.running = False
+        self.ready.set()
+
+    def run(self):
+        while self.running:
+            self.ready.wait()
+            with self.lock:
+                self.ready.clear()
+                frame = self.pending
+                self.pending = None
+                if self.reset_requested:
+                    self.analyzer.reset()
+                    self.reset_requested = False
+            if frame is None:
+                continue
+            [chs, sampling_interval] = frame
+            [freqs, log_freqs, levels] = self.analyzer.compute(chs, sampling_interval)
+            measurements = [self.analyzer.measure(level, freqs) for level in levels]
+            with self.lock:
+                if not self.reset_requested:
+                    self.result = [freqs, log_freqs, levels, measurements]
+
+
+if __name__ == '__main__':
+    import time
+
+    num_samples = 1500
+    sampling_interval = 1e-6
+    t = sampling_interval * np.arange(num_samples)
+    rng = np.random.default_rng(0)
+    ch1 = 2. * np.sin(2. * np.pi * 12345. * t) + 0.02 * np.sin(2. * np.pi * 3. * 12345. * t)
+    ch2 = 1. * np.sin(2. * np.pi * 45678. * t + 1.)
+
+    for window in WINDOWS:
+        analyzer = SpectrumAnalyzer(window, 'Exponential', 8)
+        start = time.perf_counter()
+        for i in range(200):
+            chs = np.vstack((ch1, ch2)) + 1e-3 * rng.standard_normal((2, num_samples))
+            [freqs, log_freqs, levels] = analyzer.compute(chs, sampling_interval)
+            measurements = [analyzer.measure(level, freqs) for level in levels]
+        elapsed = (time.perf_counter() - start) / 200
+        m1 = measurements[0]
+        print('{:>16s}: {:6.3f} ms/frame, CH1 {:9.2f} Hz {:6.2f} dBV THD {:5.2f}%, CH2 {:9.2f} Hz {:6.2f} dBV'.format(
+            window, 1e3 * elapsed, m1['frequency'], m1['level'], m1['thd'], measurements[1]['frequency'], measurements[1]['level']))
+        assert abs(m1['frequency'] - 12345.) < 0.1 * (freqs[1] - freqs[0])
+        assert abs(measurements[1]['frequency'] - 45678.) < 0.1 * (freqs[1] - freqs[0])
+    # a 2 V amplitude sine is 1.414 V RMS, or 3.01 dBV
+    analyzer = SpectrumAnalyzer('Flat Top')
+    [freqs, log_freqs, levels] = analyzer.compute(np.vstack((ch1, ch2)), sampling_interval)
+    assert abs(analyzer.measure(levels[0], freqs)['level'] - 3.01) < 0.05
+    print('OK')
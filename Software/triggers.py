@@ -0,0 +1,251 @@
+"""
+Trigger engine for Whoa-Scope.
+Finds trigger events in a captured frame on the host: hysteresis-qualified
+edges, pulse width, runt and window triggers, plus holdoff and Nth-event
+qualification of any of them.  Each trigger turns the frame into an array
+of event positions with a few vectorized passes, and the event nearest to
+the middle of the record is used to position the trace, as the plain edge
+search in frameprocessor does.
+
+Triggers only need a calibrated trace as a NumPy array, so the same
+objects serve ScopePlot and headless acquisition scripts.
+"""
+
+import math
+
+import numpy as np
+
+
+def schmitt_edges(ch, level, hysteresis=0., rising=True):
+    """Return the positions where ch crosses level in the given direction after being armed.
+
+    A rising edge is only armed once ch has been at or below
+    level - hysteresis, so noise that wiggles around level within the
+    hysteresis band does not produce extra edges.  Positions are in samples
+    with the sub-sample crossing found by linear interpolation.
+    """
+    if rising:
+        fired = ch > level
+        armed = ch <= level - hysteresis
+    else:
+        fired = ch < level
+        armed = ch >= level + hysteresis
+    where = np.flatnonzero(fired | armed)
+    if len(where) < 2:
+        return np.zeros(0)
+    states = fired[where]
+    # first fired sample after an armed one; everything between them lies
+    # inside the band, so the sample just before it is on the far side of
+    # level
+    arrivals = where[1:][states[1:] & ~states[:-1]]
+    before = ch[arrivals - 1]
+    return (arrivals - 1) + (level - before) / (ch[arrivals] - before)
+
+
+class Trigger(object):
+    """Base class; subclasses return their events from events(ch, sampling_interval)."""
+
+    def events(self, ch, sampling_interval):
+        raise NotImplementedError
+
+    def find(self, ch, middle, sampling_interval=1.):
+        """Return [position, offset] of the event nearest to sample middle, or None.
+
+        position is the sample before the event and offset its fractional
+        distance past that sample, as returned by FrameProcessor.find_trigger.
+        Ties go to the earlier event.
+        """
+        if len(ch) < 2:
+            return None
+        events = self.events(ch, sampling_interval)
+        if len(events) == 0:
+            return None
+        index = int(np.searchsorted(events, middle))
+        if index == len(events):
+            event = events[-1]
+        elif index == 0:
+            event = events[0]
+        else:
+            before = events[index - 1]
+            after = events[index]
+            event = before if middle - math.floor(before) <= math.floor(after) - middle else after
+        position = min(int(math.floor(event)), len(ch) - 2)
+        return [position, float(event - position)]
+
+
+class EdgeTrigger(Trigger):
+    """Rising or falling edge through level with hysteresis."""
+
+    def __init__(self, level=0., edge='Rising', hysteresis=0.):
+        self.level = level
+        self.edge = edge
+        self.hysteresis = hysteresis
+
+    def events(self, ch, sampling_interval):
+        if self.edge not in ('Rising', 'Falling'):
+            return np.zeros(0)
+        return schmitt_edges(ch, self.level, self.hysteresis, self.edge == 'Rising')
+
+
+class PulseWidthTrigger(Trigger):
+    """Pulse whose width is shorter than, longer than, or within a range.
+
+    A positive pulse starts on a rising edge through level and ends on the
+    next falling edge; a negative pulse the other way round.  The trigger
+    event is the end of a qualifying pulse, when its width becomes known.
+    condition is '<' (narrower than max_width), '>' (wider than min_width)
+    or 'range' (between min_width and max_width); widths are in seconds.
+    """
+
+    def __init__(self, level=0., polarity='Positive', condition='<', min_width=0., max_width=math.inf, hysteresis=0.):
+        self.level = level
+        self.polarity = polarity
+        self.condition = condition
+        self.min_width = min_width
+        self.max_width = max_width
+        self.hysteresis = hysteresis
+
+    def pulses(self, ch):
+        """Return [starts, ends] of the complete pulses of the configured polarity, in samples."""
+        positive = self.polarity == 'Positive'
+        starts = schmitt_edges(ch, self.level, self.hysteresis, positive)
+        ends = schmitt_edges(ch, self.level, self.hysteresis, not positive)
+        index = np.searchsorted(ends, starts)
+        complete = index < len(ends)
+        return [starts[complete], ends[index[complete]]]
+
+    def events(self, ch, sampling_interval):
+        [starts, ends] = self.pulses(ch)
+        widths = (ends - starts) * sampling_interval
+        if self.condition == '<':
+            qualified = widths < self.max_width
+        elif self.condition == '>':
+            qualified = widths > self.min_width
+        else:
+            qualified = (widths >= self.min_width) & (widths <= self.max_width)
+        return ends[qualified]
+
+
+class RuntTrigger(Trigger):
+    """Pulse that crosses the low threshold but falls back without reaching the high threshold.
+
+    For a positive runt the event is the falling edge back through low;
+    a negative runt mirrors this with respect to high.
+    """
+
+    def __init__(self, low=-1., high=1., polarity='Positive', hysteresis=0.):
+        self.low = low
+        self.high = high
+        self.polarity = polarity
+        self.hysteresis = hysteresis
+
+    def events(self, ch, sampling_interval):
+        if self.polarity == 'Positive':
+            starts = schmitt_edges(ch, self.low, self.hysteresis, True)
+            ends = schmitt_edges(ch, self.low, self.hysteresis, False)
+            reached = schmitt_edges(ch, self.high, self.hysteresis, True)
+        else:
+            starts = schmitt_edges(ch, self.high, self.hysteresis, False)
+            ends = schmitt_edges(ch, self.high, self.hysteresis, True)
+            reached = schmitt_edges(ch, self.low, self.hysteresis, False)
+        index = np.searchsorted(ends, starts)
+        complete = index < len(ends)
+        starts = starts[complete]
+        ends = ends[index[complete]]
+        # a runt ends before the next crossing of the far threshold
+        after = np.searchsorted(reached, starts)
+        next_reached = np.append(reached, np.inf)[after]
+        return ends[ends < next_reached]
+
+
+class WindowTrigger(Trigger):
+    """Signal leaving (mode 'Exit') or entering (mode 'Enter') the band between low and high."""
+
+    def __init__(self, low=-1., high=1., mode='Exit', hysteresis=0.):
+        self.low = low
+        self.high = high
+        self.mode = mode
+        self.hysteresis = hysteresis
+
+    def events(self, ch, sampling_interval):
+        exiting = self.mode == 'Exit'
+        through_high = schmitt_edges(ch, self.high, self.hysteresis, exiting)
+        through_low = schmitt_edges(ch, self.low, self.hysteresis, not exiting)
+        return np.sort(np.concatenate((through_high, through_low)))
+
+
+class QualifiedTrigger(Trigger):
+    """Fires on every nth event of another trigger and then ignores its events for holdoff seconds.
+
+    Counting starts at the first event in the frame.  After firing, events
+    within the holdoff time are skipped and counting restarts with the
+    next event.
+    """
+
+    def __init__(self, trigger, nth=1, holdoff=0.):
+        self.trigger = trigger
+        self.nth = nth
+        self.holdoff = holdoff
+
+    def events(self, ch, sampling_interval):
+        events = self.trigger.events(ch, sampling_interval)
+        nth = max(int(self.nth), 1)
+        if self.holdoff <= 0.:
+            return events[nth - 1::nth]
+        holdoff = self.holdoff / sampling_interval
+        fired = []
+        index = nth - 1
+        # one search per accepted event rather than a pass over every event
+        while index < len(events):
+            fired.append(events[index])
+            index = int(np.searchsorted(events, events[index] + holdoff, side='right')) + nth - 1
+        return np.array(fired)
+
+
+if __name__ == '__main__':
+    import time
+
+    num_samples = 1500
+    sampling_interval = 1e-6
+    rng = np.random.default_rng(0)
+    t = sampling_interval * np.arange(num_samples)
+    # a noisy 10 kHz square wave with one narrow glitch and one runt pulse
+    ch = np.where((t * 1e4) % 1. < 0.5, 1., -1.) + 0.05 * rng.standard_normal(num_samples)
+    ch[770:774] = 1.
+    ch[380:392] = 0.2
+
+    triggers = [('edge, no hysteresis', EdgeTrigger(0., 'Rising')),
+                ('edge, hysteresis', EdgeTrigger(0., 'Rising', 0.2)),
+                ('pulse width < 10 us', PulseWidthTrigger(0., 'Positive', '<', max_width=10e-6, hysteresis=0.2)),
+                ('pulse width > 40 us', PulseWidthTrigger(0., 'Positive', '>', min_width=40e-6, hysteresis=0.2)),
+                ('runt', RuntTrigger(-0.5, 0.5, 'Positive', 0.1)),
+                ('window exit', WindowTrigger(-1.5, 0.5, 'Exit', 0.1)),
+                ('every 2nd edge', QualifiedTrigger(EdgeTrigger(0., 'Rising', 0.2), nth=2)),
+                ('edge, 250 us holdoff', QualifiedTrigger(EdgeTrigger(0., 'Rising', 0.2), holdoff=250e-6))]
+
+    print('{:>22s} {:>8s} {:>10s} {:>10s}'.format('trigger', 'events', 'us/frame', 'position'))
+    for name, trigger in triggers:
+        frames = 2000
+        start = time.perf_counter()
+        for i in range(frames):
+            found = trigger.find(ch, num_samples >> 1, sampling_interval)
+        elapsed = (time.perf_counter() - start) / frames
+        events = trigger.events(ch, sampling_interval)
+        print('{:>22s} {:8d} {:10.1f} {:>10s}'.format(name, len(events), 1e6 * elapsed, 'none' if found is None else '{:.2f}'.format(sum(found))))
+        assert elapsed < 1e-3, '{} takes more than 1 ms per frame'.format(name)
+
+    # noise on a slow sine crosses the level several times per edge
+    sine = np.sin(2. * np.pi * 2e3 * t) + 0.05 * rng.standard_normal(num_samples)
+    assert len(EdgeTrigger(0., 'Rising').events(sine, sampling_interval)) > 3, 'test signal is not noisy enough'
+    assert len(EdgeTrigger(0., 'Rising', 0.3).events(sine, sampling_interval)) == 3, 'hysteresis did not reject noise'
+    # with no hysteresis the edge trigger agrees with the plain edge search
+    from frameprocessor import FrameProcessor
+    processor = FrameProcessor(num_samples)
+    for edge in ('Rising', 'Falling'):
+        for middle in range(0, num_samples, 37):
+            [position, offset] = EdgeTrigger(0.3, edge).find(sine, middle)
+            expected = processor.find_trigger(sine, 0.3, edge, middle)
+            assert (position == expected[0]) and abs(offset - expected[1]) < 1e-9, 'edge trigger differs from find_trigger'
+    assert np.allclose(triggers[2][1].events(ch, sampling_interval), [774.], atol=1.)
+    assert np.allclose(triggers[4][1].events(ch, sampling_interval), [392.], atol=1.)
+    print('OK')
@@ -0,0 +1,153 @@
+"""
+Wavegen preview for Whoa-Scope.
+Draws the waveform generator's output from one-period tables of the unit
+shapes instead of evaluating np.sin over the whole preview on every change.
+The unit shape at the preview's sample times is looked up from the table
+once per change of shape, frequency or time span, which is a resample of
+the table, and a change of amplitude or offset, which is what dragging the
+control points does most, only scales, shifts and clips that into a buffer
+that is reused from one update to the next.
+"""
+
+import math
+
+import numpy as np
+
+
+TABLE_SIZE = 1024
+
+SHAPES = ('DC', 'SIN', 'SQUARE', 'TRIANGLE')
+
+
+def unit_table(shape, size=TABLE_SIZE):
+    """Return one period of a unit-amplitude shape, with the first sample repeated at the end for interpolation."""
+    phase = np.arange(size + 1) / size
+    if shape == 'DC':
+        return np.zeros(size + 1)
+    elif shape == 'SIN':
+        return np.sin(2. * math.pi * phase)
+    elif shape == 'SQUARE':
+        table = np.where(phase % 1. < 0.5, 1., -1.)
+        table[0] = table[-1] = 0.
+        return table
+    elif shape == 'TRIANGLE':
+        return 1. - 4. * np.abs((phase + 0.25) % 1. - 0.5)
+    raise ValueError("waveform shape must be 'DC', 'SIN', 'SQUARE', or 'TRIANGLE'")
+
+
+class PreviewRenderer(object):
+    """Preview of num_points samples of the wavegen output, clipped to [lo, hi].
+
+    render() returns the sample times and the voltages.  Both arrays are
+    reused by later calls, so callers that keep them, such as a plot
+    curve, see the update in place.
+    """
+
+    def __init__(self, num_points=401, lo=0., hi=5.):
+        self.num_points = num_points
+        self.lo = lo
+        self.hi = hi
+        self.tables = {}
+        self.t = None
+        self.span = None
+        self.unit = np.zeros(num_points)
+        self.unit_key = None
+        self.values = np.empty(num_points)
+
+    def table(self, shape):
+        if shape not in self.tables:
+            self.tables[shape] = unit_table(shape)
+        return self.tables[shape]
+
+    def times(self, t0, t1):
+        if self.span != (t0, t1):
+            self.t = np.linspace(t0, t1, self.num_points)
+            self.span = (t0, t1)
+        return self.t
+
+    def unit_shape(self, shape, t0, t1, frequency):
+        """Return the unit shape at the preview's sample times, resampled from the table only when something changed."""
+        key = (shape, t0, t1, frequency)
+        if key != self.unit_key:
+            t = self.times(t0, t1)
+            if shape == 'DC':
+                self.unit[:] = 0.
+            else:
+                position = (frequency * t) % 1. * TABLE_SIZE
+                index = np.minimum(position.astype(np.int64), TABLE_SIZE - 1)
+                table = self.table(shape)
+                np.subtract(table[index + 1], table[index], out=self.unit)
+                self.unit *= position - index
+                self.unit += table[index]
+            self.unit_key = key
+        return self.unit
+
+    def render(self, shape, t0, t1, frequency, amplitude, offset):
+        unit = self.unit_shape(shape, t0, t1, frequency)
+        np.multiply(unit, amplitude, out=self.values)
+        self.values += offset
+        np.clip(self.values, self.lo, self.hi, out=self.values)
+        return [self.t, self.values]
+
+
+if __name__ == '__main__':
+    import time
+
+    def direct(shape, t0, t1, frequency, amplitude, offset, num_points):
+        # what WavegenPlot.update_preview() computed on every change
+        t = np.linspace(t0, t1, num_points)
+        if shape == 'DC':
+            v = offset * np.ones(num_points)
+        elif shape == 'SIN':
+            v = offset + amplitude * np.sin(2. * math.pi * frequency * t)
+        elif shape == 'SQUARE':
+            v = offset + amplitude * np.sign(np.sin(2. * math.pi * frequency * t))
+        else:
+            v = offset + amplitude * 2. * np.arcsin(np.sin(2. * math.pi * frequency * t)) / math.pi
+        where_over = np.where(v > 5.)[0]
+        v[where_over] = 5.
+        where_under = np.where(v < 0.)[0]
+        v[where_under] = 0.
+        return [t, v]
+
+    # agreement with the direct computation, away from the edges of the square
+    for shape in SHAPES:
+        for frequency in (20e-3, 1e3, 12345., 200e3):
+            renderer = PreviewRenderer(4001)
+            for amplitude, offset in ((1., 2.5), (2.5, 1.), (0.3, 4.9)):
+                [t, v] = renderer.render(shape, 0., 1. / frequency, frequency, amplitude, offset)
+                [t_direct, v_direct] = direct(shape, 0., 1. / frequency, frequency, amplitude, offset, 4001)
+                assert np.array_equal(t, t_direct)
+                error = np.abs(v - v_direct)
+                if shape == 'SQUARE':
+                    phase = (frequency * t) % 1.
+                    error = error[np.minimum(np.abs(phase - 0.5), np.minimum(phase, 1. - phase)) > 2. / TABLE_SIZE]
+                assert error.max() < 1e-4 * amplitude + 1e-12, (shape, frequency, amplitude, error.max())
+
+    # dragging: amplitude and offset change every event, and the frequency
+    # every few events
+    print('{:>9s} {:>8s} {:>12s} {:>12s} {:>8s}'.format('shape', 'points', 'direct us', 'table us', 'speedup'))
+    for shape in ('SIN', 'TRIANGLE'):
+        for num_points in (401, 4001, 40001):
+            renderer = PreviewRenderer(num_points)
+            num_events = 400 if num_points < 40001 else 100
+            timings = {}
+            for method in ('direct', 'table'):
+                start = time.perf_counter()
+                for event in range(num_events):
+                    frequency = 1e3 * (1. + 0.01 * (event // 8))
+                    args = (shape, 0., 1e-3, frequency, 1. + 1e-3 * event, 2.5 + 1e-3 * event)
+                    if method == 'direct':
+                        direct(*args, num_points)
+                    else:
+                        renderer.render(*args)
+                timings[method] = 1e6 * (time.perf_counter() - start) / num_events
+            print('{:>9s} {:8d} {:12.1f} {:12.1f} {:7.1f}x'.format(shape, num_points, timings['direct'], timings['table'], timings['direct'] / timings['table']))
+            if num_points >= 4001:
+                assert timings['table'] < timings['direct']
+    # the buffers are reused
+    renderer = PreviewRenderer()
+    [t, v] = renderer.render('SIN', 0., 1e-3, 1e3, 1., 2.5)
+    [t2, v2] = renderer.render('SIN', 0., 1e-3, 2e3, 2., 1.)
+    assert (t is t2) and (v is v2)
+    print('OK')